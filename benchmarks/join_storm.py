@@ -0,0 +1,118 @@
+"""Measures how long a storm of simultaneous %join commands takes to be answered.
+
+Starts a server (or targets a running one with --no-server), posts --history
+messages, connects --clients clients that negotiate line framing, then has
+every one of them send %join at the same moment, as happens when everyone
+reconnects after a restart. Reports the time until each join's reply
+(recent messages and the user list) has arrived, and for the whole storm.
+
+    python3 benchmarks/join_storm.py --clients 1000
+    python3 benchmarks/join_storm.py --engine threaded --server-arg=--join-history=50
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from loadgen import ROOT, raise_fd_limit, summarize, wait_for_port
+
+FRAME_ACK = b"Framing set to line.\n"
+JOINED_PROMPT = b"[Public Board]> "
+POSTED = b"Message posted to the public board.\n"
+SEED_BATCH = 50
+
+async def connect(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"%frame line\n")
+    received = b''
+    while FRAME_ACK not in received:
+        data = await reader.read(4096)
+        if not data:
+            raise ConnectionError("Server closed the connection during framing negotiation")
+        received += data
+    return reader, writer
+
+async def join(reader, writer, username, start):
+    await start.wait()
+    sent = time.perf_counter()
+    writer.write(f"%join {username}\n".encode())
+    received = b''
+    while JOINED_PROMPT not in received:
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError(f"{username} was disconnected while joining")
+        received = received[-len(JOINED_PROMPT):] + data
+    return (time.perf_counter() - sent) * 1000
+
+async def seed(host, port, count):
+    reader, writer = await connect(host, port)
+    writer.write(b"%join seeder\n")
+    # Batches stay well under the outbound queue size, so no reply is dropped
+    for start in range(0, count, SEED_BATCH):
+        batch = range(start, min(count, start + SEED_BATCH))
+        for i in batch:
+            writer.write(f"%post seeded message {i} with a little text in it\n".encode())
+        received = b''
+        while received.count(POSTED) < len(batch):
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("Seeding client was disconnected")
+            received += data
+    return writer
+
+async def storm(args):
+    seeder = await seed(args.host, args.port, args.history)
+    connections = await asyncio.gather(*(connect(args.host, args.port) for _ in range(args.clients)))
+    start = asyncio.Event()
+    joins = [asyncio.ensure_future(join(reader, writer, f"storm{i}", start))
+             for i, (reader, writer) in enumerate(connections)]
+    await asyncio.sleep(0.1)
+    began = time.perf_counter()
+    start.set()
+    latencies = await asyncio.gather(*joins)
+    elapsed = time.perf_counter() - began
+    for _, writer in connections:
+        writer.close()
+    seeder.close()
+    return latencies, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12398)
+    parser.add_argument('--engine', default='asyncio', help="passed to server.py --engine")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="extra argument for server.py, e.g. --server-arg=--join-history=50")
+    parser.add_argument('--no-server', action='store_true', help="benchmark a server that is already running")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--history', type=int, default=1000, help="public board messages posted beforehand")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server = None
+    if not args.no_server:
+        # The seeding client posts far faster than the default post limit allows, and
+        # every join notice is queued to every client, so queues must hold a whole storm
+        # for the join replies not to be dropped as the oldest frames
+        command = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', args.host,
+                   '--port', str(args.port), '--engine', args.engine, '--rate-limit', 'post=0',
+                   '--queue-size', str(2 * args.clients + 256), *args.server_arg]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.host, args.port)
+        latencies, elapsed = asyncio.run(storm(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    stats = summarize(latencies)
+    print(f"{args.clients} simultaneous joins with {args.history} messages of history ({args.engine})")
+    print(f"storm finished in {elapsed * 1000:.0f} ms ({args.clients / elapsed:.0f} joins/s)")
+    print(f"join reply latency: p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+          f"max {stats['max_ms']:.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Load generator and latency benchmark for the bulletin board protocol.
+
+Starts a server locally (or targets a running one with --no-server), connects
+many simulated clients that negotiate line framing, joins them, and then has
+each one issue a weighted mix of commands in a closed loop. Reports throughput,
+per-command latency percentiles and end-to-end broadcast delivery latency, and
+writes everything as JSON so runs can be compared across engines and commits.
+
+    python3 benchmarks/loadgen.py --clients 2000 --duration 20 --engine asyncio
+    python3 benchmarks/loadgen.py --mix post=1,users=1 --server-arg=--workers=4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_MIX = 'post=2,grouppost=2,message=4,users=1'
+PROMPT = b"\n[Public Board]> "
+FRAME_ACK = b"Framing set to line.\n"
+THROTTLED = b"Slow down: "
+BROADCAST_STAMP = re.compile(rb"\[bench:(\d+)\]")
+GROUP_COUNT = 5
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def summarize(values_ms):
+    values_ms = sorted(values_ms)
+    return {
+        'count': len(values_ms),
+        'mean_ms': sum(values_ms) / len(values_ms) if values_ms else None,
+        'p50_ms': percentile(values_ms, 0.50),
+        'p99_ms': percentile(values_ms, 0.99),
+        'p999_ms': percentile(values_ms, 0.999),
+        'max_ms': values_ms[-1] if values_ms else None,
+    }
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('post', 'grouppost', 'message', 'users'):
+            raise argparse.ArgumentTypeError(f"Unknown command in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+class SimulatedClient:
+    def __init__(self, index, observer):
+        self.index = index
+        self.username = f"bench{index}"
+        self.group = f"Group{index % GROUP_COUNT + 1}"
+        self.observer = observer
+        self.prompts = asyncio.Queue()  # (arrival ns, whether the reply was a throttle) per prompt
+        self.throttled = False
+        self.broadcast_ms = []
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(b"%frame line\n")
+        received = b''
+        while FRAME_ACK not in received:
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConnectionError("Server closed the connection during framing negotiation")
+            received += data
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        tail = b''
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            now = time.time_ns()
+            window = tail + data
+            boundary = 0
+            for prompt in re.finditer(re.escape(PROMPT), window):
+                self.throttled = self.throttled or THROTTLED in window[boundary:prompt.start()]
+                self.prompts.put_nowait((now, self.throttled))
+                self.throttled = False
+                boundary = prompt.end()
+            self.throttled = self.throttled or THROTTLED in window[boundary:]
+            if self.observer:
+                for match in BROADCAST_STAMP.finditer(window):
+                    self.broadcast_ms.append((now - int(match.group(1))) / 1e6)
+                    boundary = max(boundary, match.end())
+            # Keep enough to catch a prompt or stamp split across reads, but never count one twice
+            tail = window[max(boundary, len(window) - 40):]
+
+    async def command(self, text):
+        """Latency in ms, or None if the server throttled the command instead of running it."""
+        start = time.time_ns()
+        self.writer.write(text.encode() + b"\n")
+        end, throttled = await self.prompts.get()
+        return None if throttled else (end - start) / 1e6
+
+    def close(self):
+        self.read_task.cancel()
+        self.writer.close()
+
+async def run_clients(indexes, args, deadline_start, observers):
+    clients = [SimulatedClient(i, i in observers) for i in indexes]
+    latencies = {name: [] for name in ('join', 'groupjoin', 'post', 'grouppost', 'message', 'users')}
+    errors = 0
+    connect_limit = asyncio.Semaphore(200)
+
+    async def setup(client):
+        async with connect_limit:
+            await client.connect(args.host, args.port)
+        # The first prompt after the ack still says Not Joined, so join is measured against the next one
+        for name, text in (('join', f"%join {client.username}"), ('groupjoin', f"%groupjoin {client.group}")):
+            latency = await client.command(text)
+            if latency is None:
+                raise RuntimeError(f"{name} was throttled")
+            latencies[name].append(latency)
+
+    results = await asyncio.gather(*(setup(c) for c in clients), return_exceptions=True)
+    live = [c for c, r in zip(clients, results) if not isinstance(r, Exception)]
+    errors += len(clients) - len(live)
+
+    # Every process starts the measured phase at the same wall-clock moment
+    await asyncio.sleep(max(0.0, deadline_start - time.time()))
+    for client in live:
+        client.broadcast_ms.clear()
+    deadline = deadline_start + args.duration
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    completed = 0
+
+    async def drive(client):
+        nonlocal completed, errors
+        rng = random.Random(client.index)
+        while time.time() < deadline:
+            name = rng.choices(names, weights)[0]
+            if name == 'post':
+                text = f"%post [bench:{time.time_ns()}]"
+            elif name == 'grouppost':
+                text = f"%grouppost {client.group} [bench:{time.time_ns()}]"
+            elif name == 'message':
+                text = f"%message {rng.randint(1, 100)}"
+            else:
+                text = "%users"
+            latency = await client.command(text)
+            if latency is None:
+                errors += 1  # A throttle reply says nothing about how fast the server runs the command
+            else:
+                latencies[name].append(latency)
+                completed += 1
+            if args.think_ms:
+                await asyncio.sleep(rng.uniform(0, 2 * args.think_ms) / 1000)
+
+    drive_results = await asyncio.gather(*(drive(c) for c in live), return_exceptions=True)
+    errors += sum(isinstance(r, Exception) for r in drive_results)
+    broadcast_ms = [ms for client in live for ms in client.broadcast_ms]
+    for client in live:
+        client.close()
+    return {'latencies': latencies, 'broadcast_ms': broadcast_ms, 'completed': completed,
+            'connected': len(live), 'errors': errors}
+
+def client_process(indexes, args, deadline_start, observers):
+    raise_fd_limit()
+    return asyncio.run(run_clients(indexes, args, deadline_start, observers))
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start listening on {host}:{port}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12399)
+    parser.add_argument('--engine', default='asyncio', help="passed to server.py --engine")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="extra argument for server.py, e.g. --server-arg=--workers=4")
+    parser.add_argument('--no-server', action='store_true', help="benchmark a server that is already running")
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--processes', type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="client processes the simulated clients are spread over")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--think-ms', type=float, default=50.0, help="mean pause between a client's commands")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"command weights (default {DEFAULT_MIX})")
+    parser.add_argument('--observers', type=int, default=20,
+                        help="clients that timestamp received broadcasts for delivery latency")
+    parser.add_argument('--output', help="JSON results path (default benchmarks/results/<engine>-<time>.json)")
+    args = parser.parse_args()
+
+    server = None
+    if not args.no_server:
+        # Simulated clients run far faster than the default rate limits allow
+        command = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', args.host,
+                   '--port', str(args.port), '--engine', args.engine,
+                   '--rate-limit', 'post=0', '--rate-limit', 'read=0', '--rate-limit', 'join=0',
+                   *args.server_arg]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.host, args.port)
+        shares = [list(range(p, args.clients, args.processes)) for p in range(args.processes)]
+        observers = set(range(min(args.observers, args.clients)))
+        # Leave time for every client to connect and join before the measured phase
+        deadline_start = time.time() + 2.0 + args.clients / 500
+        with multiprocessing.Pool(args.processes) as pool:
+            parts = pool.starmap(client_process,
+                                 [(share, args, deadline_start, observers) for share in shares])
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = {}
+    for part in parts:
+        for name, values in part['latencies'].items():
+            latencies.setdefault(name, []).extend(values)
+    completed = sum(part['completed'] for part in parts)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'engine': args.engine,
+        'server_args': args.server_arg,
+        'clients': args.clients,
+        'connected': sum(part['connected'] for part in parts),
+        'errors': sum(part['errors'] for part in parts),
+        'duration_s': args.duration,
+        'think_ms': args.think_ms,
+        'mix': args.mix,
+        'throughput_cmds_per_s': completed / args.duration,
+        'commands': {name: summarize(values) for name, values in latencies.items() if values},
+        'broadcast_delivery': summarize([ms for part in parts for ms in part['broadcast_ms']]),
+    }
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"{args.engine}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{results['connected']}/{args.clients} clients, {results['errors']} errors, "
+          f"{results['throughput_cmds_per_s']:.0f} commands/s")
+    print(f"{'command':<10} {'count':>8} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}")
+    rows = list(results['commands'].items()) + [('broadcast', results['broadcast_delivery'])]
+    for name, stats in rows:
+        if stats['count']:
+            print(f"{name:<10} {stats['count']:>8} {stats['p50_ms']:>8.2f} "
+                  f"{stats['p99_ms']:>8.2f} {stats['p999_ms']:>8.2f}")
+    print(f"Results written to {output}")
+
+if __name__ == '__main__':
+    main()
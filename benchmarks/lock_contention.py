@@ -0,0 +1,84 @@
+"""Measures %grouppost throughput as traffic is spread over more groups.
+
+Runs the server's command handlers in-process (no sockets) with one thread per
+poster. History is kept in message logs with fsync on every write, so each post
+does real I/O while holding its group's lock. With --single-lock every group
+shares one lock, which is how the server behaved before locks were partitioned.
+
+    python3 benchmarks/lock_contention.py --groups 1 2 4 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import message_log  # noqa: E402
+import server  # noqa: E402
+
+class NullConnection:
+    framing = 'raw'
+
+    def sendall(self, data):
+        pass
+
+    def send_framed(self, frame):
+        pass
+
+def run(num_groups, threads_per_group, duration, single_lock):
+    group_names = list(server.groups)[:num_groups]
+    shared = threading.Lock()
+    for name in server.groups:
+        group = server.groups[name]
+        group['members'].clear()
+        group['lock'] = shared if single_lock else threading.Lock()
+
+    posters = []
+    for name in group_names:
+        for i in range(threads_per_group):
+            username = f"{name}-poster{i}"
+            server.groups[name]['members'][username] = NullConnection()
+            posters.append((username, name))
+
+    counts = [0] * len(posters)
+    stop = threading.Event()
+
+    def post(slot, username, group_name):
+        conn = server.groups[group_name]['members'][username]
+        command = f"%grouppost {group_name} benchmark message from {username}"
+        while not stop.is_set():
+            server.process_command(command, username, conn)
+            counts[slot] += 1
+
+    workers = [threading.Thread(target=post, args=(slot, username, name))
+               for slot, (username, name) in enumerate(posters)]
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', type=int, nargs='+', default=[1, 2, 3, 4, 5])
+    parser.add_argument('--threads-per-group', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        message_log.FSYNC_POLICY = 'always'
+        server.open_message_logs(data_dir)
+        print(f"{'groups':>6} {'partitioned posts/s':>20} {'single lock posts/s':>20} {'speedup':>8}")
+        for num_groups in args.groups:
+            partitioned = run(num_groups, args.threads_per_group, args.duration, single_lock=False)
+            single = run(num_groups, args.threads_per_group, args.duration, single_lock=True)
+            print(f"{num_groups:>6} {partitioned:>20.0f} {single:>20.0f} {partitioned / single:>7.2f}x")
+        server.close_histories()
+
+if __name__ == '__main__':
+    main()
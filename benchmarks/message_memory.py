@@ -0,0 +1,73 @@
+"""Measures bytes per stored message for the old dict records and the slotted Message.
+
+Builds --count messages the way the server does (a fresh sender string per
+command, content of about --content-length characters) and reports traced
+allocations per message, plus what --project messages would take. The dict
+layout is the one used before messages became Message objects; "cached" is
+a Message whose wire bytes have been built, as happens once it is broadcast.
+
+    python3 benchmarks/message_memory.py --count 10000000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from message import Message  # noqa: E402
+
+SENDERS = 1000
+
+def command_text(i, content_length):
+    # Split from a command string so each message owns its strings, like handle_post
+    words = f"%post user{i % SENDERS} message {i} ".ljust(content_length + 20, 'x').split(' ', 2)
+    return words[1], words[2]
+
+def make_dict(i, content_length):
+    sender, content = command_text(i, content_length)
+    return {'id': i + 1, 'sender': sender, 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'content': content}
+
+def make_message(i, content_length):
+    sender, content = command_text(i, content_length)
+    return Message(i + 1, sender, content)
+
+def make_cached(i, content_length):
+    message = make_message(i, content_length)
+    message.wire()
+    return message
+
+def measure(factory, count, content_length):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    history = [factory(i, content_length) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del history
+    return current / count, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--content-length', type=int, default=40)
+    parser.add_argument('--project', type=int, default=10000000,
+                        help="report the memory this many messages would need")
+    args = parser.parse_args()
+
+    print(f"{args.count} messages, ~{args.content_length} character content")
+    print(f"{'record':<10} {'bytes/msg':>10} {f'GiB for {args.project}':>16} {'build s':>8}")
+    baseline = None
+    for name, factory in (('dict', make_dict), ('Message', make_message), ('cached', make_cached)):
+        per_message, elapsed = measure(factory, args.count, args.content_length)
+        baseline = baseline or per_message
+        print(f"{name:<10} {per_message:>10.0f} {per_message * args.project / 2**30:>16.2f} {elapsed:>8.1f}"
+              f"  ({per_message / baseline:.0%} of dict)")
+
+if __name__ == '__main__':
+    main()
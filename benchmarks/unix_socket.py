@@ -0,0 +1,144 @@
+"""Compares round-trip latency and server CPU over loopback TCP and a Unix socket.
+
+Starts a server listening on both (or targets a running one with --no-server),
+then for each transport in turn connects --clients clients that negotiate line
+framing and join, and has each send --requests commands one at a time, waiting
+for every reply. Transports alternate for --rounds rounds so drift affects both.
+Reports latency, throughput and the server's CPU time per 1000 commands (read
+from /proc, so only when the script started the server on Linux).
+
+    python3 benchmarks/unix_socket.py
+    python3 benchmarks/unix_socket.py --engine threaded --clients 50 --command "%users"
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadgen import ROOT, raise_fd_limit, summarize, wait_for_port
+
+FRAME_ACK = b"Framing set to line.\n"
+PROMPT = b"\n[Public Board]> "
+TRANSPORTS = ('tcp', 'unix')
+
+async def open_client(args, transport, username):
+    if transport == 'unix':
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    writer.write(b"%frame line\n")
+    await reader.readuntil(FRAME_ACK)
+    writer.write(f"%join {username}\n".encode())
+    await reader.readuntil(PROMPT)
+    return reader, writer
+
+async def run_requests(reader, writer, command, count):
+    latencies = []
+    for _ in range(count):
+        sent = time.perf_counter()
+        writer.write(command)
+        await reader.readuntil(PROMPT)
+        latencies.append((time.perf_counter() - sent) * 1000)
+    return latencies
+
+async def run_transport(args, transport, round_number):
+    clients = await asyncio.gather(*(open_client(args, transport, f"{transport}{round_number}_{i}")
+                                     for i in range(args.clients)))
+    command = f"{args.command}\n".encode()
+    cpu_before = server_cpu(args.server_pid)
+    began = time.perf_counter()
+    results = await asyncio.gather(*(run_requests(reader, writer, command, args.requests)
+                                     for reader, writer in clients))
+    elapsed = time.perf_counter() - began
+    cpu_after = server_cpu(args.server_pid)
+    for _, writer in clients:
+        writer.write(b"%exit\n")
+        writer.close()
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return [latency for latencies in results for latency in latencies], elapsed, cpu
+
+def server_cpu(pid):
+    """User plus system CPU seconds used so far by pid and its workers, or None without /proc."""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids = [pid] + [int(child) for child in f.read().split()]
+        ticks = 0
+        for process in pids:
+            with open(f"/proc/{process}/stat") as f:
+                fields = f.read().rpartition(')')[2].split()
+            ticks += int(fields[11]) + int(fields[12])
+    except OSError:
+        return None
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+async def seed(args):
+    reader, writer = await open_client(args, 'tcp', 'seeder')
+    writer.write(b"%post a message for %message 1 to read\n")
+    await reader.readuntil(PROMPT)
+    writer.close()
+
+async def benchmark(args):
+    await seed(args)
+    totals = {transport: ([], 0.0, 0.0) for transport in TRANSPORTS}
+    for round_number in range(args.rounds):
+        for transport in TRANSPORTS:
+            latencies, elapsed, cpu = await run_transport(args, transport, round_number)
+            all_latencies, all_elapsed, all_cpu = totals[transport]
+            all_latencies.extend(latencies)
+            totals[transport] = (all_latencies, all_elapsed + elapsed,
+                                 None if cpu is None or all_cpu is None else all_cpu + cpu)
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12399)
+    parser.add_argument('--unix', default=os.path.join(tempfile.gettempdir(), 'bulletin-board-bench.sock'),
+                        help="Unix socket path, passed to server.py --unix")
+    parser.add_argument('--engine', default='asyncio', help="passed to server.py --engine")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="extra argument for server.py, e.g. --server-arg=--workers=2")
+    parser.add_argument('--no-server', action='store_true', help="benchmark a server that is already running")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=500, help="commands each client sends per round")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--command', default='%message 1')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server = None
+    args.server_pid = None
+    if not args.no_server:
+        # Rate limits would throttle the benchmark long before either transport does
+        command = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', args.host,
+                   '--port', str(args.port), '--unix', args.unix, '--engine', args.engine,
+                   '--rate-limit', 'post=0', '--rate-limit', 'read=0', '--rate-limit', 'join=0',
+                   *args.server_arg]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    try:
+        wait_for_port(args.host, args.port)
+        totals = asyncio.run(benchmark(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    count = args.clients * args.requests * args.rounds
+    print(f"{args.clients} clients x {args.requests} x {args.rounds} rounds of '{args.command}' ({args.engine})")
+    for transport in TRANSPORTS:
+        latencies, elapsed, cpu = totals[transport]
+        stats = summarize(latencies)
+        line = (f"{transport:>4}: {count / elapsed:.0f} req/s, p50 {stats['p50_ms']:.3f} ms, "
+                f"p99 {stats['p99_ms']:.3f} ms")
+        if cpu is not None:
+            line += f", server CPU {cpu * 1000 / (count / 1000):.1f} ms per 1000 requests"
+        print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import asyncio
+import collections
+import re
+import zlib
+
+import compression
+import framing
+import heartbeat
+
+# Board Client Configuration
+# Length framing makes every server write its own frame, which is what lets
+# replies be told apart from the broadcasts around them
+FRAMING = 'length'
+READ_SIZE = 65536
+EVENT_QUEUE_SIZE = 10000  # per subscriber; the oldest events are dropped beyond this
+
+PROMPT = re.compile(r"\n\[([^\]\n]*)\]> \Z")
+POST = r"<(?P<sender>\S+?)> \[(?P<content>.*)\] <(?P<id>\d+)>"
+POST_LINE = re.compile(rf"^{POST}$", re.MULTILINE)
+EVENTS = (
+    ('post', re.compile(rf"{POST}\n")),
+    ('grouppost', re.compile(rf"Group (?P<group>\S+): {POST}\n")),
+    ('joined', re.compile(r"(?P<username>\S+) has joined the public board\.\n")),
+    ('left', re.compile(r"(?P<username>\S+) has left the public board\.\n")),
+    ('group_deleted', re.compile(r"Group (?P<group>\S+) has been deleted\.\n")),
+    ('skipped', re.compile(r"\[\d+ messages skipped[^\n]*\]\n")),
+)
+SESSION_TOKEN = re.compile(r"^Session token: (\S+)", re.MULTILINE)
+MORE_MESSAGES = re.compile(r"^More messages available: (.+)$", re.MULTILINE)
+THROTTLED = re.compile(r"^Slow down: .* Try again in ([\d.]+)s\.", re.MULTILINE)
+EXPIRED = re.compile(r"^Message \d+ has expired\.$", re.MULTILINE)
+
+Post = collections.namedtuple('Post', 'id sender content group')
+# kind is one of the EVENTS names, or 'notice' for anything else the server sent unprompted
+Event = collections.namedtuple('Event', 'kind text post username group')
+
+class CommandError(Exception):
+    """The server answered a command with something other than success."""
+
+    def __init__(self, reply):
+        super().__init__(reply.strip())
+        self.reply = reply
+
+class Throttled(CommandError):
+    """The server's rate limit refused the command; retry_after is in seconds."""
+
+    def __init__(self, reply, retry_after):
+        super().__init__(reply)
+        self.retry_after = retry_after
+
+class Expired(CommandError):
+    """The message asked for was dropped by the server's retention policy."""
+
+def parse_event(frame):
+    for kind, pattern in EVENTS:
+        match = pattern.fullmatch(frame)
+        if match:
+            fields = match.groupdict()
+            post = None
+            if 'id' in fields:
+                post = Post(int(fields['id']), fields['sender'], fields['content'], fields.get('group'))
+            return Event(kind, frame, post, fields.get('username'), fields.get('group'))
+    return None
+
+def parse_posts(reply, group=None):
+    return [Post(int(match['id']), match['sender'], match['content'], group) for match in POST_LINE.finditer(reply)]
+
+def check(reply, *success):
+    """Returns reply if it starts with one of the success prefixes, else raises CommandError."""
+    if reply.startswith(success):
+        return reply
+    throttled = THROTTLED.search(reply)
+    if throttled:
+        raise Throttled(reply, float(throttled.group(1)))
+    raise CommandError(reply)
+
+class BoardClient:
+    """Asyncio client for bots and integrations.
+
+    Commands are pipelined: each call writes its command straight away and
+    waits for its own reply, which the server sends in order and in the same
+    write as the prompt after it. Everything else the server sends (posts,
+    joins, leaves) goes to every events() iterator. Server pings are answered
+    automatically.
+
+        async with await BoardClient.connect('localhost', 12345) as client:
+            await client.join('bot')
+            await asyncio.gather(*(client.post(f"hello {i}") for i in range(10)))
+            async for event in client.events():
+                ...
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = framing.make_client_decoder(FRAMING)
+        self.pending = collections.deque()  # (future, reply parts) per command, in the order sent
+        self.subscribers = set()
+        self.location = 'Not Joined'
+        self.username = None
+        self.token = None
+        self.closed = False
+        self.error = None  # why the connection was lost, if it wasn't a clean close
+        self.compress = None
+        self.read_task = None
+
+    @classmethod
+    async def connect(cls, host, port, compress=None):
+        """Connect, switch to length framing and, if compress is set (e.g. 'zlib'), ask for compression."""
+        return await cls._start(*await asyncio.open_connection(host, port), compress)
+
+    @classmethod
+    async def connect_unix(cls, path, compress=None):
+        """Like connect(), through the Unix socket a server on this host opened with --unix."""
+        return await cls._start(*await asyncio.open_unix_connection(path), compress)
+
+    @classmethod
+    async def _start(cls, reader, writer, compress):
+        client = cls(reader, writer)
+        try:
+            await client._negotiate_framing()
+            if compress:
+                client.compress = compress
+                check(await client.command(f"{compression.COMPRESS_COMMAND} {compress}"),
+                      compression.COMPRESS_ACK.format(mode=compress))
+        except BaseException:
+            writer.close()
+            raise
+        return client
+
+    async def _negotiate_framing(self):
+        self.writer.write(f"{framing.FRAME_COMMAND} {FRAMING}\n".encode())
+        ack = framing.FRAME_ACK.format(mode=FRAMING).encode()
+        received = b''
+        while ack not in received:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                text = received.decode('utf-8', errors='replace').strip()
+                raise ConnectionError(f"Server closed the connection during framing negotiation: {text}")
+            received += data
+        # The prompt after the acknowledgement is the reply to %frame itself
+        reply = self._expect()
+        self.read_task = asyncio.ensure_future(self._read_loop())
+        self._received(received.partition(ack)[2])
+        await reply
+
+    def _expect(self):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((future, []))
+        return future
+
+    def _send(self, command):
+        self.writer.write(framing.frame_command(FRAMING, command))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                self._received(data)
+        except (ConnectionError, OSError, framing.FrameError, ValueError, zlib.error) as e:
+            self.error = e
+        finally:
+            self._connection_lost()
+
+    def _received(self, data):
+        self.decoder.feed(data)
+        while (frame := self.decoder.next_frame()) is not None:
+            self._handle_frame(frame)
+
+    def _handle_frame(self, frame):
+        if frame == heartbeat.PING:
+            self._send(heartbeat.PONG_COMMAND)
+            return
+        prompt = PROMPT.search(frame)
+        if prompt:
+            self.location = prompt.group(1)
+            if self.pending:
+                future, parts = self.pending.popleft()
+                parts.append(frame[:prompt.start()])
+                if not future.done():
+                    future.set_result(''.join(parts))
+            return
+        event = parse_event(frame)
+        if event is None and self.pending:
+            # Written by the handler ahead of the reply, like %join's welcome
+            self.pending[0][1].append(frame)
+            if self.compress and frame == compression.COMPRESS_ACK.format(mode=self.compress):
+                # Everything after the acknowledgement is compressed
+                remaining = self.decoder.take_remaining()
+                self.decoder = compression.DecompressingDecoder(self.decoder)
+                self.decoder.feed(remaining)
+            return
+        self._publish(event or Event('notice', frame, None, None, None))
+
+    def _publish(self, event):
+        for queue in self.subscribers:
+            if queue.qsize() >= EVENT_QUEUE_SIZE:
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def _connection_lost(self):
+        self.closed = True
+        while self.pending:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection closed before the server replied: "
+                                                     f"{self.error or 'closed by the server'}"))
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+
+    async def command(self, text):
+        """Send any command and return the server's reply, without the prompt."""
+        if self.closed:
+            raise ConnectionError("Not connected")
+        reply = self._expect()
+        self._send(text)
+        await self.writer.drain()
+        return await reply
+
+    async def events(self):
+        """Async iterator over everything the server sends that isn't a reply; ends when the connection closes."""
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        try:
+            while (event := await queue.get()) is not None:
+                yield event
+        finally:
+            self.subscribers.discard(queue)
+
+    async def join(self, username):
+        reply = check(await self.command(f"%join {username}"), "Welcome ")
+        token = SESSION_TOKEN.search(reply)
+        self.username = username
+        self.token = token.group(1) if token else None
+        return reply
+
+    async def resume(self, token, last_public_id=None, group_ids=None):
+        """Rejoin a dropped session; group_ids maps group names to the last id seen there."""
+        positions = [] if last_public_id is None else [str(last_public_id)]
+        positions += [f"{group}={last_id}" for group, last_id in (group_ids or {}).items()]
+        reply = check(await self.command(' '.join(['%resume', token, *positions])), "Welcome back ")
+        self.username = reply[len("Welcome back "):reply.index('!')]
+        self.token = token
+        return reply
+
+    async def post(self, content):
+        check(await self.command(f"%post {content}"), "Message posted")
+
+    async def grouppost(self, group, content):
+        check(await self.command(f"%grouppost {group} {content}"), "Message posted")
+
+    async def groupjoin(self, group):
+        check(await self.command(f"%groupjoin {group}"), "Joined ")
+
+    async def groupleave(self, group):
+        check(await self.command(f"%groupleave {group}"), "Left ")
+
+    async def message(self, message_id, group=None):
+        """One message by id, or None if there is no such message. Raises Expired if it has expired."""
+        if group is None:
+            reply = await self.command(f"%message {message_id}")
+        else:
+            reply = await self.command(f"%groupmessage {group} {message_id}")
+        posts = parse_posts(reply, group)
+        if posts:
+            return posts[0]
+        if reply.startswith("Message not found"):
+            return None
+        if EXPIRED.search(reply):
+            raise Expired(reply)
+        raise CommandError(reply)
+
+    async def messages(self, first_id, last_id, group=None):
+        """Messages first_id..last_id, fetching page after page as needed."""
+        if group is None:
+            return await self._fetch(f"%messages {first_id} {last_id}", group)
+        return await self._fetch(f"%groupmessages {group} {first_id} {last_id}", group)
+
+    async def since(self, message_id, group=None):
+        """Every message posted after message_id."""
+        if group is None:
+            return await self._fetch(f"%since {message_id}", group)
+        return await self._fetch(f"%groupsince {group} {message_id}", group)
+
+    async def last(self, count, group=None):
+        if group is None:
+            return await self._fetch(f"%last {count}", group)
+        return await self._fetch(f"%grouplast {group} {count}", group)
+
+    async def _fetch(self, command, group):
+        posts = []
+        while command:
+            reply = await self.command(command)
+            if reply.startswith("No messages in that range"):
+                break
+            posts.extend(parse_posts(check(reply, "Messages "), group))
+            cursor = MORE_MESSAGES.search(reply)
+            command = cursor.group(1) if cursor else None
+        return posts
+
+    async def users(self):
+        reply = check(await self.command("%users"), "Current users")
+        return [line[2:] for line in reply.splitlines() if line.startswith("- ")]
+
+    async def close(self):
+        """Leave with %exit (ending the session for good) and close the connection."""
+        if not self.closed:
+            self._send("%exit")
+            try:
+                await asyncio.wait_for(asyncio.shield(self.read_task), timeout=2.0)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+        self.writer.close()
+        if self.read_task is not None:
+            self.read_task.cancel()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
@@ -1,10 +1,12 @@
-import socket
-import threading
+import asyncio
 import sys
 
+from board_client import BoardClient
+
 # Client Configuration
 SERVER_HOST = 'localhost'
 SERVER_PORT = 12345
+COMPRESSION = None  # 'zlib' asks the server to compress everything it sends (for slow links)
 
 commands_list = {
     "%connect",
@@ -23,29 +25,38 @@ server_commands_list = {
     '%groupleave',
     '%exit',
     '%join',
+    '%resume',
+    '%stats',
+    '%messages',
+    '%since',
+    '%last',
+    '%groupmessages',
+    '%groupsince',
+    '%grouplast',
+    '%search',
+    '%groupsearch',
+    '%groupcreate',
+    '%groupdelete',
 }
 
-sock = None
+def show_prompt(client):
+    print(f"\n[{client.location}]> ", end='', flush=True)
+
+async def print_events(client):
+    """Shows everything the server sends that isn't a reply to one of our commands."""
+    async for event in client.events():
+        print(event.text, end='', flush=True)  # Avoid adding extra newlines
+    print("Server closed the connection.")
 
-def receive_messages(sock):
+async def main():
+    client = None
+    loop = asyncio.get_running_loop()
     while True:
         try:
-            data = sock.recv(4096).decode()
-            if data:
-                print(data, end='')  # Avoid adding extra newlines
-            else:
-                print("Server closed the connection.")
-                sock.close()
-                break
-        except Exception as e:
-            print(f"Error receiving data: {e}")
-            sock.close()
+            # input() blocks, so it runs in a thread while the client keeps reading
+            message = await loop.run_in_executor(None, input)
+        except EOFError:
             break
-
-def main():
-    global sock
-    while True:
-        message = input()
         if message.strip() == '':
             continue
         args = message.strip().split()
@@ -56,56 +67,50 @@ def main():
             continue
 
         if command == "%connect":
-            if len(args) != 3:
-                print("Usage: %connect [address] [port]")
+            if len(args) not in (2, 3):
+                print("Usage: %connect [address] [port], or %connect [unix socket path] on the server's host")
                 continue
 
             address = args[1]
             try:
-                port = int(args[2])
+                port = int(args[2]) if len(args) == 3 else None
             except ValueError:
                 print("Invalid port number.")
                 continue
 
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                sock.connect((address, port))
-                print(f"Connected to {address}:{port}")
-                threading.Thread(target=receive_messages, args=(sock,), daemon=True).start()
+                if port is None:
+                    client = await BoardClient.connect_unix(address, compress=COMPRESSION)
+                else:
+                    client = await BoardClient.connect(address, port, compress=COMPRESSION)
             except Exception as e:
                 print(f"Unable to connect to the server: {e}")
                 sys.exit()
+            print(f"Connected to {address}" + (f":{port}" if port is not None else ""))
+            asyncio.ensure_future(print_events(client))
+            show_prompt(client)
             continue  # Proceed to next input
 
-        if sock is None:
+        if client is None:
             print("You need to connect first using %connect")
             continue
 
-        if command == "%join":
-            if len(args) != 2:
-                print("Usage: %join [username]")
-                continue
-            try:
-                sock.sendall(message.encode())
-            except Exception as e:
-                print(f"Error sending data: {e}")
-                sock.close()
-                break
+        if command == "%join" and len(args) != 2:
+            print("Usage: %join [username]")
             continue
 
-        if command in server_commands_list:
-            try:
-                sock.sendall(message.encode())
-                if command == '%exit':
-                    print("Exiting.")
-                    sock.close()
-                    break
-            except Exception as e:
-                print(f"Error sending data: {e}")
-                sock.close()
-                break
-        else:
-            print(f"{command} is not a valid command.")
+        if command == '%exit':
+            await client.close()
+            print("Exiting.")
+            break
+
+        try:
+            reply = await client.command(message)
+        except ConnectionError as e:
+            print(f"Error sending data: {e}")
+            break
+        print(reply, end='')
+        show_prompt(client)
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
@@ -1,11 +1,21 @@
 import tkinter as tk
 from tkinter import messagebox
+import queue
 import socket
 import threading
 
+import compression
+import framing
+import heartbeat
+
 SERVER_HOST = "127.0.0.1"  # Replace with the actual server IP
 SERVER_PORT = 12345        # Replace with the actual server port
+SERVER_UNIX_PATH = None    # the server's --unix path; used instead of TCP when set (same host only)
 BUFFER_SIZE = 4096
+FRAMING = "line"           # raw, line or length; negotiated with %frame after connecting
+COMPRESSION = None         # "zlib" asks the server to compress everything it sends
+MAX_SCROLLBACK_LINES = 5000  # older lines are trimmed from the chat area
+DRAIN_INTERVAL_MS = 50       # how often queued messages are rendered
 
 class ClientGUI:
     def __init__(self):
@@ -63,17 +73,29 @@ class ClientGUI:
         # Client Socket
         self.client_socket = None
         self.running = True
+        # Filled from any thread, rendered only on the Tk thread by drain_incoming
+        self.incoming = queue.SimpleQueue()
 
         self.setup_connection()
+        if self.running:
+            self.root.after(DRAIN_INTERVAL_MS, self.drain_incoming)
         self.listen_thread = threading.Thread(target=self.receive_messages, daemon=True)
         self.listen_thread.start()
 
     def setup_connection(self):
         """Set up the connection to the server."""
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((SERVER_HOST, SERVER_PORT))
+            if SERVER_UNIX_PATH:
+                self.client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.client_socket.connect(SERVER_UNIX_PATH)
+            else:
+                self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.client_socket.connect((SERVER_HOST, SERVER_PORT))
+            greeting, self.decoder = framing.negotiate(self.client_socket, FRAMING)
+            if COMPRESSION:
+                self.decoder = compression.negotiate(self.client_socket, self.decoder, FRAMING, COMPRESSION)
             self.update_chat("Connected to the server.")
+            self.update_chat(greeting)
             self.prompt_username()
         except Exception as e:
             messagebox.showerror("Connection Error", f"Failed to connect to the server:\n{e}")
@@ -102,7 +124,7 @@ class ClientGUI:
         if username:
             join_command = f"%join {username}"
             try:
-                self.client_socket.sendall(join_command.encode())
+                self.client_socket.sendall(framing.frame_command(FRAMING, join_command))
                 self.username_window.destroy()
             except Exception as e:
                 self.update_chat(f"Error: {e}")
@@ -111,18 +133,33 @@ class ClientGUI:
             messagebox.showwarning("Invalid Username", "Username cannot be empty.")
 
     def update_chat(self, message):
-        """Update the chat area with a new message."""
-        self.chat_area.config(state='normal')
-        self.chat_area.insert('end', message + '\n')
-        self.chat_area.config(state='disabled')
-        self.chat_area.see('end')
+        """Queue a message for the chat area. Safe to call from any thread."""
+        self.incoming.put(message)
+
+    def drain_incoming(self):
+        """Render everything queued since the last call with a single insert, then trim scrollback."""
+        messages = []
+        while True:
+            try:
+                messages.append(self.incoming.get_nowait())
+            except queue.Empty:
+                break
+        if messages:
+            self.chat_area.config(state='normal')
+            self.chat_area.insert('end', '\n'.join(messages) + '\n')
+            lines = int(self.chat_area.index('end-1c').split('.')[0]) - 1
+            if lines > MAX_SCROLLBACK_LINES:
+                self.chat_area.delete('1.0', f'{lines - MAX_SCROLLBACK_LINES + 1}.0')
+            self.chat_area.config(state='disabled')
+            self.chat_area.see('end')
+        self.root.after(DRAIN_INTERVAL_MS, self.drain_incoming)
 
     def send_message(self, event=None):
         """Send a message to the server."""
         message = self.input_field.get().strip()
         if message:
             try:
-                self.client_socket.sendall(message.encode())
+                self.client_socket.sendall(framing.frame_command(FRAMING, message))
                 self.update_chat(f"You: {message}")
                 self.input_field.delete(0, 'end')
             except Exception as e:
@@ -134,9 +171,15 @@ class ClientGUI:
         """Receive messages from the server."""
         while self.running:
             try:
-                message = self.client_socket.recv(BUFFER_SIZE).decode()
-                if message:
-                    self.update_chat(message)
+                data = self.client_socket.recv(BUFFER_SIZE)
+                if data:
+                    self.decoder.feed(data)
+                    while (message := self.decoder.next_frame()) is not None:
+                        message, pings = heartbeat.strip_pings(message)
+                        if pings:
+                            self.client_socket.sendall(framing.frame_command(FRAMING, heartbeat.PONG_COMMAND))
+                        if message:
+                            self.update_chat(message)
                 else:
                     self.update_chat("Server disconnected.")
                     self.running = False
@@ -150,7 +193,7 @@ class ClientGUI:
         self.running = False
         if self.client_socket:
             try:
-                self.client_socket.sendall("%exit".encode())
+                self.client_socket.sendall(framing.frame_command(FRAMING, "%exit"))
                 self.client_socket.close()
             except Exception:
                 pass
@@ -0,0 +1,110 @@
+import struct
+import zlib
+
+import framing
+
+# Compression Configuration
+COMPRESSION_MODES = ('zlib',)
+COMPRESS_COMMAND = '%compress'
+COMPRESS_ACK = "Compression set to {mode}.\n"
+COMPRESS_MIN_BYTES = 256  # smaller writes are sent as they are
+COMPRESSION_LEVEL = 6
+MAX_ENVELOPE_SIZE = 64 * 1024 * 1024
+
+# Once compression is on, everything the server writes is wrapped in envelopes:
+# a kind byte and a 4-byte big-endian length, then the payload. RAW payloads
+# are plain bytes; ZLIB payloads continue one deflate stream that lasts for the
+# whole connection, so later writes reuse what earlier ones taught it.
+ENVELOPE = struct.Struct('!BI')
+RAW = 0
+ZLIB = 1
+
+# Seeds both ends' deflate window with text nearly every session sends
+PRESET_DICTIONARY = (
+    b"Current users on the public board:\n- "
+    b"Message posted to the public board.\n"
+    b"Last two messages on the public board:\n"
+    b"More messages available: %since "
+    b" on the public board:\nMessages "
+    b"\n[Public Board]> "
+)
+
+class Compressor:
+    """Server side of one connection's compressed stream."""
+
+    def __init__(self, level=None, continuing=False):
+        if continuing:
+            # Takes over a stream another process started (see handoff.py): raw deflate adds
+            # no header, and since the client's window no longer starts with the preset
+            # dictionary, this side refers only to what it has sent itself
+            self.zlib = zlib.compressobj(level or COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            self.zlib = zlib.compressobj(level or COMPRESSION_LEVEL, zdict=PRESET_DICTIONARY)
+
+    def wrap(self, data):
+        if len(data) < COMPRESS_MIN_BYTES:
+            return ENVELOPE.pack(RAW, len(data)) + data
+        body = self.zlib.compress(data) + self.zlib.flush(zlib.Z_SYNC_FLUSH)
+        return ENVELOPE.pack(ZLIB, len(body)) + body
+
+class Decompressor:
+    """Client side: turns received envelopes back into the server's plain output."""
+
+    def __init__(self):
+        self.zlib = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        plain = []
+        while len(self.buffer) >= ENVELOPE.size:
+            kind, length = ENVELOPE.unpack_from(self.buffer)
+            if length > MAX_ENVELOPE_SIZE:
+                raise ValueError(f"Compressed envelope of {length} bytes exceeds {MAX_ENVELOPE_SIZE}")
+            end = ENVELOPE.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[ENVELOPE.size:end])
+            del self.buffer[:end]
+            plain.append(self.zlib.decompress(payload) if kind == ZLIB else payload)
+        return b''.join(plain)
+
+class DecompressingDecoder:
+    """Puts a Decompressor in front of a framing decoder, keeping the decoder interface."""
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.decompressor = Decompressor()
+
+    def feed(self, data):
+        self.decoder.feed(self.decompressor.feed(data))
+
+    def next_frame(self):
+        return self.decoder.next_frame()
+
+def negotiate(sock, decoder, framing_mode, mode='zlib'):
+    """Ask the server to compress what it sends from now on.
+
+    Everything received before the acknowledgement is fed to decoder as is.
+    Returns the decoder to use from now on, which is decoder itself if the
+    server doesn't support compression.
+    """
+    sock.sendall(framing.frame_command(framing_mode, f"{COMPRESS_COMMAND} {mode}"))
+    ack = COMPRESS_ACK.format(mode=mode).encode()
+    refusal = b"Unknown command."
+    received = b''
+    while ack not in received and refusal not in received:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("Server closed the connection during compression negotiation")
+        received += data
+    if ack not in received:
+        decoder.feed(received)
+        return decoder
+    before, _, after = received.partition(ack)
+    if framing_mode == 'length':
+        before = before[:-framing.LENGTH_HEADER.size]  # the acknowledgement's own header
+    decoder.feed(before)
+    wrapped = DecompressingDecoder(decoder)
+    wrapped.feed(after)
+    return wrapped
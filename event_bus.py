@@ -0,0 +1,342 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from message import Message
+from message_store import MessageList
+
+# Event Bus Configuration
+CONNECT_TIMEOUT = 10.0
+
+# The hub owns everything that has to be globally consistent across worker
+# processes: usernames, group membership and message ids. Workers send it
+# requests as newline-delimited JSON over a Unix socket; every state change is
+# published to all workers as an event, in one global order, before the
+# requesting worker gets its reply.
+
+def send_json(sock, obj):
+    sock.sendall((json.dumps(obj, separators=(',', ':')) + '\n').encode())
+
+class Hub:
+    def __init__(self, path, max_groups=None):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.histories = {}      # '' for the public board, otherwise the group name
+        self.users = {}          # username -> worker id, in join order
+        self.group_members = {}  # group name -> {username: None}, in join order
+        self.group_owners = {}   # group name -> creator, None for built-in groups
+        self.user_groups = {}    # username -> set of group names, so a release skips other groups
+        self.sessions = {}       # resume token -> session saved by the worker the user dropped from
+        self.tokens = {}         # username -> resume token of each connected user
+        self.max_groups = max_groups
+        self.open_history = lambda group, owner: MessageList()
+        self.drop_history = lambda group, history: None
+        self.appended = lambda group, message: None  # told of every post, with the lock held
+        self.published = lambda event: None  # told of every event sent to workers, likewise
+        self.workers = {}        # worker id -> socket
+        self.joining = {}        # worker id -> events held back until its snapshot has been sent
+        self.next_worker_id = 1
+        self.lock = threading.Lock()
+
+    def set_histories(self, public_messages, group_histories, group_owners, open_history, drop_history):
+        """Hands the hub its storage, plus how to create and discard group histories at runtime."""
+        self.histories = {'': public_messages, **group_histories}
+        self.group_members = {name: {} for name in group_histories}
+        self.group_owners = dict(group_owners)
+        self.open_history = open_history
+        self.drop_history = drop_history
+
+    def serve_forever(self):
+        print(f"Event bus listening on {self.path}")
+        while True:
+            sock, _ = self.listener.accept()
+            threading.Thread(target=self.handle_worker, args=(sock,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def handle_worker(self, sock):
+        with self.lock:
+            worker_id = self.next_worker_id
+            self.next_worker_id += 1
+            self.workers[worker_id] = sock
+            # Events published before the snapshot is out wait here, so they still arrive after it
+            self.joining[worker_id] = []
+            snapshot = {'snapshot': {
+                'users': list(self.users),
+                'group_members': {name: list(members) for name, members in self.group_members.items()},
+                'group_owners': dict(self.group_owners),
+                'histories': {name: [message.to_dict() for message in history[history.expired:]]
+                              for name, history in self.histories.items()},
+                'expired': {name: history.expired for name, history in self.histories.items()},
+            }}
+        try:
+            # Encoding and sending the whole history happens outside the lock other workers need
+            send_json(sock, snapshot)
+            with self.lock:
+                for event in self.joining.pop(worker_id):
+                    send_json(sock, event)
+            for line in sock.makefile('rb'):
+                request = json.loads(line)
+                with self.lock:
+                    result = self.dispatch(worker_id, request)
+                    send_json(sock, {'rid': request['rid'], 'result': result})
+        except (ConnectionError, socket.error, ValueError) as e:
+            print(f"Event bus connection error with worker {worker_id}: {e}")
+        finally:
+            with self.lock:
+                del self.workers[worker_id]
+                self.joining.pop(worker_id, None)
+                # A dead worker takes its users with it
+                for username, owner in list(self.users.items()):
+                    if owner == worker_id:
+                        self.release(username)
+            sock.close()
+
+    def publish(self, event):
+        self.published(event)
+        for worker_id, sock in list(self.workers.items()):
+            if worker_id in self.joining:
+                self.joining[worker_id].append(event)
+                continue
+            try:
+                send_json(sock, event)
+            except (ConnectionError, socket.error) as e:
+                print(f"Event bus publish error to worker {worker_id}: {e}")
+
+    def expire(self, group, index):
+        """Drops a history's messages before index and has every worker do the same."""
+        with self.lock:
+            history = self.histories.get(group)
+            if history is None:
+                return
+            history.drop_before(index)
+            self.publish({'event': 'expired', 'group': group, 'before': index})
+
+    # Everything below runs with self.lock held
+
+    def dispatch(self, worker_id, request):
+        op = request['op']
+        if op == 'claim':
+            username = request['username']
+            if username in self.users:
+                return False
+            self.users[username] = worker_id
+            self.tokens[username] = request['token']
+            self.publish({'event': 'joined', 'username': username})
+            return True
+        if op == 'release':
+            # A user whose session was taken over may already be claimed again elsewhere
+            if self.users.get(request['username']) == worker_id:
+                self.release(request['username'])
+            return True
+        if op == 'post':
+            group = request['group']
+            history = self.histories.get(group)
+            if history is None:
+                return None  # Deleted by another worker before this post arrived
+            message = Message(len(history) + 1, request['sender'], request['content'])
+            history.append(message)
+            self.appended(group, message)
+            self.publish({'event': 'post', 'group': group, 'message': message.to_dict()})
+            return message.id
+        if op == 'group_join':
+            group, username = request['group'], request['username']
+            if group not in self.group_members:
+                return False
+            self.group_members[group][username] = None
+            self.user_groups.setdefault(username, set()).add(group)
+            self.publish({'event': 'group_joined', 'group': group, 'username': username})
+            return True
+        if op == 'group_leave':
+            group, username = request['group'], request['username']
+            if group in self.group_members:
+                self.group_members[group].pop(username, None)
+            self.user_groups.get(username, set()).discard(group)
+            self.publish({'event': 'group_left', 'group': group, 'username': username})
+            return True
+        if op == 'group_create':
+            group = request['group']
+            if group in self.group_members or (self.max_groups and len(self.group_members) >= self.max_groups):
+                return False
+            self.histories[group] = self.open_history(group, request['owner'])
+            self.group_members[group] = {}
+            self.group_owners[group] = request['owner']
+            self.publish({'event': 'group_created', 'group': group, 'owner': request['owner']})
+            return True
+        if op == 'group_delete':
+            group = request['group']
+            if group not in self.group_members:
+                return False
+            for username in self.group_members.pop(group):
+                self.user_groups.get(username, set()).discard(group)
+            del self.group_owners[group]
+            self.drop_history(group, self.histories.pop(group))
+            self.publish({'event': 'group_deleted', 'group': group, 'username': request['username']})
+            return True
+        if op == 'session_save':
+            self.sessions[request['token']] = request['session']
+            if len(self.sessions) > 1024:
+                now = time.time()
+                for token in [t for t, session in self.sessions.items() if session['expires'] < now]:
+                    del self.sessions[token]
+            return True
+        if op == 'session_take':
+            # Any worker may receive the reconnect, so sessions live here
+            return self.sessions.pop(request['token'], None)
+        if op == 'session_drop':
+            # The user may still look connected on whichever worker they dropped from
+            username = next((name for name, token in self.tokens.items() if token == request['token']), None)
+            if username is None:
+                return False
+            groups = sorted(self.user_groups.get(username, ()))
+            self.sessions[request['token']] = {
+                'username': username,
+                'groups': groups,
+                'seen': {name: len(self.histories[name]) for name in ['', *groups]},
+                'expires': request['expires'],
+            }
+            self.publish({'event': 'dropped', 'username': username})
+            self.release(username)
+            return True
+        raise ValueError(f"Unknown event bus request: {op}")
+
+    def release(self, username):
+        if self.users.pop(username, None) is None:
+            return
+        self.tokens.pop(username, None)
+        for group in self.user_groups.pop(username, ()):
+            self.group_members[group].pop(username, None)
+        self.publish({'event': 'left', 'username': username})
+
+class BusClient:
+    """A worker's connection to the hub, plus replicas of the global user and group lists."""
+
+    def __init__(self, path, on_event):
+        self.on_event = on_event
+        self.sock = self._connect(path)
+        self.reader = self.sock.makefile('rb')
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.next_rid = 1
+        self.users = {}
+        self.group_members = {}
+        self.user_groups = {}
+
+    def _connect(self, path):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def start(self):
+        """Read the hub's snapshot, then follow its events. Returns the snapshot."""
+        snapshot = json.loads(self.reader.readline())['snapshot']
+        self.users = dict.fromkeys(snapshot['users'])
+        self.group_members = {name: dict.fromkeys(members)
+                              for name, members in snapshot['group_members'].items()}
+        for name, members in self.group_members.items():
+            for username in members:
+                self.user_groups.setdefault(username, set()).add(name)
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        return snapshot
+
+    def _read_loop(self):
+        try:
+            for line in self.reader:
+                message = json.loads(line)
+                if 'rid' in message:
+                    waiter = self.pending.pop(message['rid'])
+                    waiter[1] = message['result']
+                    waiter[0].set()
+                else:
+                    self._apply(message)
+                    self.on_event(message)
+        finally:
+            print("Lost connection to the event bus.")
+            for waiter in list(self.pending.values()):
+                waiter[0].set()
+
+    def _apply(self, event):
+        kind = event['event']
+        if kind == 'joined':
+            self.users[event['username']] = None
+        elif kind == 'left':
+            self.users.pop(event['username'], None)
+            for group in self.user_groups.pop(event['username'], ()):
+                self.group_members[group].pop(event['username'], None)
+        elif kind == 'group_joined':
+            self.group_members[event['group']][event['username']] = None
+            self.user_groups.setdefault(event['username'], set()).add(event['group'])
+        elif kind == 'group_left':
+            self.group_members[event['group']].pop(event['username'], None)
+            self.user_groups.get(event['username'], set()).discard(event['group'])
+        elif kind == 'group_created':
+            self.group_members[event['group']] = {}
+        elif kind == 'group_deleted':
+            for username in self.group_members.pop(event['group']):
+                self.user_groups.get(username, set()).discard(event['group'])
+
+    def call(self, op, **fields):
+        waiter = [threading.Event(), None]
+        with self.send_lock:
+            rid = self.next_rid
+            self.next_rid += 1
+            self.pending[rid] = waiter
+            send_json(self.sock, {'op': op, 'rid': rid, **fields})
+        waiter[0].wait()
+        if rid in self.pending:
+            del self.pending[rid]
+            raise ConnectionError("Event bus connection lost")
+        return waiter[1]
+
+    def claim(self, username, token):
+        return self.call('claim', username=username, token=token)
+
+    def release(self, username):
+        return self.call('release', username=username)
+
+    def post(self, group, sender, content):
+        return self.call('post', group=group or '', sender=sender, content=content)
+
+    def group_join(self, group, username):
+        return self.call('group_join', group=group, username=username)
+
+    def group_leave(self, group, username):
+        return self.call('group_leave', group=group, username=username)
+
+    def group_create(self, group, owner):
+        return self.call('group_create', group=group, owner=owner)
+
+    def group_delete(self, group, username):
+        return self.call('group_delete', group=group, username=username)
+
+    def session_save(self, token, session):
+        return self.call('session_save', token=token, session=session)
+
+    def session_take(self, token):
+        return self.call('session_take', token=token)
+
+    def session_drop(self, token, expires):
+        return self.call('session_drop', token=token, expires=expires)
+
+    def user_list(self):
+        return list(self.users)
+
+    def group_user_list(self, group):
+        return list(self.group_members.get(group, ()))
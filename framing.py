@@ -0,0 +1,143 @@
+import codecs
+import struct
+
+# Framing Configuration
+FRAMING_MODES = ('raw', 'line', 'length')
+DEFAULT_FRAMING = 'raw'
+MAX_FRAME_SIZE = 1024 * 1024
+
+LENGTH_HEADER = struct.Struct('!I')
+FRAME_COMMAND = '%frame'
+FRAME_ACK = "Framing set to {mode}.\n"
+
+class FrameError(ValueError):
+    pass
+
+class RawDecoder:
+    """Legacy mode: every read is one chunk of text. Split UTF-8 sequences carry over."""
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.chunks = []
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        if text:
+            self.chunks.append(text)
+
+    def next_frame(self):
+        return self.chunks.pop(0) if self.chunks else None
+
+    def take_remaining(self):
+        remaining = ''.join(self.chunks).encode()
+        self.chunks = []
+        return remaining
+
+class LineDecoder:
+    """Newline-delimited frames. Lines are split on bytes so multibyte characters stay whole."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0
+
+    def feed(self, data):
+        self.buffer += data
+        if len(self.buffer) - self.start > MAX_FRAME_SIZE and self.buffer.find(b'\n', self.start) == -1:
+            raise FrameError(f"Line longer than {MAX_FRAME_SIZE} bytes")
+
+    def next_frame(self):
+        end = self.buffer.find(b'\n', self.start)
+        if end == -1:
+            del self.buffer[:self.start]
+            self.start = 0
+            return None
+        line = self.buffer[self.start:end].rstrip(b'\r')
+        self.start = end + 1
+        return line.decode('utf-8', errors='replace')
+
+    def take_remaining(self):
+        remaining = bytes(self.buffer[self.start:])
+        self.buffer = bytearray()
+        self.start = 0
+        return remaining
+
+class LengthPrefixDecoder:
+    """Frames carrying a 4-byte big-endian length header followed by UTF-8 text."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        available = len(self.buffer) - self.start
+        if available >= LENGTH_HEADER.size:
+            (length,) = LENGTH_HEADER.unpack_from(self.buffer, self.start)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+            end = self.start + LENGTH_HEADER.size + length
+            if len(self.buffer) >= end:
+                payload = self.buffer[self.start + LENGTH_HEADER.size:end]
+                self.start = end
+                return payload.decode('utf-8', errors='replace')
+        del self.buffer[:self.start]
+        self.start = 0
+        return None
+
+    def take_remaining(self):
+        remaining = bytes(self.buffer[self.start:])
+        self.buffer = bytearray()
+        self.start = 0
+        return remaining
+
+def make_decoder(mode):
+    """Decoder for commands sent by a client."""
+    if mode == 'line':
+        return LineDecoder()
+    if mode == 'length':
+        return LengthPrefixDecoder()
+    return RawDecoder()
+
+def make_client_decoder(mode):
+    """Decoder for data sent by the server; only length mode frames the server's output."""
+    if mode == 'length':
+        return LengthPrefixDecoder()
+    return RawDecoder()
+
+def encode_frame(mode, data):
+    """Wrap bytes written by the server for a connection using the given mode."""
+    if mode == 'length':
+        return LENGTH_HEADER.pack(len(data)) + data
+    return data
+
+def frame_command(mode, command):
+    """Encode one client command for the given mode."""
+    data = command.encode()
+    if mode == 'line':
+        return data + b'\n'
+    if mode == 'length':
+        return LENGTH_HEADER.pack(len(data)) + data
+    return data
+
+def negotiate(sock, mode):
+    """Ask the server to switch framing.
+
+    Returns (text received before the switch, decoder primed with anything
+    received after it).
+    """
+    if mode == 'raw':
+        return '', make_client_decoder(mode)
+    sock.sendall(f"{FRAME_COMMAND} {mode}\n".encode())
+    ack = FRAME_ACK.format(mode=mode).encode()
+    received = b''
+    while ack not in received:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("Server closed the connection during framing negotiation")
+        received += data
+    before, _, after = received.partition(ack)
+    decoder = make_client_decoder(mode)
+    decoder.feed(after)
+    return before.decode('utf-8', errors='replace'), decoder
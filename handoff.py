@@ -0,0 +1,174 @@
+import json
+import os
+import select
+import socket
+import struct
+import threading
+
+# Handoff Configuration
+DRAIN_TIMEOUT = 2.0      # how long connections get to write out what is queued for them before the handoff
+TAKEOVER_TIMEOUT = 30.0  # how long the old process waits for the new one to be ready, and vice versa
+FDS_PER_MESSAGE = 250    # Linux passes at most 253 descriptors in one SCM_RIGHTS message
+
+# A new server.py started with --handoff PATH connects to the server already
+# listening there. The old server stops reading between commands, then sends:
+#   HEADER (state length, descriptor count), the JSON state, then the listening
+#   and client sockets, FDS_PER_MESSAGE at a time, each batch riding on one byte.
+# The new process loads the state and answers READY; the old one answers GO and
+# exits without touching the sockets again. Until GO neither side has served a
+# byte, so either one can still back out: the old server carries on if READY
+# never comes, and the new one exits if GO never does.
+HEADER = struct.Struct('!QI')
+READY = b"ready\n"
+GO = b"go\n"
+
+class ReadGate:
+    """Lets a handoff stop every threaded reader between commands.
+
+    Readers wait for their socket in enter() rather than blocking in recv(),
+    so stop() can wake all of them through one pipe. A reader already past
+    enter() finishes its read, and the commands in it, before stop() returns;
+    the others stay parked until resume(), or until the process exits.
+    """
+
+    def __init__(self):
+        self.wake_read, self.wake_write = os.pipe()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.busy = 0
+
+    def enter(self, sock=None):
+        """Waits until sock is readable (if given) and no handoff is under way. Pair with leave()."""
+        while True:
+            readable = True
+            if sock is not None:
+                poller = select.poll()
+                poller.register(sock, select.POLLIN)
+                poller.register(self.wake_read, select.POLLIN)
+                readable = any(fd == sock.fileno() for fd, _ in poller.poll())
+            with self.cond:
+                if not self.stopped and readable:
+                    self.busy += 1
+                    return
+                while self.stopped:
+                    self.cond.wait()
+
+    def leave(self):
+        with self.cond:
+            self.busy -= 1
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            os.write(self.wake_write, b'x')
+            while self.busy:
+                self.cond.wait()
+
+    def resume(self):
+        with self.cond:
+            os.read(self.wake_read, 1)
+            self.stopped = False
+            self.cond.notify_all()
+
+class OpenGate:
+    """The ReadGate stand-in when handoffs are off: readers block in recv() as usual."""
+
+    def enter(self, sock=None):
+        pass
+
+    def leave(self):
+        pass
+
+def listen(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    return listener
+
+def serve(listener, hand_off):
+    """Accepts takeover requests from new processes in the background; hand_off(channel) serves each."""
+    def accept_loop():
+        while True:
+            channel, _ = listener.accept()
+            hand_off(channel)
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+def send_state(channel, state, fds):
+    data = json.dumps(state, separators=(',', ':')).encode()
+    channel.sendall(HEADER.pack(len(data), len(fds)) + data)
+    for start in range(0, len(fds), FDS_PER_MESSAGE):
+        socket.send_fds(channel, [b'f'], fds[start:start + FDS_PER_MESSAGE])
+
+def wait_ready(channel):
+    """Old process: True once the new one has loaded the state and is ready to serve."""
+    channel.settimeout(TAKEOVER_TIMEOUT)
+    try:
+        return recv_exactly(channel, len(READY)) == READY
+    except (ConnectionError, OSError):
+        return False
+
+def confirm(channel):
+    channel.sendall(GO)
+
+def recv_exactly(channel, size):
+    # Never asks for more than is left, so a read can't run into the byte carrying descriptors
+    parts = []
+    while size:
+        data = channel.recv(min(size, 1 << 20))
+        if not data:
+            raise ConnectionError("old server closed the handoff channel")
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+class Takeover:
+    """New process side: the state and sockets inherited from the server being replaced."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        channel.settimeout(TAKEOVER_TIMEOUT)
+        length, fd_count = HEADER.unpack(recv_exactly(channel, HEADER.size))
+        self.state = json.loads(recv_exactly(channel, length))
+        self.fds = []
+        while len(self.fds) < fd_count:
+            data, fds, _, _ = socket.recv_fds(channel, 1, FDS_PER_MESSAGE)
+            if not data:
+                raise ConnectionError("old server closed the handoff channel")
+            self.fds.extend(fds)
+
+    def socket(self, index):
+        return socket.socket(fileno=self.fds[index])
+
+    def commit(self):
+        """Tells the old process we're ready and waits for it to let go. Exits if it backed out."""
+        try:
+            self.channel.sendall(READY)
+            if recv_exactly(self.channel, len(GO)) == GO:
+                return
+        except (ConnectionError, OSError):
+            pass
+        print("The old server kept its connections; exiting")
+        os._exit(1)
+
+    def wait_for_exit(self):
+        """Blocks until the old process has gone (its end of the channel closes with it)."""
+        self.channel.settimeout(None)
+        try:
+            while self.channel.recv(1):
+                pass
+        except OSError:
+            pass
+        self.channel.close()
+
+def request(path):
+    """Connects to the server taking handoffs at path. Returns a Takeover, or None if no server is there."""
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        channel.close()
+        return None
+    return Takeover(channel)
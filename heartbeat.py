@@ -0,0 +1,79 @@
+import re
+import socket
+import threading
+import time
+
+# Heartbeat Configuration
+HEARTBEAT_INTERVAL = 30.0  # ping a connection after this many quiet seconds; 0 disables pings
+IDLE_TIMEOUT = 90.0        # drop a connection after this many quiet seconds; 0 disables reaping
+SWEEP_INTERVAL = 5.0       # how often connections are checked
+KEEPALIVE_IDLE = 60        # TCP keepalive: seconds before the first probe; 0 disables keepalive
+KEEPALIVE_INTERVAL = 10    # seconds between probes
+KEEPALIVE_COUNT = 5        # unanswered probes before the kernel drops the connection
+
+# The server sends PING on its own line; clients answer with the PONG command.
+# Either side may also send %ping, which is answered with PONG.
+PING = "%ping\n"
+PING_COMMAND = '%ping'
+PONG_COMMAND = '%pong'
+PONG = "%pong\n"
+PING_LINE = re.compile(r"^%ping\n", re.MULTILINE)
+
+# Counters shared by every connection in the process
+stats = {
+    'pings_sent': 0,
+    'pongs_received': 0,
+    'reaped': 0,
+}
+stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+# Every open session, so the sweeper can find the quiet ones
+sessions = set()
+sessions_lock = threading.Lock()
+
+def track(session):
+    session.last_seen = session.last_ping = time.monotonic()
+    with sessions_lock:
+        sessions.add(session)
+
+def untrack(session):
+    with sessions_lock:
+        sessions.discard(session)
+
+def sweep(now=None):
+    """Returns (sessions to ping, sessions to drop) given how long each has been quiet."""
+    now = time.monotonic() if now is None else now
+    with sessions_lock:
+        current = list(sessions)
+    ping, reap = [], []
+    for session in current:
+        idle = now - session.last_seen
+        if IDLE_TIMEOUT and idle >= IDLE_TIMEOUT:
+            reap.append(session)
+        elif HEARTBEAT_INTERVAL and idle >= HEARTBEAT_INTERVAL and now - session.last_ping >= HEARTBEAT_INTERVAL:
+            session.last_ping = now
+            ping.append(session)
+    with sessions_lock:
+        sessions.difference_update(reap)  # dropped once; cleanup may take a moment
+    count('pings_sent', len(ping))
+    count('reaped', len(reap))
+    return ping, reap
+
+def enable_keepalive(sock):
+    """Lets the kernel notice peers that vanished without closing, even when nothing is being sent."""
+    if not KEEPALIVE_IDLE or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return  # a Unix socket peer can't vanish without the kernel knowing
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Not every platform exposes the tuning knobs; the system defaults apply there
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+def strip_pings(text):
+    """Client side: removes server pings from received text. Returns (text, number of pings)."""
+    return PING_LINE.subn('', text)
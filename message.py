@@ -0,0 +1,39 @@
+import sys
+import time
+from datetime import datetime
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class Message:
+    """One post on a board or group.
+
+    Slotted instead of a dict, with the sender interned so every message from
+    one user shares a single string and the date kept as integer epoch seconds.
+    The bytes sent to clients are built on first use and cached.
+    """
+
+    __slots__ = ('id', 'sender', 'timestamp', 'content', '_wire')
+
+    def __init__(self, id, sender, content, timestamp=None):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.content = content
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self._wire = None
+
+    def wire(self):
+        """The message as clients see it, encoded once."""
+        if self._wire is None:
+            self._wire = f"<{self.sender}> [{self.content}] <{self.id}>\n".encode()
+        return self._wire
+
+    def to_dict(self):
+        return {'id': self.id, 'sender': self.sender, 'ts': self.timestamp, 'content': self.content}
+
+    @classmethod
+    def from_dict(cls, data):
+        timestamp = data.get('ts')
+        if timestamp is None:
+            # Logs written before timestamps were integers store a formatted date
+            timestamp = int(datetime.strptime(data['date'], DATE_FORMAT).timestamp())
+        return cls(data['id'], data['sender'], data['content'], timestamp)
@@ -0,0 +1,249 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from message import Message
+
+# Message Log Configuration
+SEGMENT_MESSAGES = 65536
+FSYNC_POLICIES = ('always', 'batch', 'interval')
+FSYNC_POLICY = 'batch'
+FSYNC_BATCH_SIZE = 100
+FSYNC_INTERVAL = 1.0
+
+# Each index slot holds the end offset of a record in the segment's log file.
+# Records are never empty, so the first zero slot marks the end of the index.
+INDEX_ENTRY = struct.Struct('<Q')
+
+open_logs = []
+open_logs_lock = threading.Lock()
+interval_thread = None
+
+def encode_record(msg):
+    return (json.dumps(msg.to_dict(), ensure_ascii=False, separators=(',', ':')) + '\n').encode()
+
+def decode_record(data):
+    return Message.from_dict(json.loads(data))
+
+class Segment:
+    """One fixed-capacity slice of a log: an append-only .log and a memory-mapped .idx."""
+
+    def __init__(self, directory, base, capacity):
+        self.base = base
+        self.capacity = capacity
+        stem = os.path.join(directory, f"{base:020d}")
+        self.log_fd = os.open(stem + '.log', os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(stem + '.idx', os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.index_fd).st_size < capacity * INDEX_ENTRY.size:
+            os.ftruncate(self.index_fd, capacity * INDEX_ENTRY.size)
+        self.index = mmap.mmap(self.index_fd, capacity * INDEX_ENTRY.size)
+        self.count = self._recover()
+
+    def end_offset(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)[0]
+
+    def _recover(self):
+        # Binary search for the first empty slot instead of scanning the log
+        lo, hi = 0, self.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.end_offset(mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        count = lo
+        # Drop index entries whose records never reached the log, then any torn tail
+        log_size = os.fstat(self.log_fd).st_size
+        while count and self.end_offset(count - 1) > log_size:
+            count -= 1
+            INDEX_ENTRY.pack_into(self.index, count * INDEX_ENTRY.size, 0)
+        end = self.end_offset(count - 1) if count else 0
+        if log_size > end:
+            os.ftruncate(self.log_fd, end)
+        return count
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def append(self, record):
+        start = self.end_offset(self.count - 1) if self.count else 0
+        os.write(self.log_fd, record)
+        INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, start + len(record))
+        self.count += 1
+
+    def read(self, i):
+        start = self.end_offset(i - 1) if i else 0
+        end = self.end_offset(i)
+        return os.pread(self.log_fd, end - start, start)
+
+    def read_range(self, first, stop):
+        """Records first..stop-1 with a single pread, since they sit back to back in the log."""
+        start = self.end_offset(first - 1) if first else 0
+        end = self.end_offset(stop - 1)
+        return os.pread(self.log_fd, end - start, start).splitlines(keepends=True)
+
+    def sync(self):
+        os.fsync(self.log_fd)
+        self.index.flush()
+
+    def close(self):
+        self.index.close()
+        os.close(self.index_fd)
+        os.close(self.log_fd)
+
+class MessageLog:
+    """Segmented append-only message log for one board or group.
+
+    Behaves like the list it replaces: append(), len(), indexing and slicing,
+    with every lookup going through the index straight to disk. Expired
+    messages are dropped a whole segment at a time; their positions stay in
+    place (as None) so ids never move.
+    """
+
+    def __init__(self, directory, fsync_policy=None, segment_messages=None):
+        self.directory = directory
+        self.fsync_policy = fsync_policy or FSYNC_POLICY
+        if self.fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {self.fsync_policy}")
+        self.segment_messages = segment_messages or SEGMENT_MESSAGES
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.idx'))
+        # Segments dropped by retention before a restart leave None in their place
+        self.segments = [None] * (bases[0] // self.segment_messages if bases else 0)
+        self.segments += [Segment(directory, base, self.segment_messages) for base in bases]
+        if not bases:
+            self.segments.append(Segment(directory, 0, self.segment_messages))
+        self.length = self.segments[-1].base + self.segments[-1].count
+        self.expired = bases[0] if bases else 0
+        self.retired = []  # dropped segments, closed on the next drop so in-flight reads finish
+        with open_logs_lock:
+            open_logs.append(self)
+        if self.fsync_policy == 'interval':
+            start_interval_sync()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step == 1:
+                return self.read_range(start, stop)
+            return [self[i] for i in range(start, stop, step)]
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("message log index out of range")
+        segment = self.segments[key // self.segment_messages]
+        if segment is None or key < self.expired:
+            return None
+        return decode_record(segment.read(key - segment.base))
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def read_range(self, start, stop):
+        messages = []
+        if start < self.expired:
+            messages = [None] * (min(stop, self.expired) - start)
+            start = self.expired
+        while start < stop:
+            segment = self.segments[start // self.segment_messages]
+            if segment is None:  # dropped while we were reading
+                end = min(stop, (start // self.segment_messages + 1) * self.segment_messages)
+                messages.extend([None] * (end - start))
+            else:
+                end = min(stop, segment.base + segment.count)
+                messages.extend(decode_record(record)
+                                for record in segment.read_range(start - segment.base, end - segment.base))
+            start = end
+        return messages
+
+    def append(self, msg):
+        record = encode_record(msg)
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.is_full():
+                segment.sync()
+                segment = Segment(self.directory, segment.base + self.segment_messages,
+                                  self.segment_messages)
+                self.segments.append(segment)
+            segment.append(record)
+            self.length += 1
+            self.unsynced += 1
+            if self.fsync_policy == 'always' or (
+                    self.fsync_policy == 'batch' and self.unsynced >= FSYNC_BATCH_SIZE):
+                self._sync()
+
+    def _sync(self):
+        self.segments[-1].sync()
+        self.unsynced = 0
+
+    def drop_before(self, index):
+        """Expire every message before index, deleting the segments that only hold expired ones."""
+        with self.lock:
+            if index <= self.expired:
+                return
+            self.expired = index
+            for segment in self.retired:
+                segment.close()
+            self.retired = []
+            # The segment being appended to is never dropped
+            for i in range(len(self.segments) - 1):
+                segment = self.segments[i]
+                if segment is None:
+                    continue
+                if segment.base + segment.capacity > index:
+                    break
+                stem = os.path.join(self.directory, f"{segment.base:020d}")
+                os.unlink(stem + '.log')
+                os.unlink(stem + '.idx')
+                self.segments[i] = None
+                self.retired.append(segment)
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.segments:
+                self._sync()
+            for segment in self.segments + self.retired:
+                if segment is not None:
+                    segment.close()
+            self.segments = []
+            self.retired = []
+        with open_logs_lock:
+            if self in open_logs:
+                open_logs.remove(self)
+
+def start_interval_sync():
+    global interval_thread
+    with open_logs_lock:
+        if interval_thread is not None:
+            return
+        interval_thread = threading.Thread(target=interval_sync_loop, daemon=True)
+        interval_thread.start()
+
+def interval_sync_loop():
+    while True:
+        time.sleep(FSYNC_INTERVAL)
+        with open_logs_lock:
+            logs = list(open_logs)
+        for log in logs:
+            if log.fsync_policy == 'interval':
+                log.sync()
+
+def close_all():
+    with open_logs_lock:
+        logs = list(open_logs)
+    for log in logs:
+        log.close()
@@ -0,0 +1,195 @@
+import array
+import os
+import threading
+
+from message_log import decode_record, encode_record
+
+# Hot Window Configuration
+HOT_MESSAGES = 1000
+HOT_BYTES = 0  # 0 means only HOT_MESSAGES applies
+RING_START = 1024  # initial ring slots when only a byte budget bounds the window; doubled as needed
+
+class MessageList(list):
+    """In-memory history. Expired messages are replaced by None so ids never move."""
+
+    expired = 0  # index of the first message that hasn't expired
+
+    def drop_before(self, index):
+        if index <= self.expired:
+            return
+        first, self.expired = self.expired, index
+        for i in range(first, index):
+            self[i] = None
+
+class SpillFile:
+    """Append-only file of messages evicted from the hot window, indexed by position."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # The spill file only backs the in-memory history of this process
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+        self.offsets = array.array('Q', [0])
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, msg):
+        record = encode_record(msg)
+        with self.lock:
+            os.write(self.fd, record)
+            self.offsets.append(self.offsets[-1] + len(record))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+            data = os.pread(self.fd, self.offsets[stop] - self.offsets[start], self.offsets[start])
+            return [decode_record(record) for record in data.splitlines(keepends=True)]
+        start, end = self.offsets[key], self.offsets[key + 1]
+        return decode_record(os.pread(self.fd, end - start, start))
+
+    def close(self):
+        os.close(self.fd)
+        os.unlink(self.path)
+
+class HotColdStore:
+    """List-like history that keeps only the newest messages in memory.
+
+    Older messages live in `cold`, either a SpillFile that receives them as
+    they fall out of the window or a MessageLog that already holds every
+    message (write_through). Indexes never move, so message ids stay stable.
+    A SpillFile starts at index `expired`, the history's retention floor.
+    Given only max_bytes, the window holds as many messages as fit in it.
+    """
+
+    def __init__(self, cold, write_through=False, max_messages=None, max_bytes=None, expired=0):
+        self.cold = cold
+        self.write_through = write_through
+        self.max_bytes = max_bytes if max_bytes is not None else HOT_BYTES
+        # 0 leaves the count unbounded
+        self.max_messages = max_messages or (0 if self.max_bytes else HOT_MESSAGES)
+        # Ring buffer: absolute index i lives in slot i % capacity while hot
+        self.capacity = self.max_messages or RING_START
+        self.ring = [None] * self.capacity
+        self.sizes = array.array('L', [0]) * self.capacity
+        self.expired = cold.expired if write_through else expired
+        self.cold_base = 0 if write_through else expired
+        self.length = len(cold) if write_through else expired
+        self.hot_start = self.length
+        self.hot_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def append(self, msg):
+        size = len(encode_record(msg))
+        with self.lock:
+            if self.write_through:
+                self.cold.append(msg)
+            if self.length - self.hot_start == self.capacity:
+                if self.max_messages:
+                    self._evict()
+                else:
+                    self._grow()
+            slot = self.length % self.capacity
+            self.ring[slot] = msg
+            self.sizes[slot] = size
+            self.hot_bytes += size
+            self.length += 1
+            while self.max_bytes and self.hot_bytes > self.max_bytes and self.length - self.hot_start > 1:
+                self._evict()
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        ring = [None] * capacity
+        sizes = array.array('L', [0]) * capacity
+        for i in range(self.hot_start, self.length):
+            ring[i % capacity] = self.ring[i % self.capacity]
+            sizes[i % capacity] = self.sizes[i % self.capacity]
+        self.ring, self.sizes, self.capacity = ring, sizes, capacity
+
+    def _evict(self):
+        slot = self.hot_start % self.capacity
+        if not self.write_through:
+            self.cold.append(self.ring[slot])
+        self.ring[slot] = None
+        self.hot_bytes -= self.sizes[slot]
+        self.hot_start += 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self.read_range(start, stop)
+        with self.lock:
+            if key < 0:
+                key += self.length
+            if not 0 <= key < self.length:
+                raise IndexError("message store index out of range")
+            if key < self.expired:
+                return None
+            if key >= self.hot_start:
+                self.hits += 1
+                return self.ring[key % self.capacity]
+            self.misses += 1
+        return self.cold[key - self.cold_base]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def read_range(self, start, stop):
+        """Messages start..stop-1: one cold read for the part that left the window, then the ring."""
+        with self.lock:
+            expired = [None] * max(0, min(stop, self.expired) - start)
+            start += len(expired)
+            split = max(start, min(stop, self.hot_start))
+            hot = [self.ring[i % self.capacity] for i in range(split, stop)]
+            self.hits += len(hot)
+            self.misses += split - start
+        cold = self.cold[start - self.cold_base:split - self.cold_base] if split > start else []
+        return expired + cold + hot
+
+    def drop_before(self, index):
+        """Expires messages before index. A MessageLog frees their segments; a SpillFile keeps its bytes."""
+        with self.lock:
+            if index <= self.expired:
+                return
+            self.expired = index
+            # Expired messages still in the window give their memory back now
+            end = min(index, self.length)
+            for i in range(self.hot_start, end):
+                slot = i % self.capacity
+                self.ring[slot] = None
+                self.hot_bytes -= self.sizes[slot]
+                self.sizes[slot] = 0
+            if end > self.hot_start:
+                if not self.write_through:
+                    # All of the spill file is older still, so later evictions are lined up after it
+                    self.cold_base = end - len(self.cold)
+                self.hot_start = end
+        if self.write_through:
+            self.cold.drop_before(index)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hot_messages': self.length - self.hot_start,
+                'hot_bytes': self.hot_bytes,
+                'cold_messages': self.hot_start,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def close(self):
+        if isinstance(self.cold, SpillFile):
+            self.cold.close()
@@ -0,0 +1,167 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics Configuration
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[slot] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (None when empty or past the last bucket)."""
+        counts, count, _ = self.snapshot()
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return None
+
+class Family:
+    """A histogram per label value, created on first use."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, Histogram(self.buckets))
+        return child
+
+    def items(self):
+        with self.lock:
+            return sorted(self.children.items())
+
+command_latency = Family()
+lock_wait = Family()
+lock_hold = Family()
+fanout_size = Histogram(SIZE_BUCKETS)
+fanout_duration = Histogram()
+
+class InstrumentedLock:
+    """threading.Lock that records how long callers wait for it and how long they hold it."""
+
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.wait = lock_wait.labels(name)
+        self.hold = lock_hold.labels(name)
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.wait.observe(self.acquired_at - start)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.hold.observe(held)
+        return False
+
+def observe_command(command, seconds):
+    command_latency.labels(command).observe(seconds)
+
+def observe_fanout(recipients, seconds):
+    fanout_size.observe(recipients)
+    fanout_duration.observe(seconds)
+
+def format_histogram(lines, name, histogram, labels=''):
+    counts, count, total = histogram.snapshot()
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.buckets, counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {count}')
+    suffix = f'{{{labels.rstrip(",")}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {total}')
+    lines.append(f'{name}_count{suffix} {count}')
+
+def exposition(gauges, counters):
+    """Render every metric in Prometheus text format.
+
+    gauges and counters map a metric name to (help, value), where value is a
+    number or {'label': label_name, 'values': {label_value: number}}.
+    """
+    lines = []
+    families = (
+        ('bulletin_command_duration_seconds', "Time spent handling each command.", command_latency, 'command'),
+        ('bulletin_lock_wait_seconds', "Time spent waiting to acquire each lock.", lock_wait, 'lock'),
+        ('bulletin_lock_hold_seconds', "Time each lock was held.", lock_hold, 'lock'),
+    )
+    for name, help_text, family, label in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for value, histogram in family.items():
+            format_histogram(lines, name, histogram, f'{label}="{value}",')
+    for name, help_text, histogram in (
+            ('bulletin_fanout_recipients', "Recipients per broadcast.", fanout_size),
+            ('bulletin_fanout_duration_seconds', "Time spent enqueuing one broadcast.", fanout_duration)):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        format_histogram(lines, name, histogram)
+    for kind, metrics in (('gauge', gauges), ('counter', counters)):
+        for name, (help_text, value) in metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, dict):
+                label, values = value['label'], value['values']
+                for label_value, sample in values.items():
+                    lines.append(f'{name}{{{label}="{label_value}"}} {sample}')
+            else:
+                lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+def serve_http(host, port, render):
+    """Serve render() as text/plain on /metrics from a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return httpd
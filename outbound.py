@@ -0,0 +1,250 @@
+import collections
+import socket
+import threading
+import weakref
+
+import compression
+import framing
+
+# Outbound Configuration
+OUTBOUND_QUEUE_SIZE = 256
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'disconnect', 'coalesce')
+SLOW_CONSUMER_POLICY = 'drop_oldest'
+WRITER_CLOSE_TIMEOUT = 2.0
+IOV_MAX = 1024  # most buffers a single sendmsg() call may carry
+
+COALESCE_NOTICE = "[{count} messages skipped because you fell behind. Use %message to catch up.]\n"
+
+# Counters shared by every queue in the process
+stats = {
+    'enqueued': 0,
+    'dropped': 0,
+    'coalesced': 0,
+    'disconnected': 0,
+    'writes': 0,
+    'frames_written': 0,
+    'compressed_bytes_in': 0,
+    'compressed_bytes_out': 0,
+}
+stats_lock = threading.Lock()
+active_queues = weakref.WeakSet()
+
+def count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+def count_write(frames):
+    with stats_lock:
+        stats['writes'] += 1
+        stats['frames_written'] += frames
+
+def queue_depths():
+    """Returns (total, max) depth across every live outbound queue."""
+    depths = [len(q) for q in list(active_queues)]
+    return sum(depths), max(depths, default=0)
+
+class OutboundQueue:
+    """Bounded FIFO of pre-encoded frames waiting to be written to one client.
+
+    A Compressor in the queue marks where the client asked for compression:
+    frames after it are compressed as the writer takes them, so the deflate
+    stream only ever sees bytes that are really sent, in order.
+    """
+
+    def __init__(self, max_items=None, policy=None):
+        self.items = collections.deque()
+        self.max_items = max_items or OUTBOUND_QUEUE_SIZE
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        if self.policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {self.policy}")
+        self.cond = threading.Condition()
+        self.closed = False
+        self.overflowed = False
+        self.dropped = 0
+        self.compressor = None
+        self.writing = False  # the writer holds a batch it hasn't finished sending
+        active_queues.add(self)
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, data):
+        """Queue bytes for the writer. Returns False if the consumer must be disconnected."""
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.max_items and not self._overflow():
+                return False
+            self.items.append(data)
+            self.cond.notify()
+        count('enqueued')
+        return True
+
+    def start_compression(self, compressor):
+        """Compress everything queued after this point. Never dropped by the slow-consumer policy."""
+        with self.cond:
+            self.items.append(compressor)
+            self.cond.notify()
+
+    def _overflow(self):
+        if self.policy == 'disconnect':
+            self.dropped += len(self.items)
+            self.items.clear()
+            self.closed = True
+            self.overflowed = True
+            self.cond.notify_all()
+            count('disconnected')
+            return False
+        markers = [item for item in self.items if isinstance(item, compression.Compressor)]
+        if self.policy == 'coalesce':
+            skipped = len(self.items) - len(markers)
+            self.items.clear()
+            self.items.extend(markers)
+            self.items.append(COALESCE_NOTICE.format(count=skipped).encode())
+            self.dropped += skipped
+            count('dropped', skipped)
+            count('coalesced')
+        else:
+            if markers:
+                # The oldest frame goes, never the compression marker
+                self.items.remove(next(item for item in self.items
+                                       if not isinstance(item, compression.Compressor)))
+            else:
+                self.items.popleft()
+            self.dropped += 1
+            count('dropped')
+        return True
+
+    def pop_ready(self):
+        """Take everything currently queued without blocking."""
+        with self.cond:
+            batch = list(self.items)
+            self.items.clear()
+        return self._compress(batch)
+
+    def wait_batch(self):
+        """Block until frames are queued. Returns an empty list once closed and drained."""
+        while True:
+            with self.cond:
+                while not self.items and not self.closed:
+                    self.writing = False
+                    self.cond.wait()
+                batch = list(self.items)
+                self.items.clear()
+                self.writing = bool(batch)
+            out = self._compress(batch)
+            # A batch holding nothing but a compression marker has nothing to write yet
+            if out or not batch:
+                return out
+
+    def written(self):
+        with self.cond:
+            self.writing = False
+
+    def idle(self):
+        """True when everything queued has been handed to the socket."""
+        with self.cond:
+            return not self.items and not self.writing
+
+    def _compress(self, batch):
+        # Only the writer calls this, so the compressor is never shared between threads
+        out = []
+        pending = []
+        for item in batch:
+            if isinstance(item, compression.Compressor):
+                self._flush_compressed(pending, out)
+                self.compressor = item
+            elif self.compressor is not None:
+                pending.append(item)
+            else:
+                out.append(item)
+        self._flush_compressed(pending, out)
+        return out
+
+    def _flush_compressed(self, pending, out):
+        if not pending:
+            return
+        data = b''.join(pending)
+        wrapped = self.compressor.wrap(data)
+        out.append(wrapped)
+        pending.clear()
+        with stats_lock:
+            stats['compressed_bytes_in'] += len(data)
+            stats['compressed_bytes_out'] += len(wrapped)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class QueuedConnection:
+    """Wraps a blocking socket so sendall() only enqueues; a writer thread does the I/O."""
+
+    def __init__(self, sock, max_items=None, policy=None):
+        self.sock = sock
+        self.queue = OutboundQueue(max_items, policy)
+        self.framing = framing.DEFAULT_FRAMING
+        self.compressed = False
+        self.writer = threading.Thread(target=self._drain, daemon=True)
+        self.writer.start()
+
+    def sendall(self, data):
+        self.send_framed(framing.encode_frame(self.framing, data))
+
+    def send_framed(self, frame):
+        if not self.queue.put(frame):
+            if self.queue.overflowed:
+                self.shutdown()
+            raise ConnectionResetError("Outbound queue closed for slow consumer")
+
+    def start_compression(self, compressor):
+        self.queue.start_compression(compressor)
+
+    def shutdown(self):
+        # Unblocks both the writer and the reader so the normal leave/cleanup path runs
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def idle(self):
+        return self.queue.idle()
+
+    def _drain(self):
+        try:
+            while True:
+                batch = self.queue.wait_batch()
+                if not batch:
+                    break
+                self._send_batch(batch)
+                self.queue.written()
+        except (ConnectionError, socket.error):
+            self.queue.close()
+
+    def _send_batch(self, batch):
+        # Vectored write: every pending frame goes out in one sendmsg() where possible
+        start = 0
+        while start < len(batch):
+            buffers = batch[start:start + IOV_MAX]
+            sent = self.sock.sendmsg(buffers)
+            done = 0
+            for data in buffers:
+                if sent < len(data):
+                    batch[start] = memoryview(data)[sent:]
+                    break
+                sent -= len(data)
+                start += 1
+                done += 1
+            count_write(done)
+
+    def close(self):
+        self.queue.close()
+        if threading.current_thread() is not self.writer:
+            self.writer.join(WRITER_CLOSE_TIMEOUT)
+        self.sock.close()
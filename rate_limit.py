@@ -0,0 +1,155 @@
+import threading
+import time
+
+# Rate Limit Configuration
+# Each class of command gets (tokens per second, burst) per connection and per username.
+# A rate of 0 turns that limit off.
+RATE_LIMITS = {
+    'post': (5.0, 20),
+    'read': (20.0, 100),
+    'join': (1.0, 5),
+}
+MAX_CONNECTIONS = 0    # 0 means no limit
+LISTEN_BACKLOG = 4096
+PRUNE_INTERVAL = 60.0  # seconds between sweeps of idle per-username buckets
+
+COMMAND_CLASSES = {
+    '%post': 'post',
+    '%grouppost': 'post',
+    '%message': 'read',
+    '%messages': 'read',
+    '%since': 'read',
+    '%last': 'read',
+    '%groupmessage': 'read',
+    '%groupmessages': 'read',
+    '%groupsince': 'read',
+    '%grouplast': 'read',
+    '%search': 'read',
+    '%groupsearch': 'read',
+    '%users': 'read',
+    '%groups': 'read',
+    '%groupusers': 'read',
+    '%join': 'join',
+    '%resume': 'join',
+    '%groupjoin': 'join',
+    '%groupcreate': 'join',
+}
+
+THROTTLE_REPLY = "Slow down: too many {kind} commands. Try again in {wait:.1f}s.\n"
+SERVER_FULL_REPLY = "Server is full. Try again later.\n"
+
+# Counters shared by every connection in the process
+stats = {
+    'throttled_post': 0,
+    'throttled_read': 0,
+    'throttled_join': 0,
+    'connections_rejected': 0,
+}
+stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+class TokenBucket:
+    """Allows `rate` commands per second on average, and bursts of up to `burst`."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available; 0 if one is available now."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+def new_buckets():
+    return {kind: TokenBucket(rate, burst) for kind, (rate, burst) in RATE_LIMITS.items() if rate > 0}
+
+# Per-username buckets outlive connections, so reconnecting doesn't refill them
+user_buckets = {}  # username -> {kind: TokenBucket}
+user_buckets_lock = threading.Lock()
+last_prune = time.monotonic()
+
+def prune_user_buckets(now):
+    """Forgets usernames whose buckets have all refilled; they'd start full again anyway."""
+    global last_prune
+    last_prune = now
+    for username, buckets in list(user_buckets.items()):
+        if all(bucket.idle(now) for bucket in buckets.values()):
+            del user_buckets[username]
+
+class ConnectionLimiter:
+    """Token buckets for one connection, checked together with those of its username."""
+
+    def __init__(self):
+        self.buckets = new_buckets()
+
+    def check(self, command, username):
+        """Takes a token for command. Returns None if it may run, or the reply to send instead."""
+        kind = COMMAND_CLASSES.get(command)
+        own = self.buckets.get(kind)
+        if own is None:
+            return None
+        now = time.monotonic()
+        with user_buckets_lock:
+            if now - last_prune > PRUNE_INTERVAL:
+                prune_user_buckets(now)
+            shared = user_buckets.setdefault(username, new_buckets())[kind] if username else None
+            wait = max(own.wait_time(now), shared.wait_time(now) if shared else 0.0)
+            if wait:
+                count(f'throttled_{kind}')
+                return THROTTLE_REPLY.format(kind=kind, wait=wait)
+            own.tokens -= 1
+            if shared:
+                shared.tokens -= 1
+        return None
+
+class Admission:
+    """Counts open connections against MAX_CONNECTIONS."""
+
+    def __init__(self):
+        self.open = 0
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            if MAX_CONNECTIONS and self.open >= MAX_CONNECTIONS:
+                admitted = False
+            else:
+                self.open += 1
+                admitted = True
+        if not admitted:
+            count('connections_rejected')
+        return admitted
+
+    def inherit(self):
+        """Counts a connection taken over from the process this one replaced; never refused."""
+        with self.lock:
+            self.open += 1
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+admission = Admission()
+
+def parse_limit(value):
+    """Parses a --rate-limit value like post=5/20 into ('post', (5.0, 20))."""
+    kind, _, spec = value.partition('=')
+    if kind not in RATE_LIMITS:
+        raise ValueError(f"unknown command class {kind!r}; expected one of {', '.join(RATE_LIMITS)}")
+    rate, _, burst = spec.partition('/')
+    rate = float(rate)
+    return kind, (rate, int(burst) if burst else max(1, int(rate)))
@@ -0,0 +1,243 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from event_bus import send_json
+
+# Replication Configuration
+HEARTBEAT_INTERVAL = 1.0    # the primary writes at least this often, so lag stays measurable when idle
+FOLLOWER_TIMEOUT = 10.0     # a follower that hears nothing for this long reconnects
+QUEUE_SIZE = 100000         # events buffered per follower; one that falls further behind is dropped
+CONNECT_TIMEOUT = 10.0      # how long a follower keeps trying to reach the primary at startup
+RECONNECT_DELAY = 0.5       # doubled after every failed attempt, up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY_MAX = 30.0
+
+# A follower is fed the same events the hub publishes to sharded workers, minus
+# everything about users: those belong to whichever server they connected to.
+# Every line carries 'sent', the primary's clock when it was queued.
+REPLICATED_EVENTS = ('post', 'group_created', 'group_deleted', 'expired')
+HEARTBEAT = 'heartbeat'
+WRITE_COMMANDS = ('%post', '%grouppost', '%groupcreate', '%groupdelete')
+READ_ONLY_REPLY = "This server is a read-only replica; {command} only works on the primary.\n"
+
+# Counters shared by every follower connection in the process
+stats = {
+    'events_sent': 0,
+    'followers_dropped': 0,
+    'events_applied': 0,
+    'resyncs': 0,
+}
+stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+class ResyncNeeded(Exception):
+    """The follower missed events and has to start again from a fresh snapshot."""
+
+def parse_address(value):
+    """A --replication or --follow value: a Unix socket path if it has a '/', otherwise [host:]port."""
+    if '/' in value:
+        return value
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def format_address(address):
+    return address if isinstance(address, str) else f"{address[0]}:{address[1]}"
+
+def open_socket(address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+def snapshot(histories, group_owners):
+    """What a new follower starts from: each board's unexpired messages, its floor, and the groups."""
+    return {
+        'histories': {name: [message.to_dict() for message in history[history.expired:]]
+                      for name, history in histories.items()},
+        'expired': {name: history.expired for name, history in histories.items()},
+        'group_owners': dict(group_owners),
+    }
+
+class Follower:
+    __slots__ = ('sock', 'peer', 'queue')
+
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.peer = peer
+        self.queue = queue.Queue(QUEUE_SIZE)
+
+class Replicator:
+    """Primary side: sends each follower a snapshot, then every replicated event in order.
+
+    A follower is registered before its snapshot is taken, so nothing
+    published in between is lost; events the snapshot already includes are
+    skipped by the follower. publish() only queues, so a slow follower never
+    holds up a post; one that falls QUEUE_SIZE events behind is disconnected
+    and starts over from a new snapshot when it reconnects.
+    """
+
+    def __init__(self, address, take_snapshot, listener=None):
+        self.address = address
+        self.take_snapshot = take_snapshot
+        self.listener = listener or self.open_listener(address)
+        self.followers = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def open_listener(address):
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)
+        listener = open_socket(address)
+        if not isinstance(address, str):
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen()
+        return listener
+
+    def start(self):
+        print(f"Replication listening on {format_address(self.address)}")
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def accept_loop(self):
+        while True:
+            sock, peer = self.listener.accept()
+            threading.Thread(target=self.serve_follower, args=(Follower(sock, peer or 'unix socket'),),
+                             daemon=True).start()
+
+    def heartbeat_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            self._queue({'event': HEARTBEAT})
+
+    def publish(self, event):
+        if event['event'] in REPLICATED_EVENTS:
+            self._queue(event)
+
+    def _queue(self, event):
+        line = (json.dumps({**event, 'sent': time.time()}, separators=(',', ':')) + '\n').encode()
+        with self.lock:
+            for follower in list(self.followers):
+                try:
+                    follower.queue.put_nowait(line)
+                except queue.Full:
+                    print(f"Dropping follower {follower.peer}: {QUEUE_SIZE} events behind")
+                    count('followers_dropped')
+                    self.followers.discard(follower)
+                    # Its sender still has a full queue to work through; the next write fails
+                    try:
+                        follower.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+    def serve_follower(self, follower):
+        with self.lock:
+            self.followers.add(follower)
+        print(f"Follower connected from {follower.peer}")
+        try:
+            send_json(follower.sock, {'snapshot': self.take_snapshot(), 'sent': time.time()})
+            while True:
+                batch = [follower.queue.get()]
+                # Whatever else is already waiting goes out in the same write
+                while len(batch) < 1000:
+                    try:
+                        batch.append(follower.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                follower.sock.sendall(b''.join(batch))
+                count('events_sent', len(batch))
+        except (ConnectionError, socket.error) as e:
+            print(f"Replication error with follower {follower.peer}: {e}")
+        finally:
+            with self.lock:
+                self.followers.discard(follower)
+            follower.sock.close()
+            print(f"Follower {follower.peer} disconnected")
+
+class ReplicaClient:
+    """Follower side: applies the primary's snapshot and events, reconnecting when the stream stops.
+
+    apply_snapshot(snapshot) runs for the first snapshot and again after
+    every reconnect; apply_event(event) for each event in between, and may
+    raise ResyncNeeded to force a reconnect.
+    """
+
+    def __init__(self, address, apply_snapshot, apply_event):
+        self.address = address
+        self.apply_snapshot = apply_snapshot
+        self.apply_event = apply_event
+        self.connected = False
+        self.lag = None         # seconds between the primary queueing the last line and it being applied
+        self.last_heard = None  # time.monotonic() when the last line arrived
+
+    def start(self):
+        """Connect and apply the first snapshot (retrying for CONNECT_TIMEOUT), then follow in the background."""
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                reader = self._connect()
+                break
+            except (ConnectionError, FileNotFoundError, socket.error):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        threading.Thread(target=self.run, args=(reader,), daemon=True).start()
+
+    def _connect(self):
+        sock = open_socket(self.address)
+        try:
+            sock.settimeout(FOLLOWER_TIMEOUT)
+            sock.connect(self.address)
+            reader = sock.makefile('rb')
+            line = reader.readline()
+            if not line:
+                raise ConnectionError("primary closed the connection before sending a snapshot")
+            message = json.loads(line)
+            self._heard(message)
+            self.apply_snapshot(message['snapshot'])
+        except BaseException:
+            sock.close()
+            raise
+        self.connected = True
+        print(f"Following {format_address(self.address)}")
+        return reader
+
+    def _heard(self, message):
+        self.last_heard = time.monotonic()
+        self.lag = max(0.0, time.time() - message['sent'])
+
+    def run(self, reader):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                for line in reader:
+                    message = json.loads(line)
+                    if message['event'] != HEARTBEAT:
+                        self.apply_event(message)
+                        count('events_applied')
+                    self._heard(message)
+                error = "primary closed the connection"
+            except (ConnectionError, socket.error, ValueError, ResyncNeeded) as e:
+                error = e
+            reader.close()
+            self.connected = False
+            print(f"Lost replication stream from {format_address(self.address)}: {error}")
+            while True:
+                time.sleep(delay)
+                try:
+                    reader = self._connect()
+                    count('resyncs')
+                    delay = RECONNECT_DELAY
+                    break
+                except (ConnectionError, FileNotFoundError, socket.error, ValueError) as e:
+                    print(f"Could not reconnect to the primary: {e}")
+                    delay = min(delay * 2, RECONNECT_DELAY_MAX)
@@ -0,0 +1,194 @@
+import collections
+import heapq
+import threading
+import time
+
+# Retention Configuration
+# How much history each board keeps. 0 means no limit; a board with no limit
+# at all is never looked at.
+EXPIRY_INTERVAL = 1.0  # a board is pruned at most this often, so expiry happens in batches
+EXPIRE_CHUNK = 1000    # messages read per slice while looking for the new floor
+INDEX_PRUNE_MIN = 1000 # expired messages to accumulate before the search index is trimmed
+
+EXPIRED_REPLY = "Message {id} has expired.\n"
+PUBLIC = 'public'  # how --retention names the public board
+
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+Policy = collections.namedtuple('Policy', 'max_age max_count max_bytes')
+NO_LIMIT = Policy(0, 0, 0)
+
+# Counters shared by every board in the process
+stats = {
+    'expired': 0,
+    'expiry_runs': 0,
+}
+stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+def parse_amount(text, units):
+    suffix = text[-1:].lower()
+    if suffix in units:
+        return float(text[:-1]) * units[suffix]
+    return float(text)
+
+def parse_policy(value):
+    """Parses a --retention value like Group1:age=7d,count=10000,bytes=50M into ('Group1', Policy).
+
+    Without a board name the policy is the default for every board; 'public'
+    names the public board. Limits left out are off.
+    """
+    board, _, spec = value.rpartition(':')
+    limits = {}
+    for part in spec.split(','):
+        name, _, amount = part.partition('=')
+        if name == 'age':
+            limits['max_age'] = parse_amount(amount, AGE_UNITS)
+        elif name == 'count':
+            limits['max_count'] = int(amount)
+        elif name == 'bytes':
+            limits['max_bytes'] = int(parse_amount(amount, SIZE_UNITS))
+        else:
+            raise ValueError(f"unknown retention limit {name!r}; expected age, count or bytes")
+    return board, NO_LIMIT._replace(**limits)
+
+class Expirer:
+    """Drops messages that fall outside their board's retention policy, off the request path.
+
+    Boards are kept in a heap ordered by when they next need pruning: the
+    moment their oldest message reaches its age limit, or straight away (but
+    no sooner than EXPIRY_INTERVAL after the last run) once a count or byte
+    limit is exceeded. appended() only updates counters and, when a deadline
+    moves earlier, pushes one heap entry. A run reads forward from the current
+    floor, so it only ever touches the messages it expires.
+
+    Boards are named as on the event bus: '' for the public board, otherwise
+    the group name. history_for(name) returns a board's history, or None once
+    the group is gone; apply(name, index) drops everything before index.
+    """
+
+    def __init__(self, policies, history_for, apply):
+        self.default = policies.get('', NO_LIMIT)
+        self.policies = {('' if board == PUBLIC else board): policy
+                         for board, policy in policies.items() if board}
+        self.history_for = history_for
+        self.apply = apply
+        self.heap = []         # (due time, board)
+        self.due = {}          # board -> due time of its live heap entry; older entries are skipped
+        self.last_run = {}     # board -> when it was last pruned
+        self.live_bytes = {}   # board -> bytes of unexpired messages, for boards with a byte limit
+        self.condition = threading.Condition()
+        self.running = threading.Lock()  # held for each run; pause() holds it to keep runs out
+
+    def policy(self, name):
+        return self.policies.get(name, self.default)
+
+    def enabled(self):
+        return any(self.default) or any(any(policy) for policy in self.policies.values())
+
+    def start(self, names):
+        """Schedules every existing board for a first run, then starts the expiry thread."""
+        for name in names:
+            self.schedule(name, time.time())
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, name, due):
+        with self.condition:
+            if not any(self.policy(name)):
+                return
+            current = self.due.get(name)
+            if current is not None and current <= due:
+                return
+            self.due[name] = due
+            heapq.heappush(self.heap, (due, name))
+            self.condition.notify()
+
+    def appended(self, name, message):
+        """Called after every post; cheap enough for the request path."""
+        policy = self.policy(name)
+        if not any(policy):
+            return
+        history = self.history_for(name)
+        if history is None:
+            return
+        with self.condition:
+            if name in self.live_bytes:
+                self.live_bytes[name] += len(message.wire())
+            over = ((policy.max_count and len(history) - history.expired > policy.max_count)
+                    or (policy.max_bytes and self.live_bytes.get(name, 0) > policy.max_bytes))
+            last_run = self.last_run.get(name, 0.0)
+        # Only a post that exceeds a limit, or the first one after the board was emptied,
+        # can bring the next run forward; for any other schedule() returns at once
+        due = time.time() if over else (message.timestamp + policy.max_age if policy.max_age else None)
+        if due is not None:
+            self.schedule(name, max(due, last_run + EXPIRY_INTERVAL))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                due, name = heapq.heappop(self.heap)
+                if self.due.get(name) != due:
+                    continue
+                del self.due[name]
+            try:
+                with self.running:
+                    self.expire(name)
+            except Exception as e:
+                print(f"Error expiring messages in {name or 'the public board'}: {e}")
+
+    def pause(self):
+        """Waits for a run in progress, then keeps the histories untouched until resume()."""
+        self.running.acquire()
+
+    def resume(self):
+        self.running.release()
+
+    def expire(self, name):
+        history = self.history_for(name)
+        policy = self.policy(name)
+        if history is None:
+            with self.condition:
+                self.last_run.pop(name, None)
+                self.live_bytes.pop(name, None)
+            return
+        now = time.time()
+        with self.condition:
+            length = len(history)
+            live = self.live_bytes.get(name)
+            if policy.max_bytes and live is None:
+                self.live_bytes[name] = 0  # appended() counts posts from here on
+        first = history.expired
+        counted = 0
+        if policy.max_bytes and live is None:
+            # First run for this board: one pass to learn its size
+            live = counted = sum(len(message.wire()) for start in range(first, length, EXPIRE_CHUNK)
+                                 for message in history[start:min(length, start + EXPIRE_CHUNK)])
+        cutoff = now - policy.max_age
+        dropped = 0
+        oldest = None
+        while first < length and oldest is None:
+            for message in history[first:min(length, first + EXPIRE_CHUNK)]:
+                if not ((policy.max_count and length - first > policy.max_count)
+                        or (policy.max_bytes and live - dropped > policy.max_bytes)
+                        or (policy.max_age and message.timestamp <= cutoff)):
+                    oldest = message
+                    break
+                dropped += len(message.wire())
+                first += 1
+        expired = first - history.expired
+        if expired:
+            self.apply(name, first)
+            count('expired', expired)
+        count('expiry_runs')
+        with self.condition:
+            self.last_run[name] = now
+            if policy.max_bytes:
+                self.live_bytes[name] += counted - dropped
+        if oldest is not None and policy.max_age:
+            self.schedule(name, max(oldest.timestamp + policy.max_age, now + EXPIRY_INTERVAL))
@@ -0,0 +1,150 @@
+import array
+import bisect
+import collections
+import heapq
+import math
+import re
+import threading
+
+# Search Index Configuration
+MAX_PREFIX_TERMS = 200   # a prefix query expands to at most this many terms
+REBUILD_CHUNK = 10000    # messages read per slice when indexing existing history
+PRUNE_CHUNK = 1000       # terms trimmed per lock hold when expired messages are dropped
+
+TOKEN = re.compile(r"\w+")
+QUERY_TOKEN = re.compile(r"\w+\*?")
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+class SearchIndex:
+    """Inverted index over the content and sender of one board's or group's messages.
+
+    Each term maps to parallel arrays of message ids (ascending, since messages
+    are added in id order) and how often the term occurs in that message.
+
+    An index created with building=True is still catching up on existing
+    history: add() holds new messages back until finish(), so ids still
+    arrive in order, and searches should wait for it.
+    """
+
+    def __init__(self, building=False):
+        self.postings = {}  # term -> (array of ids, array of counts)
+        self.terms = []     # every term, sorted, for prefix queries
+        self.documents = 0
+        self.first_id = 1   # ids below this have expired and been dropped
+        self.building = building
+        self.deferred = []  # messages added while building
+        self.lock = threading.Lock()
+
+    def add(self, message):
+        with self.lock:
+            if self.building:
+                self.deferred.append(message)
+                return
+        self._index(message)
+
+    def _index(self, message):
+        counts = collections.Counter(tokenize(message.content))
+        counts.update(tokenize(message.sender))
+        with self.lock:
+            self.documents += 1
+            for term, count in counts.items():
+                entry = self.postings.get(term)
+                if entry is None:
+                    entry = self.postings[term] = (array.array('I'), array.array('H'))
+                    bisect.insort(self.terms, term)
+                entry[0].append(message.id)
+                entry[1].append(min(count, 0xFFFF))
+
+    def add_all(self, history, end=None):
+        """Indexes history up to end (all of it by default), a slice at a time."""
+        end = len(history) if end is None else end
+        self.first_id = history.expired + 1
+        for start in range(history.expired, end, REBUILD_CHUNK):
+            for message in history[start:min(start + REBUILD_CHUNK, end)]:
+                if message is not None:
+                    self._index(message)
+
+    def finish(self):
+        """Indexes the messages add() held back while building, then takes new ones directly."""
+        while True:
+            with self.lock:
+                if not self.deferred:
+                    self.building = False
+                    return
+                batch, self.deferred = self.deferred, []
+            for message in batch:
+                self._index(message)
+
+    def drop_before(self, first_id):
+        """Forgets messages with ids below first_id, a chunk of terms at a time so adds aren't held up."""
+        with self.lock:
+            if first_id <= self.first_id:
+                return
+            self.documents = max(0, self.documents - (first_id - self.first_id))
+            self.first_id = first_id
+            terms = list(self.postings)
+        for start in range(0, len(terms), PRUNE_CHUNK):
+            with self.lock:
+                for term in terms[start:start + PRUNE_CHUNK]:
+                    entry = self.postings.get(term)
+                    if entry is None:
+                        continue
+                    k = bisect.bisect_left(entry[0], first_id)
+                    if k == len(entry[0]):
+                        del self.postings[term]
+                    elif k:
+                        del entry[0][:k]
+                        del entry[1][:k]
+        with self.lock:
+            self.terms = sorted(self.postings)
+
+    def _expand(self, word):
+        if not word.endswith('*'):
+            entry = self.postings.get(word)
+            return [entry] if entry else []
+        prefix = word[:-1]
+        entries = []
+        i = bisect.bisect_left(self.terms, prefix)
+        while i < len(self.terms) and self.terms[i].startswith(prefix) and len(entries) < MAX_PREFIX_TERMS:
+            entries.append(self.postings[self.terms[i]])
+            i += 1
+        return entries
+
+    def search(self, query, limit, first_id=1):
+        """Ids of the best `limit` messages matching every query word, and how many matched in all.
+
+        A word ending in * matches any term with that prefix. Messages are
+        ranked by summed tf-idf of the query words, newest first on ties.
+        Ids below first_id (expired, but maybe not yet dropped) are left out.
+        """
+        words = QUERY_TOKEN.findall(query.lower())
+        if not words:
+            return [], 0
+        with self.lock:
+            expanded = [self._expand(word) for word in words]
+            if not all(expanded):
+                return [], 0
+            # Start from the rarest word so every later step only checks a few candidates
+            expanded.sort(key=lambda entries: sum(len(ids) for ids, _ in entries))
+            weights = [math.log(1 + self.documents / sum(len(ids) for ids, _ in entries))
+                       for entries in expanded]
+            scores = {}
+            for ids, counts in expanded[0]:
+                k = bisect.bisect_left(ids, first_id)
+                for message_id, count in zip(ids[k:], counts[k:]):
+                    scores[message_id] = scores.get(message_id, 0.0) + weights[0] * count
+            for entries, weight in zip(expanded[1:], weights[1:]):
+                matched = {}
+                for message_id, score in scores.items():
+                    hits = 0
+                    for ids, counts in entries:
+                        k = bisect.bisect_left(ids, message_id)
+                        if k < len(ids) and ids[k] == message_id:
+                            hits += counts[k]
+                    if hits:
+                        matched[message_id] = score + weight * hits
+                scores = matched
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return [message_id for message_id, _ in best], len(scores)
@@ -1,62 +1,371 @@
+import argparse
+import asyncio
+import base64
+import heapq
+import multiprocessing
+import os
+import re
+import secrets
+import shutil
 import socket
+import tempfile
 import threading
-from datetime import datetime
+import time
+
+import compression
+import event_bus
+import framing
+import handoff
+import heartbeat
+import message_log
+import message_store
+import metrics
+from message import Message
+import outbound
+import rate_limit
+import replication
+import retention
+import search_index
 
 # Server Configuration
 HOST = '0.0.0.0'
 PORT = 12345
+ENGINES = ('threaded', 'asyncio')
+UNIX_PATH = None  # also listen on this Unix socket, for clients on the same host
 
 # Global Data Structures
+# Group Configuration
+DEFAULT_GROUPS = tuple(f"Group{i}" for i in range(1, 6))
+MAX_GROUPS = 100000
+GROUPS_PAGE_SIZE = 100
+# Group names double as directory names under --data-dir
+GROUP_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+GROUP_OWNER_FILE = 'owner'  # the creator's username, next to a created group's segments
+
 clients = {}
-groups = {f"Group{i}": {'members': {}, 'messages': []} for i in range(1, 6)}
-public_messages = []
+session_tokens = {}  # username -> resume token of each connected user, under clients_lock
+sessions = {}        # resume token -> what a disconnected user had (single-process mode)
+# Groups created at runtime have an owner; the defaults have none and only admins can delete them
+groups = {name: {'members': {}, 'messages': message_store.MessageList(), 'lock': metrics.InstrumentedLock('group'),
+                 'index': search_index.SearchIndex(), 'owner': None, 'deleted': False}
+          for name in DEFAULT_GROUPS}
+# Reverse membership index, so leaving only touches the groups a user is actually in
+user_groups = {}  # username -> set of group names
+# Names whose storage is being opened or dropped outside groups_lock; no other group may take them meanwhile
+reserved_group_names = set()
+public_messages = message_store.MessageList()
+public_index = search_index.SearchIndex()
+
+# Locks for thread safety, partitioned so traffic on one board never waits on another.
+# Never hold more than one of these at a time.
+clients_lock = metrics.InstrumentedLock('clients')  # the clients registry
+public_lock = metrics.InstrumentedLock('public')    # public board id allocation and appends
+groups_lock = metrics.InstrumentedLock('groups')    # adding/removing groups, and user_groups
+# Each group carries its own lock for its members and message appends.
+# History reads take no lock: message lists only ever grow, so a length check
+# followed by an index lookup sees a consistent message, or None once it has expired.
+
+# Set in sharded worker processes: the connection to the hub that owns usernames,
+# group membership and message ids (see event_bus.py). None in single-process mode.
+bus = None
+# Commands whose handlers wait for a reply from the hub in sharded mode
+HUB_COMMANDS = ('%join', '%resume', '%post', '%grouppost', '%groupjoin', '%groupleave',
+                '%groupcreate', '%groupdelete')
+# How bus events reach the engine's thread; the asyncio engine swaps in call_soon_threadsafe
+run_in_engine = lambda fn, *args: fn(*args)
+
+# Where new group histories go; set once storage is opened
+DATA_DIR = None
+HOT_WINDOW = None  # (max_messages, max_bytes, spill_dir) when hot stores are enabled
+
+# Retention policies from --retention, by board ('' is the default for every board)
+RETENTION = {}
+# Runs them in the process that owns the histories; None when there are none (see retention.py)
+expirer = None
+
+# Streams every post, group change and expiry to read replicas; None without --replication
+replicator = None
+# In a read replica (--follow), the stream from the primary it applies; None otherwise
+follower = None
+
+# Zero-downtime restarts (--handoff, see handoff.py)
+HANDOFF_PATH = None
+METRICS_ADDRESS = None           # (host, port) of the metrics endpoint, started late after a takeover
+read_gate = handoff.OpenGate()   # a ReadGate when handoffs are on and the engine is threaded
+handing_off = threading.Event()  # set while connections are frozen for a handoff
+takeover = None                  # the handoff.Takeover this process started from, if any
+listeners = {}                   # 'tcp', 'unix', 'replication', 'handoff' -> listening socket to pass on
+async_loop = None                # the asyncio engine's loop, and the servers accepting on its listeners
+async_servers = {}
 
-# Lock for thread safety
-lock = threading.Lock()
+# Users allowed to run %stats; when empty anyone may
+ADMIN_USERS = set()
+
+# Range and cursor replies stop at whichever page limit is reached first
+HISTORY_PAGE_SIZE = 100
+HISTORY_PAGE_BYTES = 256 * 1024
+SEARCH_PAGE_SIZE = 10
+
+# Public board messages shown to a user when they join
+JOIN_HISTORY = 2
+
+# A dropped client can %resume within this many seconds of disconnecting
+SESSION_TTL = 300
+RESUME_MAX_MESSAGES = 1000  # per board or group; the rest is left to a cursor
 
 GROUP_ACCESS_ERROR = "You are not a member of this group or the group does not exist.\n"
 
 def broadcast(message, exclude_client=None):
-    with lock:
-        for client in clients.values():
-            if client != exclude_client:
-                try:
-                    client.sendall(message.encode())
-                except (ConnectionError, socket.error) as e:
-                    print(f"Connection error during broadcast: {e}")
+    with clients_lock:
+        recipients = [client for client in clients.values() if client != exclude_client]
+    fan_out(message if isinstance(message, bytes) else message.encode(), recipients)
+
+def fan_out(data, recipients):
+    # Only enqueues, so a stalled recipient can't hold up the sender or the lock.
+    # Each framing mode's bytes are built once and shared by every recipient using it.
+    start = time.perf_counter()
+    frames = {}
+    for client in recipients:
+        frame = frames.get(client.framing)
+        if frame is None:
+            frame = frames[client.framing] = framing.encode_frame(client.framing, data)
+        try:
+            client.send_framed(frame)
+        except (ConnectionError, socket.error) as e:
+            print(f"Connection error during broadcast: {e}")
+    metrics.observe_fanout(len(recipients), time.perf_counter() - start)
 
 def format_message(msg):
-    return f"<{msg['sender']}> [{msg['content']}] <{msg['id']}>\n"
+    return msg.wire().decode()
+
+class JoinSnapshot:
+    """The part of the join reply every user gets: recent public messages and the user list.
+
+    Each part is rendered once and shared by every join until a post (history)
+    or a leave (users) discards it; a join only appends its own line to the
+    cached user list. A part rendered while another thread changed it is sent
+    but not kept, since it may already be stale.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.history = None
+        self.users = None
+        self.history_version = 0
+        self.users_version = 0
+
+    def get(self):
+        with self.lock:
+            history, history_version = self.history, self.history_version
+            users, users_version = self.users, self.users_version
+        if history is None:
+            history = render_join_history()
+            with self.lock:
+                if self.history_version == history_version:
+                    self.history = history
+        if users is None:
+            users = render_join_users()
+            with self.lock:
+                if self.users_version == users_version:
+                    self.users = users
+        return history + users
+
+    def posted(self):
+        with self.lock:
+            self.history = None
+            self.history_version += 1
+
+    def joined(self, username):
+        with self.lock:
+            if self.users is not None:
+                self.users += f"- {username}\n".encode()
+            self.users_version += 1
+
+    def left(self):
+        with self.lock:
+            self.users = None
+            self.users_version += 1
+
+    def reset(self):
+        self.posted()
+        self.left()
+
+join_snapshot = JoinSnapshot()
+
+def render_join_history():
+    if not JOIN_HISTORY:
+        return b''
+    last_messages = [message for message in public_messages[-JOIN_HISTORY:] if message is not None]
+    if not last_messages:
+        return b"No messages on the public board yet.\n"
+    if JOIN_HISTORY == 2:
+        # What clients have always been sent, and what compression's preset dictionary expects
+        header = b"Last two messages on the public board:\n"
+    else:
+        plural = 's' if len(last_messages) != 1 else ''
+        header = f"Last {len(last_messages)} message{plural} on the public board:\n".encode()
+    return header + b''.join(message.wire() for message in last_messages)
+
+def render_join_users():
+    if bus is not None:
+        users = bus.user_list()
+    else:
+        with clients_lock:
+            users = list(clients)
+    return ("Current users on the public board:\n" + ''.join(f"- {user}\n" for user in users)).encode()
+
+class ClientSession:
+    """Per-connection protocol state shared by the threaded and asyncio engines."""
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.username = None
+        self.current_location = 'Not Joined'
+        self.limiter = rate_limit.ConnectionLimiter()
+        self.set_framing(framing.DEFAULT_FRAMING)
+        heartbeat.track(self)
+
+    def set_framing(self, mode):
+        self.framing = mode
+        self.conn.framing = mode
+        self.decoder = framing.make_decoder(mode)
+
+    def prompt(self):
+        self.conn.sendall(self.prompt_bytes())
+
+    def prompt_bytes(self):
+        return f"\n[{self.current_location}]> ".encode()
+
+    def feed(self, data):
+        """Consume bytes read from the client, running every complete command.
+
+        Returns False once the session should end.
+        """
+        self.receive(data)
+        while True:
+            command = self.decoder.next_frame()
+            if command is None:
+                return True
+            if not self.run_command(command):
+                return False
 
-def handle_client(conn, addr):
+    def receive(self, data):
+        self.last_seen = time.monotonic()
+        self.decoder.feed(data)
+
+    def run_command(self, command):
+        """Runs one complete command. Returns False once the session should end."""
+        keyword = command.strip()
+        if keyword == heartbeat.PONG_COMMAND:
+            heartbeat.count('pongs_received')
+            return True
+        if keyword == heartbeat.PING_COMMAND:
+            self.conn.sendall(heartbeat.PONG.encode())
+            return True
+        if command.startswith(framing.FRAME_COMMAND):
+            self.switch_framing(command)
+            self.prompt()
+            return True
+        response = self.handle_data(command)
+        if response is None:
+            return False
+        # A reply and its prompt go out as one write, so a broadcast can never land
+        # between them and clients can tell every reply from the traffic around it
+        self.conn.sendall(response + self.prompt_bytes())
+        return True
+
+    def switch_framing(self, command):
+        # In raw mode the rest of the read may already belong to the new framing
+        line, _, rest = command.partition('\n')
+        args = line.split()
+        if len(args) != 2 or args[1] not in framing.FRAMING_MODES:
+            self.conn.sendall(f"Usage: %frame [{'|'.join(framing.FRAMING_MODES)}]\n".encode())
+            return
+        pending = rest.encode() + self.decoder.take_remaining()
+        # The acknowledgement is the last thing written in the old framing
+        self.conn.sendall(framing.FRAME_ACK.format(mode=args[1]).encode())
+        self.set_framing(args[1])
+        self.decoder.feed(pending)
+
+    def handle_data(self, data):
+        """Run one command from the client.
+
+        Returns the reply to send with the prompt, or None once the session should end.
+        """
+        args = data.split(None, 2)
+        if args:
+            # Until a join succeeds only this connection is charged: a name nobody has claimed
+            # yet isn't this client's, and charging it would let anyone lock its owner out
+            throttled = self.limiter.check(args[0], self.username)
+            if throttled:
+                return throttled.encode()
+        response, self.username = process_command(data, self.username, self.conn)
+        if response == "EXIT":
+            self.conn.sendall("Goodbye!\n".encode())
+            return None
+        if self.username and self.current_location != 'Public Board':
+            self.current_location = 'Public Board'
+        # Handlers that send stored messages return their cached bytes as they are
+        if isinstance(response, bytes):
+            return response
+        return response.encode() if response else b''
+
+    def cleanup(self):
+        heartbeat.untrack(self)
+        cleanup_client(self.username, self.conn)
+
+def cleanup_client(username, conn):
+    with clients_lock:
+        if username and clients.get(username) is not conn:
+            return  # Already cleaned up when a %resume took its session over
+        if username:
+            del clients[username]
+        token = session_tokens.pop(username, None)
+    if username and bus is None:
+        join_snapshot.left()
+    # Remove user from any groups they're part of
+    with groups_lock:
+        group_names = user_groups.pop(username, ())
+    for group_name in group_names:
+        group = groups.get(group_name)
+        if group is not None:
+            with group['lock']:
+                group['members'].pop(username, None)
+    if token:
+        save_session(token, username, group_names)
+    if username and bus is not None:
+        bus.release(username)  # The hub announces the leave on every worker
+    elif username:
+        broadcast(f"{username} has left the public board.\n", exclude_client=conn)
+
+def open_session(sock, addr):
+    heartbeat.enable_keepalive(sock)
+    return ClientSession(outbound.QueuedConnection(sock), addr)
+
+def serve_client(session):
+    """Reads and runs one connection's commands until it ends (threaded engine)."""
+    conn = session.conn
     try:
-        current_location = 'Not Joined'
-        username = None
         while True:
-            conn.sendall(f"\n[{current_location}]> ".encode())
-            data = conn.recv(4096).decode()
-            if not data:
-                break
-            response, username = process_command(data, username, conn)
-            if response == "EXIT":
-                conn.sendall("Goodbye!\n".encode())
-                break
-            elif response:
-                conn.sendall(response.encode())
-            if username and current_location != 'Public Board':
-                current_location = 'Public Board'
-    except (ConnectionError, socket.error) as e:
-        print(f"Connection error with {addr}: {e}")
+            read_gate.enter(conn.sock)
+            try:
+                data = conn.recv(4096)
+                if not data or not session.feed(data):
+                    break
+            finally:
+                read_gate.leave()
+    except (ConnectionError, socket.error, framing.FrameError) as e:
+        print(f"Connection error with {session.addr}: {e}")
     finally:
-        with lock:
-            if username and username in clients:
-                del clients[username]
-            # Remove user from any groups they're part of
-            for group in groups.values():
-                group['members'].pop(username, None)
-        if username:
-            broadcast(f"{username} has left the public board.\n", exclude_client=conn)
+        # Inside the gate too, so a handoff never finds a connection half cleaned up
+        read_gate.enter()
+        try:
+            session.cleanup()
+        finally:
+            read_gate.leave()
         conn.close()
+        rate_limit.admission.release()
 
 def process_command(data, username, conn):
     args = data.strip().split()
@@ -65,27 +374,45 @@ def process_command(data, username, conn):
     command_handlers = {
         '%help': handle_help,
         '%join': handle_join,
+        '%resume': handle_resume,
         '%post': handle_post,
         '%message': handle_message,
         '%users': handle_users,
         '%groups': handle_groups,
         '%groupjoin': handle_group_join,
+        '%groupcreate': handle_group_create,
+        '%groupdelete': handle_group_delete,
         '%grouppost': handle_group_post,
         '%groupmessage': handle_group_message,
+        '%messages': handle_messages,
+        '%since': handle_since,
+        '%last': handle_last,
+        '%groupmessages': handle_group_messages,
+        '%groupsince': handle_group_since,
+        '%grouplast': handle_group_last,
+        '%search': handle_search,
+        '%groupsearch': handle_group_search,
         '%groupusers': handle_group_users,
         '%groupleave': handle_group_leave,
         '%exit': handle_exit,
+        '%stats': handle_stats,
+        '%compress': handle_compress,
     }
 
     handler = command_handlers.get(args[0])
     if handler is None:
         return "Unknown command. Type '%help' for a list of commands.\n", username
+    if follower is not None and args[0] in replication.WRITE_COMMANDS:
+        return replication.READ_ONLY_REPLY.format(command=args[0]), username
 
+    start = time.perf_counter()
     try:
         return handler(args, username, conn)
     except Exception as e:
         print(f"Error processing command from {username}: {e}")
         return f"Error processing command: {e}\n", username
+    finally:
+        metrics.observe_command(args[0], time.perf_counter() - start)
 
 # Handles %help
 def handle_help(args, username, conn):
@@ -93,16 +420,30 @@ def handle_help(args, username, conn):
 Available Commands:
 - %help: Show this help message.
 - %join [username]: Join the public board with a unique username.
+- %resume [token] [last_public_id] [group=last_id ...]: Rejoin after a dropped connection.
 - %post [message]: Post a message to the public board.
 - %message [message_id]: Retrieve a message from the public board.
 - %users: List users on the public board.
-- %groups: List available groups.
+- %groups [page]: List available groups.
 - %groupjoin [group_name]: Join a private group.
+- %groupcreate [group_name]: Create a group and join it.
+- %groupdelete [group_name]: Delete a group you created.
 - %grouppost [group_name] [message]: Post a message to a group.
 - %groupmessage [group_name] [message_id]: Retrieve a message from a group.
+- %messages [first_id] [last_id]: Retrieve a range of public board messages.
+- %since [message_id]: Retrieve public board messages posted after an id.
+- %last [count]: Retrieve the newest public board messages.
+- %groupmessages [group_name] [first_id] [last_id]: Retrieve a range of group messages.
+- %groupsince [group_name] [message_id]: Retrieve group messages posted after an id.
+- %grouplast [group_name] [count]: Retrieve the newest group messages.
+- %search [query] [page:N]: Search public board messages (word* matches a prefix).
+- %groupsearch [group_name] [query] [page:N]: Search a group's messages.
 - %groupusers [group_name]: List users in a group.
 - %groupleave [group_name]: Leave a group.
 - %exit: Exit the application.
+- %stats: Show server statistics.
+- %frame [raw|line|length]: Switch this connection's wire framing.
+- %compress zlib: Compress everything the server sends on this connection.
 """
     return help_text, username
 
@@ -112,16 +453,18 @@ def handle_post(args, username, conn):
     if len(args) < 2:
         return "Usage: %post [message]\n", username
     content = ' '.join(args[1:])
-    message = {
-        'id': len(public_messages) + 1,
-        'sender': username,
-        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'content': content
-    }
-    with lock:
+    if bus is not None:
+        bus.post(None, username, content)  # Appended and broadcast when the hub's event arrives
+        return "Message posted to the public board.\n", username
+    with public_lock:
+        # Allocate the id and append together so concurrent posts never share an id
+        message = Message(len(public_messages) + 1, username, content)
         public_messages.append(message)
-    formatted_message = format_message(message)
-    broadcast(formatted_message, exclude_client=None)
+        public_index.add(message)
+        replicate_post('', message)
+    join_snapshot.posted()
+    note_appended('', message)
+    broadcast(message.wire(), exclude_client=None)
     return "Message posted to the public board.\n", username
 
 def handle_message(args, username, conn):
@@ -133,62 +476,328 @@ def handle_message(args, username, conn):
         msg_id = int(args[1]) - 1
     except ValueError:
         return "Message ID must be a number.\n", username
-    with lock:
-        if 0 <= msg_id < len(public_messages):
-            msg = public_messages[msg_id]
-            return format_message(msg), username
-        else:
-            return "Message not found on the public board.\n", username
+    history = public_messages
+    if 0 <= msg_id < len(history):
+        return format_single(history[msg_id], msg_id), username
+    else:
+        return "Message not found on the public board.\n", username
+
+def format_single(message, msg_id):
+    if message is None:
+        return retention.EXPIRED_REPLY.format(id=msg_id + 1)
+    return message.wire()
+
+def handle_messages(args, username, conn):
+    if username is None:
+        return "You need to join the public board first using '%join [username]'.\n", username
+    numbers = parse_numbers(args[1:], 2)
+    if numbers is None:
+        return "Usage: %messages [first_id] [last_id]\n", username
+    first, last = numbers
+    return format_page(public_messages, first - 1, last, "on the public board",
+                       lambda next_id: f"%messages {next_id} {last}"), username
+
+def handle_since(args, username, conn):
+    if username is None:
+        return "You need to join the public board first using '%join [username]'.\n", username
+    numbers = parse_numbers(args[1:], 1, allow_zero=True)
+    if numbers is None:
+        return "Usage: %since [message_id]\n", username
+    return format_page(public_messages, numbers[0], len(public_messages), "on the public board",
+                       lambda next_id: f"%since {next_id - 1}"), username
+
+def handle_last(args, username, conn):
+    if username is None:
+        return "You need to join the public board first using '%join [username]'.\n", username
+    numbers = parse_numbers(args[1:], 1)
+    if numbers is None:
+        return "Usage: %last [count]\n", username
+    total = len(public_messages)
+    return format_page(public_messages, total - numbers[0], total, "on the public board",
+                       lambda next_id: f"%since {next_id - 1}"), username
+
+def parse_numbers(values, expected, allow_zero=False):
+    if len(values) != expected:
+        return None
+    try:
+        numbers = [int(value) for value in values]
+    except ValueError:
+        return None
+    if any(number < (0 if allow_zero else 1) for number in numbers):
+        return None
+    return numbers
+
+def format_page(history, start, stop, place, next_command, page_size=None):
+    """Messages start..stop-1 of history as one response, cut at a page with a cursor to the rest."""
+    start = max(start, history.expired)
+    stop = min(stop, len(history))
+    if start >= stop:
+        return f"No messages in that range {place}.\n".encode()
+    lines = []
+    size = 0
+    end = start
+    for message in history[start:min(stop, start + (page_size or HISTORY_PAGE_SIZE))]:
+        end += 1
+        if message is None:  # expired while the page was being read
+            continue
+        line = message.wire()
+        lines.append(line)
+        size += len(line)
+        if size >= HISTORY_PAGE_BYTES:
+            break
+    header = f"Messages {start + 1}-{end} of {len(history)} {place}:\n".encode()
+    if end < stop:
+        lines.append(f"More messages available: {next_command(end + 1)}\n".encode())
+    return header + b''.join(lines)
+
+def handle_search(args, username, conn):
+    if username is None:
+        return "You need to join the public board first using '%join [username]'.\n", username
+    query = parse_search(args[1:])
+    if query is None:
+        return "Usage: %search [query] [page:N]\n", username
+    words, page = query
+    return format_search(public_messages, public_index, words, page, "on the public board",
+                         "%search"), username
+
+def handle_group_search(args, username, conn):
+    query = parse_search(args[2:])
+    if len(args) < 3 or query is None:
+        return "Usage: %groupsearch [group_name] [query] [page:N]\n", username
+    group_name = args[1]
+    history = group_history(group_name, username)
+    if history is None:
+        return GROUP_ACCESS_ERROR, username
+    words, page = query
+    return format_search(history, groups[group_name]['index'], words, page, f"in {group_name}",
+                         f"%groupsearch {group_name}"), username
+
+def parse_search(values):
+    words = [value for value in values if not value.startswith('page:')]
+    pages = [value[len('page:'):] for value in values if value.startswith('page:')]
+    if not words or len(pages) > 1:
+        return None
+    try:
+        page = int(pages[0]) if pages else 1
+    except ValueError:
+        return None
+    if page < 1:
+        return None
+    return ' '.join(words), page
+
+def format_search(history, index, query, page, place, command):
+    if index.building:
+        return f"The search index {place} is still being built. Try again shortly.\n".encode()
+    ids, total = index.search(query, page * SEARCH_PAGE_SIZE, first_id=history.expired + 1)
+    page_ids = ids[(page - 1) * SEARCH_PAGE_SIZE:]
+    if not page_ids:
+        return f"No matches for '{query}' {place}.\n".encode()
+    first = (page - 1) * SEARCH_PAGE_SIZE + 1
+    lines = [f"Matches {first}-{first + len(page_ids) - 1} of {total} for '{query}' {place}:\n".encode()]
+    # The index may still hold messages that have just expired
+    lines.extend(message.wire() for message in (history[message_id - 1] for message_id in page_ids)
+                 if message is not None)
+    if first + len(page_ids) - 1 < total:
+        lines.append(f"More matches available: {command} {query} page:{page + 1}\n".encode())
+    return b''.join(lines)
+
+def build_search_indexes():
+    """Index whatever history was loaded at startup, in the background so startup doesn't read it all.
+
+    New messages are indexed as they are appended; until a board's index has
+    caught up, they wait in it and %search on that board says it is still building.
+    """
+    global public_index
+    boards = []
+    # The end is taken under the board lock, so every later message goes through add()
+    with public_lock:
+        public_index = search_index.SearchIndex(building=True)
+        boards.append((public_messages, public_index, len(public_messages)))
+    for group in list(groups.values()):
+        with group['lock']:
+            group['index'] = search_index.SearchIndex(building=True)
+            boards.append((group['messages'], group['index'], len(group['messages'])))
+    threading.Thread(target=index_histories, args=(boards,), daemon=True).start()
+
+def index_histories(boards):
+    started = time.monotonic()
+    for history, index, end in boards:
+        index.add_all(history, end)
+        index.finish()
+    indexed = sum(end - history.expired for history, _, end in boards)
+    if indexed:
+        print(f"Indexed {indexed} messages for search in {time.monotonic() - started:.1f}s")
 
 def handle_users(args, username, conn):
+    if bus is not None:
+        users = bus.user_list()
+    else:
+        with clients_lock:
+            users = list(clients)
     response = "Current users on the public board:\n"
-    with lock:
-        for user in clients.keys():
-            response += f"- {user}\n"
+    for user in users:
+        response += f"- {user}\n"
     return response, username
 
 def handle_groups(args, username, conn):
+    numbers = parse_numbers(args[1:], 1) if len(args) > 1 else [1]
+    if numbers is None:
+        return "Usage: %groups [page]\n", username
+    start = (numbers[0] - 1) * GROUPS_PAGE_SIZE
+    names = tuple(groups)
     response = "Available groups:\n"
-    with lock:
-        for idx, group in enumerate(groups.keys(), 1):
-            response += f"{idx}. {group}\n"
+    for idx, group in enumerate(names[start:start + GROUPS_PAGE_SIZE], start + 1):
+        response += f"{idx}. {group}\n"
+    if start + GROUPS_PAGE_SIZE < len(names):
+        response += f"More groups available: %groups {numbers[0] + 1}\n"
     return response, username
 
 def handle_group_join(args, username, conn):
     if len(args) != 2:
         return "Usage: %groupjoin [group_name]\n", username
     group_name = args[1]
-    with lock:
-        if group_name in groups:
-            groups[group_name]['members'][username] = conn
-            return f"Joined {group_name}. You are now in Group: {group_name}\n", username
-        else:
-            return "Group not found.\n", username
+    if join_group(group_name, username, conn):
+        return f"Joined {group_name}. You are now in Group: {group_name}\n", username
+    else:
+        return "Group not found.\n", username
+
+def join_group(group_name, username, conn):
+    group = groups.get(group_name)
+    if group is None:
+        return False
+    with group['lock']:
+        if group['deleted']:
+            return False
+        group['members'][username] = conn
+    index_membership(username, group_name, joined=True)
+    if bus is not None:
+        bus.group_join(group_name, username)
+    return True
+
+def handle_group_create(args, username, conn):
+    if username is None:
+        return "You need to join the public board first using '%join [username]'.\n", username
+    if len(args) != 2 or not GROUP_NAME.fullmatch(args[1]):
+        return "Usage: %groupcreate [group_name] (letters, digits, '-' and '_', up to 32)\n", username
+    group_name = args[1]
+    if bus is not None:
+        # The hub creates it everywhere, this worker included, before replying
+        created = bus.group_create(group_name, username)
+    else:
+        created = add_group(group_name, lambda: new_history(group_name, username), owner=username)
+        if created:
+            replicate({'event': 'group_created', 'group': group_name, 'owner': username})
+    if not created:
+        return f"Could not create {group_name}: it already exists or the group limit was reached.\n", username
+    return handle_group_join(['%groupjoin', group_name], username, conn)
+
+def handle_group_delete(args, username, conn):
+    # Built-in and recovered groups have no owner, which must never match a connection that hasn't joined
+    if username is None:
+        return "You need to join the public board first using '%join [username]'.\n", username
+    if len(args) != 2:
+        return "Usage: %groupdelete [group_name]\n", username
+    group_name = args[1]
+    group = groups.get(group_name)
+    if group is None:
+        return "Group not found.\n", username
+    if group['owner'] != username and username not in ADMIN_USERS:
+        return "Only the group's creator or a server admin can delete it.\n", username
+    if bus is not None:
+        bus.group_delete(group_name, username)
+    else:
+        members = remove_group(group_name)
+        replicate({'event': 'group_deleted', 'group': group_name, 'username': username})
+        notify_group_deleted(group_name, members, username)
+    return f"Deleted {group_name}.\n", username
+
+def notify_group_deleted(group_name, members, deleted_by):
+    recipients = [member_conn for member_name, member_conn in members.items() if member_name != deleted_by]
+    fan_out(f"Group {group_name} has been deleted.\n".encode(), recipients)
+
+def new_group(history, owner):
+    return {'members': {}, 'messages': history, 'lock': metrics.InstrumentedLock('group'),
+            'index': search_index.SearchIndex(), 'owner': owner, 'deleted': False}
+
+def add_group(group_name, make_history, owner):
+    """Adds a group unless the name is taken or the limit reached; make_history() only runs if it will be."""
+    with groups_lock:
+        # Checked before opening any storage, which would otherwise be the live group's files
+        if (group_name in groups or group_name in reserved_group_names
+                or len(groups) + len(reserved_group_names) >= MAX_GROUPS):
+            return False
+        reserved_group_names.add(group_name)
+    try:
+        history = make_history()  # Opens files, so not under groups_lock
+        with groups_lock:
+            groups[group_name] = new_group(history, owner)
+    finally:
+        with groups_lock:
+            reserved_group_names.discard(group_name)
+    return True
+
+def remove_group(group_name):
+    """Deletes a group and its history. Returns the members it had."""
+    with groups_lock:
+        group = groups.pop(group_name, None)
+        if group is None:
+            return {}
+        # Until its storage is gone, so a new group of that name can't open the same files
+        reserved_group_names.add(group_name)
+    try:
+        with group['lock']:
+            group['deleted'] = True
+            members = dict(group['members'])
+            group['members'].clear()
+        with groups_lock:
+            for member in members:
+                index_membership_locked(member, group_name, joined=False)
+        drop_history(group_name, group['messages'])
+    finally:
+        with groups_lock:
+            reserved_group_names.discard(group_name)
+    return members
+
+def index_membership(username, group_name, joined):
+    with groups_lock:
+        index_membership_locked(username, group_name, joined)
+
+def index_membership_locked(username, group_name, joined):
+    if joined:
+        user_groups.setdefault(username, set()).add(group_name)
+        return
+    group_names = user_groups.get(username)
+    if group_names is not None:
+        group_names.discard(group_name)
+        if not group_names:
+            del user_groups[username]
 
 def handle_group_post(args, username, conn):
     if len(args) < 3:
         return "Usage: %grouppost [group_name] [message]\n", username
     group_name = args[1]
     content = ' '.join(args[2:])
-    with lock:
-        if group_name in groups and username in groups[group_name]['members']:
-            message = {
-                'id': len(groups[group_name]['messages']) + 1,
-                'sender': username,
-                'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'content': content
-            }
-            groups[group_name]['messages'].append(message)
-            formatted_message = f"Group {group_name}: {format_message(message)}"
-            for member_name, member_conn in groups[group_name]['members'].items():
-                if member_conn != conn:
-                    try:
-                        member_conn.sendall(formatted_message.encode())
-                    except (ConnectionError, socket.error) as e:
-                        print(f"Connection error during group broadcast: {e}")
-            return f"Message posted to {group_name}.\n", username
-        else:
+    group = groups.get(group_name)
+    if group is None:
+        return GROUP_ACCESS_ERROR, username
+    if bus is not None:
+        if username not in group['members']:
+            return GROUP_ACCESS_ERROR, username
+        if bus.post(group_name, username, content) is None:
             return GROUP_ACCESS_ERROR, username
+        return f"Message posted to {group_name}.\n", username
+    with group['lock']:
+        if username not in group['members']:
+            return GROUP_ACCESS_ERROR, username
+        message = Message(len(group['messages']) + 1, username, content)
+        group['messages'].append(message)
+        group['index'].add(message)
+        replicate_post(group_name, message)
+        recipients = [member_conn for member_conn in group['members'].values()
+                      if member_conn != conn]
+    note_appended(group_name, message)
+    fan_out(f"Group {group_name}: ".encode() + message.wire(), recipients)
+    return f"Message posted to {group_name}.\n", username
 
 def handle_group_message(args, username, conn):
     if len(args) != 3:
@@ -198,39 +807,89 @@ def handle_group_message(args, username, conn):
         msg_id = int(args[2]) - 1
     except ValueError:
         return "Message ID must be a number.\n", username
-    with lock:
-        if group_name in groups and username in groups[group_name]['members']:
-            if 0 <= msg_id < len(groups[group_name]['messages']):
-                msg = groups[group_name]['messages'][msg_id]
-                return format_message(msg), username
-            else:
-                return "Message not found in the group.\n", username
-        else:
-            return GROUP_ACCESS_ERROR, username
+    group = groups.get(group_name)
+    if group is None or username not in group['members']:
+        return GROUP_ACCESS_ERROR, username
+    history = group['messages']
+    if 0 <= msg_id < len(history):
+        return format_single(history[msg_id], msg_id), username
+    else:
+        return "Message not found in the group.\n", username
+
+def group_history(group_name, username):
+    group = groups.get(group_name)
+    if group is None or username not in group['members']:
+        return None
+    return group['messages']
+
+def handle_group_messages(args, username, conn):
+    numbers = parse_numbers(args[2:], 2)
+    if len(args) != 4 or numbers is None:
+        return "Usage: %groupmessages [group_name] [first_id] [last_id]\n", username
+    group_name = args[1]
+    first, last = numbers
+    history = group_history(group_name, username)
+    if history is None:
+        return GROUP_ACCESS_ERROR, username
+    return format_page(history, first - 1, last, f"in {group_name}",
+                       lambda next_id: f"%groupmessages {group_name} {next_id} {last}"), username
+
+def handle_group_since(args, username, conn):
+    numbers = parse_numbers(args[2:], 1, allow_zero=True)
+    if len(args) != 3 or numbers is None:
+        return "Usage: %groupsince [group_name] [message_id]\n", username
+    group_name = args[1]
+    history = group_history(group_name, username)
+    if history is None:
+        return GROUP_ACCESS_ERROR, username
+    return format_page(history, numbers[0], len(history), f"in {group_name}",
+                       lambda next_id: f"%groupsince {group_name} {next_id - 1}"), username
+
+def handle_group_last(args, username, conn):
+    numbers = parse_numbers(args[2:], 1)
+    if len(args) != 3 or numbers is None:
+        return "Usage: %grouplast [group_name] [count]\n", username
+    group_name = args[1]
+    history = group_history(group_name, username)
+    if history is None:
+        return GROUP_ACCESS_ERROR, username
+    total = len(history)
+    return format_page(history, total - numbers[0], total, f"in {group_name}",
+                       lambda next_id: f"%groupsince {group_name} {next_id - 1}"), username
 
 def handle_group_users(args, username, conn):
     if len(args) != 2:
         return "Usage: %groupusers [group_name]\n", username
     group_name = args[1]
-    with lock:
-        if group_name in groups and username in groups[group_name]['members']:
-            response = f"Users in {group_name}:\n"
-            for user in groups[group_name]['members'].keys():
-                response += f"- {user}\n"
-            return response, username
-        else:
-            return GROUP_ACCESS_ERROR, username
+    group = groups.get(group_name)
+    if group is None:
+        return GROUP_ACCESS_ERROR, username
+    with group['lock']:
+        members = list(group['members'])
+    if username not in members:
+        return GROUP_ACCESS_ERROR, username
+    if bus is not None:
+        members = bus.group_user_list(group_name)
+    response = f"Users in {group_name}:\n"
+    for user in members:
+        response += f"- {user}\n"
+    return response, username
 
 def handle_group_leave(args, username, conn):
     if len(args) != 2:
         return "Usage: %groupleave [group_name]\n", username
     group_name = args[1]
-    with lock:
-        if group_name in groups and username in groups[group_name]['members']:
-            del groups[group_name]['members'][username]
-            return f"Left {group_name}. You are now back on the Public Board.\n", username
-        else:
+    group = groups.get(group_name)
+    if group is None:
+        return GROUP_ACCESS_ERROR, username
+    with group['lock']:
+        if username not in group['members']:
             return GROUP_ACCESS_ERROR, username
+        del group['members'][username]
+    index_membership(username, group_name, joined=False)
+    if bus is not None:
+        bus.group_leave(group_name, username)
+    return f"Left {group_name}. You are now back on the Public Board.\n", username
 
 def handle_join(args, username, conn):
     if username is not None:
@@ -239,42 +898,1299 @@ def handle_join(args, username, conn):
         return "Usage: %join [username]\n", username
     join_username = args[1]
 
-    with lock:
+    token = claim_username(join_username, conn)
+    if token is None:
+        return "Username already taken. Choose a different username.\n", username
+
+    # Only the welcome is rendered per user; recent messages and the user list are shared
+    welcome = (f"Welcome {join_username}! Type '%help' for a list of commands.\n"
+               f"Session token: {token} (reconnect with '%resume {token}' to pick up where you left off)\n")
+    conn.sendall(welcome.encode() + join_snapshot.get())
+
+    return None, join_username  # Return updated username
+
+def claim_username(join_username, conn, token=None):
+    """Registers conn under join_username and announces it. Returns its resume token, or None if taken."""
+    token = token or secrets.token_urlsafe(16)
+    if bus is not None:
+        # The hub checks uniqueness across workers and announces the join everywhere
+        if not bus.claim(join_username, token):
+            return None
+        with clients_lock:
+            clients[join_username] = conn
+            session_tokens[join_username] = token
+        return token
+    with clients_lock:
         if join_username in clients:
-            return "Username already taken. Choose a different username.\n", username
+            return None
         clients[join_username] = conn
-
-    conn.sendall(f"Welcome {join_username}! Type '%help' for a list of commands.\n".encode())
+        session_tokens[join_username] = token
+    join_snapshot.joined(join_username)
     broadcast(f"{join_username} has joined the public board.\n", exclude_client=conn)
+    return token
 
-    # Send last two messages
-    with lock:
-        if public_messages:
-            last_messages = public_messages[-2:]
-            conn.sendall("Last two messages on the public board:\n".encode())
-            for msg in last_messages:
-                conn.sendall(format_message(msg).encode())
-        else:
-            conn.sendall("No messages on the public board yet.\n".encode())
+def handle_resume(args, username, conn):
+    if username is not None:
+        return "You have already joined the public board.\n", username
+    seen = parse_resume_positions(args[2:])
+    if len(args) < 2 or seen is None:
+        return "Usage: %resume [token] [last_public_id] [group=last_id ...]\n", username
+    token = args[1]
+    session = take_session(token)
+    if session is None and drop_stale_connection(token):
+        session = take_session(token)
+    if session is None:
+        return "Session expired or unknown. Use '%join [username]' instead.\n", username
+    join_username = session['username']
+    if claim_username(join_username, conn, token) is None:
+        store_session(token, session)  # Still there for the next attempt
+        return "Username already taken. Choose a different username.\n", username
+    # Positions the client reports win over what the server had queued when it dropped
+    positions = {**session['seen'], **seen}
+    restored = [group_name for group_name in session['groups'] if join_group(group_name, join_username, conn)]
 
-        # Send list of current users
-        conn.sendall("Current users on the public board:\n".encode())
-        for user in clients.keys():
-            conn.sendall(f"- {user}\n".encode())
+    parts = [f"Welcome back {join_username}!\n".encode()]
+    if restored:
+        parts.append(f"Rejoined groups: {', '.join(restored)}\n".encode())
+    boards = [('', public_messages, "on the public board", "%since {}")]
+    boards += [(group_name, groups[group_name]['messages'], f"in {group_name}", f"%groupsince {group_name} {{}}")
+               for group_name in restored if group_name in groups]
+    missed = 0
+    for key, history, place, cursor in boards:
+        start = positions.get(key, len(history))
+        if start < len(history):
+            missed += len(history) - start
+            parts.append(format_page(history, start, len(history), place,
+                                     lambda next_id, cursor=cursor: cursor.format(next_id - 1),
+                                     page_size=RESUME_MAX_MESSAGES))
+    if not missed:
+        parts.append(b"No new messages since you left.\n")
+    conn.sendall(b''.join(parts))
+    return None, join_username
 
-    return None, join_username  # Return updated username
+def drop_stale_connection(token):
+    """Disconnects the user still connected under token, saving their session. False if there isn't one.
+
+    After a network blip the server keeps the half-open connection until it
+    times out, so the client's %resume usually arrives first. With workers the
+    hub saves the session and tells the worker holding the connection to drop it.
+    """
+    if bus is not None:
+        return bus.session_drop(token, time.time() + SESSION_TTL)
+    with clients_lock:
+        stale = next(((name, clients[name]) for name, user_token in session_tokens.items()
+                      if user_token == token and name in clients), None)
+    if stale is None:
+        return False
+    stale_username, stale_conn = stale
+    # Saved here rather than by its reader, so the session is there to take once this returns
+    cleanup_client(stale_username, stale_conn)
+    stale_conn.shutdown()
+    return True
+
+def parse_resume_positions(values):
+    """'12' is the last public board id seen, 'Group1=7' the last id seen in a group."""
+    positions = {}
+    for value in values:
+        key, _, number = value.rpartition('=')
+        if not number.isdigit():
+            return None
+        positions[key] = int(number)
+    return positions
+
+def save_session(token, username, group_names):
+    store_session(token, saved_session(username, group_names))
+
+def store_session(token, session):
+    if bus is not None:
+        bus.session_save(token, session)
+        return
+    with clients_lock:
+        sessions[token] = session
+        prune_sessions(sessions)
+
+def saved_session(username, group_names):
+    return {
+        'username': username,
+        'groups': sorted(group_names),
+        'seen': {'': len(public_messages),
+                 **{name: len(groups[name]['messages']) for name in group_names if name in groups}},
+        'expires': time.time() + SESSION_TTL,
+    }
+
+def prune_sessions(saved):
+    # Abandoned sessions are only swept once there are enough of them to matter
+    if len(saved) > 1024:
+        now = time.time()
+        for expired in [token for token, session in saved.items() if session['expires'] < now]:
+            del saved[expired]
+
+def take_session(token):
+    if bus is not None:
+        session = bus.session_take(token)
+    else:
+        with clients_lock:
+            session = sessions.pop(token, None)
+    if session is None or session['expires'] < time.time():
+        return None
+    return session
+
+def handle_compress(args, username, conn):
+    if len(args) != 2 or args[1] not in compression.COMPRESSION_MODES:
+        return f"Usage: %compress [{'|'.join(compression.COMPRESSION_MODES)}]\n", username
+    if conn.compressed:
+        return "Compression is already on.\n", username
+    # The acknowledgement is the last thing the client receives uncompressed
+    conn.sendall(compression.COMPRESS_ACK.format(mode=args[1]).encode())
+    conn.start_compression(compression.Compressor())
+    conn.compressed = True
+    return None, username
 
 def handle_exit(args, username, conn):
+    # Leaving on purpose ends the session; only dropped connections can be resumed
+    with clients_lock:
+        session_tokens.pop(username, None)
     return "EXIT", username
 
-def start_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
-        print(f"Server started on {HOST}:{PORT}")
+# Handles %stats
+def handle_stats(args, username, conn):
+    if ADMIN_USERS and username not in ADMIN_USERS:
+        return "Only server admins can view statistics.\n", username
+    total_depth, max_depth = outbound.queue_depths()
+    with outbound.stats_lock:
+        counters = dict(outbound.stats)
+    with clients_lock:
+        connected = len(clients)
+    response = "Server statistics:\n"
+    response += f"- connected users: {connected}\n"
+    response += f"- outbound queue depth: {total_depth} total, {max_depth} max\n"
+    response += f"- outbound frames enqueued: {counters['enqueued']}\n"
+    response += f"- outbound frames dropped: {counters['dropped']}\n"
+    response += f"- slow consumers coalesced: {counters['coalesced']}\n"
+    response += f"- slow consumers disconnected: {counters['disconnected']}\n"
+    frames_per_write = counters['frames_written'] / counters['writes'] if counters['writes'] else 0.0
+    response += (f"- socket writes: {counters['writes']} for {counters['frames_written']} frames "
+                 f"({frames_per_write:.1f} frames per write)\n")
+    history = history_stats()
+    if history is not None:
+        lookups = history['hits'] + history['misses']
+        hit_rate = 100.0 * history['hits'] / lookups if lookups else 0.0
+        response += (f"- history hot window: {history['hot_messages']} messages, "
+                     f"{history['hot_bytes'] / 1024:.1f} KiB\n")
+        response += f"- history on disk only: {history['cold_messages']} messages\n"
+        response += (f"- history lookups: {history['hits']} hits, {history['misses']} misses "
+                     f"({hit_rate:.1f}% hit rate)\n")
+    with rate_limit.stats_lock:
+        limits = dict(rate_limit.stats)
+    response += (f"- open connections: {rate_limit.admission.open}"
+                 f"{f' of {rate_limit.MAX_CONNECTIONS}' if rate_limit.MAX_CONNECTIONS else ''}, "
+                 f"{limits['connections_rejected']} refused\n")
+    response += (f"- commands throttled: {limits['throttled_post']} post, {limits['throttled_read']} read, "
+                 f"{limits['throttled_join']} join\n")
+    with heartbeat.stats_lock:
+        beats = dict(heartbeat.stats)
+    response += (f"- heartbeats: {beats['pings_sent']} pings, {beats['pongs_received']} pongs, "
+                 f"{beats['reaped']} idle connections dropped\n")
+    if RETENTION:
+        with retention.stats_lock:
+            expiry = dict(retention.stats)
+        response += f"- messages expired by retention: {expiry['expired']}\n"
+    with replication.stats_lock:
+        replicated = dict(replication.stats)
+    if replicator is not None:
+        response += (f"- replication: {len(replicator.followers)} followers, {replicated['events_sent']} events sent, "
+                     f"{replicated['followers_dropped']} followers dropped for falling behind\n")
+    if follower is not None:
+        response += (f"- replica of {replication.format_address(follower.address)}: "
+                     f"{'streaming' if follower.connected else 'reconnecting'}, "
+                     f"lag {follower.lag * 1000:.1f}ms, last heard {time.monotonic() - follower.last_heard:.1f}s ago, "
+                     f"{replicated['events_applied']} events applied, {replicated['resyncs']} resyncs\n")
+    if counters['compressed_bytes_in']:
+        ratio = counters['compressed_bytes_out'] / counters['compressed_bytes_in']
+        response += (f"- compression: {counters['compressed_bytes_in'] / 1024:.1f} KiB in, "
+                     f"{counters['compressed_bytes_out'] / 1024:.1f} KiB out ({ratio:.0%})\n")
+    response += "Command latency (count, p50, p99):\n"
+    for command, histogram in metrics.command_latency.items():
+        response += (f"- {command}: {histogram.count}, {format_seconds(histogram.quantile(0.5))}, "
+                     f"{format_seconds(histogram.quantile(0.99))}\n")
+    response += "Lock wait / hold time (total seconds):\n"
+    for name, histogram in metrics.lock_wait.items():
+        hold = metrics.lock_hold.labels(name)
+        response += f"- {name}: {histogram.sum:.4f} waiting, {hold.sum:.4f} held over {hold.count} acquisitions\n"
+    response += (f"Broadcasts: {metrics.fanout_size.count}, "
+                 f"avg {metrics.fanout_size.sum / max(metrics.fanout_size.count, 1):.1f} recipients, "
+                 f"p99 {format_seconds(metrics.fanout_duration.quantile(0.99))} to enqueue\n")
+    sizes = group_sizes()
+    response += f"Groups: {len(sizes)}, {sum(sizes.values())} memberships. Largest:\n"
+    for group_name, size in heapq.nlargest(5, sizes.items(), key=lambda item: item[1]):
+        response += f"- {group_name}: {size}\n"
+    return response, username
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "n/a"
+    return f"<={seconds * 1000:g}ms"
+
+def group_sizes():
+    return {group_name: len(group['members']) for group_name, group in list(groups.items())}
+
+def render_metrics():
+    """Everything %stats knows, in Prometheus exposition format."""
+    total_depth, max_depth = outbound.queue_depths()
+    with outbound.stats_lock:
+        counters = dict(outbound.stats)
+    with clients_lock:
+        connected = len(clients)
+    sizes = group_sizes()
+    gauges = {
+        'bulletin_connected_users': ("Users joined to this server process.", connected),
+        'bulletin_groups': ("Groups that exist.", len(sizes)),
+        'bulletin_group_memberships': ("Group memberships on this server process.", sum(sizes.values())),
+        'bulletin_open_connections': ("Connections admitted and still open.", rate_limit.admission.open),
+        'bulletin_outbound_queue_depth': ("Frames waiting in all outbound queues.", total_depth),
+        'bulletin_outbound_queue_depth_max': ("Deepest single outbound queue.", max_depth),
+    }
+    history = history_stats()
+    if history is not None:
+        gauges['bulletin_history_hot_messages'] = ("Messages held in memory.", history['hot_messages'])
+        gauges['bulletin_history_hot_bytes'] = ("Bytes of messages held in memory.", history['hot_bytes'])
+    counter_metrics = {
+        f'bulletin_outbound_{name}_total': (f"Outbound {name.replace('_', ' ')}.", value)
+        for name, value in counters.items()
+    }
+    with rate_limit.stats_lock:
+        limits = dict(rate_limit.stats)
+    counter_metrics['bulletin_commands_throttled_total'] = (
+        "Commands refused by rate limits, by command class.",
+        {'label': 'class', 'values': {kind: limits[f'throttled_{kind}'] for kind in rate_limit.RATE_LIMITS}})
+    counter_metrics['bulletin_connections_rejected_total'] = (
+        "Connections refused because the server was full.", limits['connections_rejected'])
+    with heartbeat.stats_lock:
+        beats = dict(heartbeat.stats)
+    counter_metrics['bulletin_heartbeat_pings_total'] = ("Pings sent to quiet connections.", beats['pings_sent'])
+    counter_metrics['bulletin_heartbeat_pongs_total'] = ("Pongs received from clients.", beats['pongs_received'])
+    counter_metrics['bulletin_idle_connections_reaped_total'] = (
+        "Connections dropped for being quiet past the idle timeout.", beats['reaped'])
+    with retention.stats_lock:
+        expiry = dict(retention.stats)
+    counter_metrics['bulletin_messages_expired_total'] = (
+        "Messages dropped by retention policies.", expiry['expired'])
+    counter_metrics['bulletin_expiry_runs_total'] = (
+        "Background expiry passes over a board or group.", expiry['expiry_runs'])
+    if replicator is not None:
+        gauges['bulletin_replication_followers'] = ("Read replicas streaming from this server.",
+                                                    len(replicator.followers))
+    if follower is not None:
+        gauges['bulletin_replication_connected'] = ("1 while this replica is streaming from its primary.",
+                                                    int(follower.connected))
+        gauges['bulletin_replication_lag_seconds'] = (
+            "Time from the primary queueing the latest replication event to this replica applying it.", follower.lag)
+        gauges['bulletin_replication_last_heard_seconds'] = (
+            "Seconds since anything arrived from the primary, heartbeats included.",
+            time.monotonic() - follower.last_heard)
+    with replication.stats_lock:
+        replicated = dict(replication.stats)
+    counter_metrics['bulletin_replication_events_sent_total'] = (
+        "Events streamed to read replicas.", replicated['events_sent'])
+    counter_metrics['bulletin_replication_followers_dropped_total'] = (
+        "Read replicas disconnected for falling too far behind.", replicated['followers_dropped'])
+    counter_metrics['bulletin_replication_events_applied_total'] = (
+        "Events from the primary applied by this replica.", replicated['events_applied'])
+    counter_metrics['bulletin_replication_resyncs_total'] = (
+        "Times this replica reconnected and caught up from a fresh snapshot.", replicated['resyncs'])
+    if history is not None:
+        counter_metrics['bulletin_history_lookups_total'] = (
+            "History lookups by where they were served from.",
+            {'label': 'result', 'values': {'hit': history['hits'], 'miss': history['misses']}})
+    return metrics.exposition(gauges, counter_metrics)
+
+def open_message_logs(data_dir):
+    """Swap the in-memory history lists for on-disk logs, recovering anything already stored."""
+    global public_messages, DATA_DIR
+    DATA_DIR = data_dir
+    with public_lock:
+        public_messages = message_log.MessageLog(os.path.join(data_dir, 'public'))
+    for group_name, group in groups.items():
+        with group['lock']:
+            group['messages'] = message_log.MessageLog(os.path.join(data_dir, 'groups', group_name))
+    # Groups created at runtime come back with the owner recorded next to their segments
+    groups_dir = os.path.join(data_dir, 'groups')
+    for group_name in sorted(os.listdir(groups_dir)):
+        if group_name not in groups and GROUP_NAME.fullmatch(group_name):
+            add_group(group_name, lambda: new_history(group_name),
+                      owner=read_group_owner(os.path.join(groups_dir, group_name)))
+    print(f"Loaded {len(public_messages)} public messages and {len(groups)} groups from {data_dir}")
+
+def open_hot_stores(max_messages, max_bytes, spill_dir):
+    """Keep only a bounded window of each history in memory, spilling or deferring the rest to disk."""
+    global public_messages, HOT_WINDOW
+    HOT_WINDOW = (max_messages, max_bytes, spill_dir)
+    with public_lock:
+        public_messages = hot_store(public_messages, os.path.join(spill_dir, 'public.spill'))
+    for group_name, group in list(groups.items()):
+        with group['lock']:
+            group['messages'] = hot_store(group['messages'], group_spill_path(group_name))
+
+def hot_store(history, spill_path):
+    max_messages, max_bytes, _ = HOT_WINDOW
+    if isinstance(history, message_log.MessageLog):
+        return message_store.HotColdStore(history, write_through=True,
+                                          max_messages=max_messages, max_bytes=max_bytes)
+    spill = message_store.SpillFile(spill_path)
+    store = message_store.HotColdStore(spill, max_messages=max_messages, max_bytes=max_bytes,
+                                       expired=history.expired)
+    for msg in history[history.expired:]:
+        store.append(msg)
+    return store
+
+def group_spill_path(group_name):
+    return os.path.join(HOT_WINDOW[2], 'groups', f"{group_name}.spill")
+
+def new_history(group_name, owner=None):
+    """Empty history for a group created at runtime, stored the same way as everything else."""
+    history = message_store.MessageList()
+    if DATA_DIR:
+        history = message_log.MessageLog(os.path.join(DATA_DIR, 'groups', group_name))
+        if owner is not None:
+            write_group_owner(history.directory, owner)
+    if HOT_WINDOW:
+        history = hot_store(history, group_spill_path(group_name))
+    return history
+
+def write_group_owner(directory, owner):
+    # Replaced whole, so a crash never leaves half a name behind
+    path = os.path.join(directory, GROUP_OWNER_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(owner)
+    os.replace(path + '.tmp', path)
+
+def read_group_owner(directory):
+    """The creator saved with a group's log, or None for groups stored before owners were."""
+    try:
+        with open(os.path.join(directory, GROUP_OWNER_FILE)) as f:
+            return f.read() or None
+    except FileNotFoundError:
+        return None
+
+def drop_history(group_name, history):
+    if isinstance(history, message_store.HotColdStore):
+        history.close()
+        history = history.cold
+    if isinstance(history, message_log.MessageLog):
+        history.close()
+        shutil.rmtree(history.directory, ignore_errors=True)
+
+def all_histories():
+    return [public_messages] + [group['messages'] for group in list(groups.values())]
+
+def history_stats():
+    """Totals the hot window counters of every board and group, if hot stores are enabled."""
+    histories = all_histories()
+    totals = {'hot_messages': 0, 'hot_bytes': 0, 'cold_messages': 0, 'hits': 0, 'misses': 0}
+    for history in histories:
+        if not isinstance(history, message_store.HotColdStore):
+            return None
+        for key, value in history.stats().items():
+            totals[key] += value
+    return totals
+
+def close_histories():
+    for history in all_histories():
+        if isinstance(history, message_store.HotColdStore):
+            history.close()
+    message_log.close_all()
+
+def board_history(board):
+    """History of a board named as on the event bus ('' is the public board), or None if it's gone."""
+    if not board:
+        return public_messages
+    group = groups.get(board)
+    return group['messages'] if group is not None else None
+
+def note_appended(board, message):
+    if expirer is not None:
+        expirer.appended(board, message)
+
+def expire_history(board, index):
+    """Drops a board's messages before index, trimming its search index once enough have gone."""
+    if board:
+        group = groups.get(board)
+        if group is None:
+            return
+        history, search = group['messages'], group['index']
+    else:
+        history, search = public_messages, public_index
+    history.drop_before(index)
+    if index + 1 - search.first_id >= retention.INDEX_PRUNE_MIN:
+        search.drop_before(index + 1)
+    if not board:
+        join_snapshot.posted()
+    replicate({'event': 'expired', 'group': board, 'before': index})
+
+def start_retention(history_for, apply, boards):
+    """Starts expiring messages under the --retention policies, if there are any."""
+    global expirer
+    candidate = retention.Expirer(RETENTION, history_for, apply)
+    if candidate.enabled():
+        expirer = candidate
+        expirer.start(boards)
+
+def replicate(event):
+    """Queues an event, shaped like the hub's, for every follower."""
+    if replicator is not None:
+        replicator.publish(event)
+
+def replicate_post(board, message):
+    # Called with the board's lock held, so followers receive ids in order
+    if replicator is not None:
+        replicator.publish({'event': 'post', 'group': board, 'message': message.to_dict()})
+
+def start_replication(address, take_snapshot):
+    global replicator
+    replicator = replication.Replicator(address, take_snapshot, listener=inherited_listener('replication'))
+    listeners['replication'] = replicator.listener
+    replicator.start()
+
+def replication_snapshot():
+    boards = list(groups.items())
+    return replication.snapshot({'': public_messages, **{name: group['messages'] for name, group in boards}},
+                                {name: group['owner'] for name, group in boards})
+
+def start_following(address):
+    """Makes this server a read replica of the primary streaming on address, once it has a first snapshot."""
+    global follower
+    follower = replication.ReplicaClient(address, apply_replica_snapshot, apply_replica_event)
+    follower.start()
+
+def apply_replica_snapshot(snapshot):
+    """Brings this replica's boards in line with a snapshot from the primary, keeping its own users."""
+    global public_messages
+    with public_lock:
+        public_messages = merge_replica_history(public_messages, snapshot, '')
+    for group_name, owner in snapshot['group_owners'].items():
+        group = groups.get(group_name)
+        if group is None:
+            add_group(group_name, lambda: merge_replica_history(None, snapshot, group_name), owner)
+            continue
+        with group['lock']:
+            group['messages'] = merge_replica_history(group['messages'], snapshot, group_name)
+            group['owner'] = owner
+    # Deleted on the primary while this replica wasn't listening
+    for group_name in [name for name in groups if name not in snapshot['group_owners']]:
+        members = remove_group(group_name)
+        run_in_engine(notify_group_deleted, group_name, members, None)
+    build_search_indexes()
+    join_snapshot.posted()
+
+def merge_replica_history(history, snapshot, board):
+    """Appends whatever the snapshot has beyond history, or starts over from it if the two can't be lined up."""
+    expired = snapshot['expired'][board]
+    messages = snapshot['histories'][board]
+    if history is not None and expired <= len(history) <= expired + len(messages):
+        for data in messages[len(history) - expired:]:
+            history.append(Message.from_dict(data))
+        history.drop_before(expired)
+        return history
+    # First sight of the board, or the primary lost history (say, restarted without --data-dir)
+    if history is not None:
+        drop_history(board, history)
+    history = replica_history(snapshot, board)
+    if HOT_WINDOW:
+        history = hot_store(history, group_spill_path(board) if board else
+                            os.path.join(HOT_WINDOW[2], 'public.spill'))
+    return history
+
+def apply_replica_event(event):
+    """Applies one event from the primary; posts the snapshot already had are skipped."""
+    if event['event'] == 'post':
+        history = board_history(event['group'])
+        if history is None:
+            return
+        message_id = event['message']['id']
+        if message_id <= len(history):
+            return
+        if message_id > len(history) + 1:
+            raise replication.ResyncNeeded(f"missed messages {len(history) + 1}-{message_id - 1} "
+                                           f"of {event['group'] or 'the public board'}")
+    handle_bus_event(event)
+
+def handle_bus_event(event):
+    """Applies a hub event to this worker's replica and notifies its local clients."""
+    kind = event['event']
+    if kind == 'post':
+        message = Message.from_dict(event['message'])
+        if event['group']:
+            group = groups.get(event['group'])
+            if group is None:
+                return
+            with group['lock']:
+                group['messages'].append(message)
+                group['index'].add(message)
+                recipients = [member_conn for member_name, member_conn in group['members'].items()
+                              if member_name != message.sender]
+            run_in_engine(fan_out, f"Group {event['group']}: ".encode() + message.wire(), recipients)
+        else:
+            with public_lock:
+                public_messages.append(message)
+                public_index.add(message)
+            join_snapshot.posted()
+            run_in_engine(broadcast, message.wire())
+    elif kind == 'joined':
+        join_snapshot.joined(event['username'])
+        run_in_engine(broadcast_except_user, f"{event['username']} has joined the public board.\n",
+                      event['username'])
+    elif kind == 'dropped':
+        drop_local_connection(event['username'])
+    elif kind == 'left':
+        join_snapshot.left()
+        run_in_engine(broadcast, f"{event['username']} has left the public board.\n")
+    elif kind == 'group_created':
+        add_group(event['group'], lambda: new_history(event['group'], event['owner']), owner=event['owner'])
+    elif kind == 'expired':
+        history = board_history(event['group'])
+        if history is not None:
+            retention.count('expired', max(0, event['before'] - history.expired))
+            expire_history(event['group'], event['before'])
+    elif kind == 'group_deleted':
+        members = remove_group(event['group'])
+        run_in_engine(notify_group_deleted, event['group'], members, event['username'])
+
+def drop_local_connection(username):
+    """Disconnects username here if connected; the hub already saved their session and releases them next."""
+    with clients_lock:
+        conn = clients.pop(username, None)
+        session_tokens.pop(username, None)
+    if conn is None:
+        return
+    with groups_lock:
+        group_names = user_groups.pop(username, ())
+    for group_name in group_names:
+        group = groups.get(group_name)
+        if group is not None:
+            with group['lock']:
+                group['members'].pop(username, None)
+    # Its reader finds the user gone and skips the usual cleanup
+    conn.shutdown()
+
+def broadcast_except_user(message, username):
+    with clients_lock:
+        conn = clients.get(username)
+    broadcast(message, exclude_client=conn)
+
+def load_bus_snapshot(snapshot):
+    global public_messages
+    with public_lock:
+        public_messages = replica_history(snapshot, '')
+    with groups_lock:
+        groups.clear()
+        for group_name, owner in snapshot['group_owners'].items():
+            groups[group_name] = new_group(replica_history(snapshot, group_name), owner)
+    join_snapshot.reset()
+
+def replica_history(snapshot, board):
+    # The hub leaves out expired messages; their slots are kept so ids still line up
+    expired = snapshot['expired'][board]
+    history = message_store.MessageList([None] * expired)
+    history.extend(Message.from_dict(data) for data in snapshot['histories'][board])
+    history.expired = expired
+    return history
+
+def run_worker(args, bus_path, index, hub_listener, unix_listener):
+    global bus
+    hub_listener.close()  # Inherited from the parent through fork
+    bus = event_bus.BusClient(bus_path, handle_bus_event)
+    load_bus_snapshot(bus.start())
+    build_search_indexes()
+    if args.hot_messages or args.hot_mb:
+        hot_bytes = int(args.hot_mb * 1024 * 1024) if args.hot_mb else 0
+        open_hot_stores(args.hot_messages, hot_bytes, os.path.join(args.spill_dir, str(os.getpid())))
+    if args.metrics_port:
+        metrics.serve_http(args.metrics_host, args.metrics_port + index, render_metrics)
+    print(f"Worker {index} (pid {os.getpid()}) serving {args.host}:{args.port}")
+    try:
+        if args.engine == 'asyncio':
+            start_async_server(args.host, args.port, reuse_port=True, unix_listener=unix_listener)
+        else:
+            start_server(args.host, args.port, reuse_port=True, unix_listener=unix_listener)
+    finally:
+        close_histories()
+
+def start_sharded(args):
+    """Run N worker processes sharing the port via SO_REUSEPORT, coordinated by a hub in this process."""
+    bus_path = args.bus_path or os.path.join(tempfile.gettempdir(), f"bulletin-board-{os.getpid()}.sock")
+    hub = event_bus.Hub(bus_path, max_groups=MAX_GROUPS)
+    # Unix sockets have no SO_REUSEPORT, so every worker accepts from one inherited listener
+    unix_listener = open_unix_listener(UNIX_PATH) if UNIX_PATH else None
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_worker, args=(args, bus_path, index, hub.listener, unix_listener),
+                               daemon=True)
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    # Storage belongs to the hub; workers hold replicas fed by the bus
+    if args.data_dir:
+        open_message_logs(args.data_dir)
+    hub.set_histories(public_messages, {name: group['messages'] for name, group in groups.items()},
+                      {name: group['owner'] for name, group in groups.items()}, new_history, drop_history)
+    # The hub expires its own histories and has workers follow with an event
+    start_retention(hub.histories.get, hub.expire, list(hub.histories))
+    if expirer is not None:
+        hub.appended = expirer.appended
+    if args.replication:
+        # Started after the fork, so the workers don't inherit its threads
+        start_replication(args.replication, lambda: hub_replication_snapshot(hub))
+        hub.published = replicator.publish
+    try:
+        hub.serve_forever()
+    finally:
+        hub.close()
+        if replicator is not None:
+            replicator.close()
+        if unix_listener is not None:
+            close_unix_listener(unix_listener)
+        close_histories()
+
+def start_handoffs():
+    """Starts taking handoff requests from new processes, once this one is serving."""
+    if HANDOFF_PATH:
+        listeners['handoff'] = listeners.get('handoff') or handoff.listen(HANDOFF_PATH)
+        handoff.serve(listeners['handoff'], hand_off)
+        print(f"Accepting handoffs on {HANDOFF_PATH}")
+
+def hand_off(channel):
+    """Passes the listeners, live connections and boards to the new server.py on channel, then exits.
+
+    Connections stop being read between commands and get DRAIN_TIMEOUT to
+    write out what is queued for them. Any that can't are left behind and
+    close when this process exits; their users can %resume on the new one.
+    """
+    print("Handing off to a new server process")
+    handing_off.set()
+    if expirer is not None:
+        expirer.pause()
+    freeze_connections()
+    try:
+        live, slow = wait_for_drain()
+        state, fds = export_state(live, slow)
+        handoff.send_state(channel, state, fds)
+        if handoff.wait_ready(channel):
+            handoff.confirm(channel)
+            print(f"Handed off {len(live)} connections, closing {len(slow)} that couldn't catch up; exiting",
+                  flush=True)
+            close_histories()
+            # Skips every cleanup path: the sockets, and the files behind them, are the new process's now
+            os._exit(0)
+        print("The new server never got ready; carrying on")
+    except (ConnectionError, OSError) as e:
+        print(f"Handoff failed, carrying on: {e}")
+    thaw_connections()
+    if expirer is not None:
+        expirer.resume()
+    handing_off.clear()
+    channel.close()
+
+def freeze_connections():
+    """Stops reading from every connection, and accepting new ones, between commands."""
+    if async_loop is None:
+        read_gate.stop()
+    else:
+        asyncio.run_coroutine_threadsafe(freeze_async(), async_loop).result()
+
+def thaw_connections():
+    if async_loop is None:
+        read_gate.resume()
+    else:
+        asyncio.run_coroutine_threadsafe(thaw_async(), async_loop).result()
+
+def wait_for_drain():
+    """Gives queued output DRAIN_TIMEOUT to reach the sockets. Returns (drained sessions, the rest)."""
+    deadline = time.monotonic() + handoff.DRAIN_TIMEOUT
+    while True:
+        with heartbeat.sessions_lock:
+            current = list(heartbeat.sessions)
+        busy = {session for session in current if not session.conn.idle()}
+        if not busy or time.monotonic() >= deadline:
+            return [session for session in current if session not in busy], list(busy)
+        time.sleep(0.01)
+
+def export_state(live, slow):
+    """What the new process needs to carry on, and the sockets it takes over (referred to by index)."""
+    fds = []
+
+    def add(fd):
+        fds.append(fd)
+        return len(fds) - 1
+
+    boards = list(groups.items())
+    owners = {name: group['owner'] for name, group in boards}
+    state = {'group_owners': owners,
+             'listeners': {name: add(listener.fileno()) for name, listener in listeners.items()}}
+    if not DATA_DIR:
+        # With --data-dir the new process reopens the logs instead
+        state.update(replication.snapshot({'': public_messages, **{name: group['messages'] for name, group in boards}},
+                                          owners))
+    with clients_lock:
+        saved = dict(sessions)
+        tokens = dict(session_tokens)
+    with groups_lock:
+        memberships = {username: sorted(names) for username, names in user_groups.items()}
+    # Left behind like any dropped connection, so their users can resume
+    for session in slow:
+        if session.username in tokens:
+            saved[tokens[session.username]] = saved_session(session.username, memberships.get(session.username, ()))
+    state['sessions'] = saved
+    state['connections'] = []
+    for session in live:
+        # Whatever partial command was read stays with the session, in case the handoff is called off
+        pending = session.decoder.take_remaining()
+        session.decoder.feed(pending)
+        state['connections'].append({
+            'fd': add(session.conn.fileno()),
+            'username': session.username,
+            'token': tokens.get(session.username),
+            'groups': memberships.get(session.username, []),
+            'location': session.current_location,
+            'framing': session.framing,
+            'pending': base64.b64encode(pending).decode(),
+            'compressed': session.conn.compressed,
+        })
+    return state, fds
+
+def load_handoff_state(state):
+    """Takes over the boards, groups and resumable sessions of the server this process replaces."""
+    global public_messages
+    owners = state['group_owners']
+    for group_name in [name for name in groups if name not in owners]:
+        remove_group(group_name)
+    if 'histories' in state:
+        with public_lock:
+            public_messages = replica_history(state, '')
+        for group_name in owners:
+            if group_name in groups:
+                groups[group_name]['messages'] = replica_history(state, group_name)
+            else:
+                add_group(group_name, lambda: replica_history(state, group_name), owners[group_name])
+    for group_name, owner in owners.items():
+        if group_name not in groups:
+            add_group(group_name, lambda: new_history(group_name, owner), owner)
+        groups[group_name]['owner'] = owner
+    sessions.update(state['sessions'])
+
+def inherited_listener(name):
+    if takeover is None or name not in takeover.state['listeners']:
+        return None
+    return takeover.socket(takeover.state['listeners'][name])
+
+def inherited_connections():
+    """Commits the takeover, if this process is one. Returns the inherited connections as (socket, saved state)."""
+    if takeover is None:
+        return []
+    takeover.commit()
+    threading.Thread(target=after_takeover, daemon=True).start()
+    connections = []
+    for saved in takeover.state['connections']:
+        rate_limit.admission.inherit()
+        connections.append((takeover.socket(saved['fd']), saved))
+    print(f"Took over {len(connections)} connections")
+    return connections
+
+def after_takeover():
+    takeover.wait_for_exit()
+    print("The old server has exited")
+    # Its metrics endpoint only went away with it
+    start_metrics()
+
+def start_metrics():
+    if METRICS_ADDRESS:
+        metrics.serve_http(*METRICS_ADDRESS, render_metrics)
+
+def restore_session(session, saved):
+    """Puts a connection taken over in a handoff back the way the old process had it."""
+    conn = session.conn
+    session.set_framing(saved['framing'])
+    session.decoder.feed(base64.b64decode(saved['pending']))
+    session.current_location = saved['location']
+    session.username = username = saved['username']
+    if saved['compressed']:
+        conn.start_compression(compression.Compressor(continuing=True))
+        conn.compressed = True
+    if username is None:
+        return
+    with clients_lock:
+        clients[username] = conn
+        if saved['token']:
+            session_tokens[username] = saved['token']
+    join_snapshot.joined(username)
+    for group_name in saved['groups']:
+        join_group(group_name, username, conn)
+
+def hub_replication_snapshot(hub):
+    # Under the hub's lock, so no event lands between the snapshot and the follower's queue
+    with hub.lock:
+        return replication.snapshot(hub.histories, hub.group_owners)
+
+def check_heartbeats():
+    """Pings quiet connections and drops the ones quiet for longer than IDLE_TIMEOUT.
+
+    Dropping only shuts the socket down; the connection's own reader then runs
+    the normal leave path, so a dropped user can still %resume.
+    """
+    if handing_off.is_set():
+        return  # the connections are about to belong to another process
+    ping, reap = heartbeat.sweep()
+    for session in ping:
+        try:
+            session.conn.sendall(heartbeat.PING.encode())
+        except (ConnectionError, socket.error):
+            pass
+    for session in reap:
+        print(f"Dropping idle connection {session.addr} ({session.username or 'not joined'})")
+        session.conn.shutdown()
+
+def run_heartbeats():
+    while True:
+        time.sleep(heartbeat.SWEEP_INTERVAL)
+        check_heartbeats()
+
+def start_server(host=HOST, port=PORT, reuse_port=False, unix_listener=None):
+    with listeners.get('tcp') or open_tcp_listener(host, port, reuse_port) as s:
+        listeners['tcp'] = s
+        print(f"Server started on {host}:{port}")
+        if unix_listener is not None:
+            listeners['unix'] = unix_listener
+            print(f"Also listening on {UNIX_PATH}")
+            threading.Thread(target=accept_loop, args=(unix_listener,), daemon=True).start()
+        for sock, saved in inherited_connections():
+            session = open_session(sock, sock.getpeername() or unix_peer_name())
+            restore_session(session, saved)
+            threading.Thread(target=serve_client, args=(session,), daemon=True).start()
+        start_handoffs()
+        threading.Thread(target=run_heartbeats, daemon=True).start()
+        accept_loop(s)
+
+def open_tcp_listener(host, port, reuse_port=False):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((host, port))
+    s.listen(rate_limit.LISTEN_BACKLOG)
+    return s
+
+def accept_loop(listener):
+    while True:
+        read_gate.enter(listener)
+        try:
+            conn, addr = listener.accept()
+            if not rate_limit.admission.admit():
+                reject_connection(conn)
+                continue
+            # The session exists before the gate is left, so a handoff can't miss it
+            session = open_session(conn, addr or unix_peer_name())
+            session.prompt()
+            threading.Thread(target=serve_client, args=(session,), daemon=True).start()
+        finally:
+            read_gate.leave()
+
+def open_unix_listener(path):
+    """Listening socket at path; a socket file left behind by an earlier run is replaced."""
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(rate_limit.LISTEN_BACKLOG)
+    return listener
+
+def close_unix_listener(listener):
+    listener.close()
+    if os.path.exists(UNIX_PATH):
+        os.unlink(UNIX_PATH)
+
+def unix_peer_name():
+    # Unix socket peers are unnamed; this is what logs show for them
+    return f"unix:{UNIX_PATH}"
+
+def reject_connection(sock):
+    # Accepting and closing tells the client to back off instead of leaving it in the backlog
+    try:
+        sock.setblocking(False)
+        sock.send(framing.encode_frame(framing.DEFAULT_FRAMING, rate_limit.SERVER_FULL_REPLY.encode()))
+    except OSError:
+        pass
+    sock.close()
+
+class AsyncConnection:
+    """Socket-like wrapper so the handlers can sendall() onto an asyncio transport.
+
+    Frames wait in the bounded outbound queue and are flushed with a single
+    writelines() once per event loop iteration, or once the transport resumes
+    writing after asking us to pause. In sharded mode handlers run in executor
+    threads (see BoardProtocol), so sending and shutting down may come from
+    off the loop and are handed to it.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.queue = outbound.OutboundQueue()
+        self.paused = False
+        self.flush_scheduled = False
+        self.framing = framing.DEFAULT_FRAMING
+        self.compressed = False
+
+    def sendall(self, data):
+        self.send_framed(framing.encode_frame(self.framing, data))
+
+    def send_framed(self, frame):
+        if self.transport.is_closing():
+            raise ConnectionResetError("connection is closing")
+        if not self.queue.put(frame):
+            self.shutdown()
+            raise ConnectionResetError("Outbound queue closed for slow consumer")
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # Cleared by flush() before it takes the queue, so a frame put meanwhile is never missed
+        if not self.paused and not self.flush_scheduled:
+            self.flush_scheduled = True
+            if threading.get_ident() == self.loop_thread:
+                self.loop.call_soon(self.flush)
+            else:
+                self.loop.call_soon_threadsafe(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.paused or self.transport.is_closing():
+            return
+        batch = self.queue.pop_ready()
+        if batch:
+            self.transport.writelines(batch)
+            outbound.count_write(len(batch))
+
+    def start_compression(self, compressor):
+        self.queue.start_compression(compressor)
+        self._schedule_flush()
+
+    def shutdown(self):
+        # connection_lost runs the normal leave path
+        if threading.get_ident() == self.loop_thread:
+            self.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.transport.abort)
+
+    def fileno(self):
+        return self.transport.get_extra_info('socket').fileno()
+
+    def idle(self):
+        return self.queue.idle() and not self.transport.get_write_buffer_size()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.queue.close()
+        self.transport.close()
+
+class BoardProtocol(asyncio.Protocol):
+    """One instance per connection; no task or thread stack is kept for idle clients.
+
+    In sharded mode the HUB_COMMANDS wait for a round trip to the hub, so they
+    run in the loop's executor instead, with reading paused until they finish
+    so a connection's commands still run one at a time and in order.
+    """
+
+    def __init__(self, inherited=None):
+        self.inherited = inherited  # what the old process had for a connection taken over in a handoff
+        self.feeding = None         # the executor job running this connection's hub command, in sharded mode
+
+    def connection_made(self, transport):
+        # An inherited connection was counted when it was taken over
+        self.admitted = self.inherited is not None or rate_limit.admission.admit()
+        if not self.admitted:
+            transport.write(framing.encode_frame(framing.DEFAULT_FRAMING, rate_limit.SERVER_FULL_REPLY.encode()))
+            transport.close()
+            return
+        heartbeat.enable_keepalive(transport.get_extra_info('socket'))
+        self.conn = AsyncConnection(transport)
+        self.session = ClientSession(self.conn, transport.get_extra_info('peername') or unix_peer_name())
+        if self.inherited is None:
+            self.session.prompt()
+        else:
+            restore_session(self.session, self.inherited)
+
+    def pause_writing(self):
+        self.conn.pause_writing()
+
+    def resume_writing(self):
+        self.conn.resume_writing()
+
+    def data_received(self, data):
+        if not self.admitted:
+            return
+        if bus is None:
+            if not self.guarded(self.session.feed, data):
+                self.conn.close()
+            return
+        if self.guarded(self.session.receive, data) is False:
+            self.conn.close()
+            return
+        if self.feeding is None or self.feeding.done():
+            self.run_commands()
+
+    def run_commands(self):
+        """Runs complete commands on the loop until one has to wait on the hub, which goes to the executor."""
         while True:
-            conn, addr = s.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+            command = self.guarded(self.session.decoder.next_frame)
+            if command is False:
+                self.conn.close()
+                return
+            if command is None:
+                return
+            args = command.split(None, 1)
+            if args and args[0] in HUB_COMMANDS:
+                self.conn.transport.pause_reading()
+                self.feeding = self.conn.loop.run_in_executor(None, self.guarded, self.session.run_command, command)
+                self.feeding.add_done_callback(self.ran)
+                return
+            if not self.guarded(self.session.run_command, command):
+                self.conn.close()
+                return
+
+    def ran(self, future):
+        if not future.result():
+            self.conn.close()
+        elif not self.conn.transport.is_closing():
+            self.conn.transport.resume_reading()
+            self.run_commands()  # anything that arrived along with the command that waited
+
+    def guarded(self, run, *args):
+        """Calls run; False instead of raising if the connection broke."""
+        try:
+            return run(*args)
+        except (ConnectionError, socket.error, framing.FrameError) as e:
+            print(f"Connection error with {self.session.addr}: {e}")
+            return False
+
+    def connection_lost(self, exc):
+        if not self.admitted:
+            return
+        if bus is None:
+            self.cleanup()
+        elif self.feeding is not None and not self.feeding.done():
+            # Leaves only once the commands already running have finished
+            self.feeding.add_done_callback(lambda _: self.conn.loop.run_in_executor(None, self.cleanup))
+        else:
+            self.conn.loop.run_in_executor(None, self.cleanup)
+
+    def cleanup(self):
+        self.session.cleanup()
+        rate_limit.admission.release()
+
+async def serve_async(host=HOST, port=PORT, reuse_port=False, unix_listener=None):
+    global run_in_engine, async_loop
+    loop = async_loop = asyncio.get_running_loop()
+    run_in_engine = loop.call_soon_threadsafe
+    listeners['tcp'] = listeners.get('tcp') or open_tcp_listener(host, port, reuse_port)
+    if unix_listener is not None:
+        listeners['unix'] = unix_listener
+    await start_async_servers()
+    print(f"Server started on {host}:{port} (asyncio)")
+    if unix_listener is not None:
+        print(f"Also listening on {UNIX_PATH}")
+    for sock, saved in inherited_connections():
+        await loop.connect_accepted_socket(lambda saved=saved: BoardProtocol(saved), sock)
+    start_handoffs()
+
+    def sweep():
+        check_heartbeats()
+        loop.call_later(heartbeat.SWEEP_INTERVAL, sweep)
+    loop.call_later(heartbeat.SWEEP_INTERVAL, sweep)
+    try:
+        await loop.create_future()  # serve until the loop stops
+    finally:
+        for server in async_servers.values():
+            server.close()
+
+async def start_async_servers():
+    loop = asyncio.get_running_loop()
+    async_servers['tcp'] = await loop.create_server(BoardProtocol, sock=listeners['tcp'],
+                                                    backlog=rate_limit.LISTEN_BACKLOG)
+    if 'unix' in listeners:
+        async_servers['unix'] = await loop.create_unix_server(BoardProtocol, sock=listeners['unix'],
+                                                              backlog=rate_limit.LISTEN_BACKLOG)
+
+async def freeze_async():
+    for name, server in async_servers.items():
+        listeners[name] = listeners[name].dup()  # closing the server closes the socket it was given
+        server.close()
+    with heartbeat.sessions_lock:
+        current = list(heartbeat.sessions)
+    for session in current:
+        session.conn.transport.pause_reading()
+
+async def thaw_async():
+    await start_async_servers()
+    with heartbeat.sessions_lock:
+        current = list(heartbeat.sessions)
+    for session in current:
+        session.conn.transport.resume_reading()
+
+def start_async_server(host=HOST, port=PORT, reuse_port=False, unix_listener=None):
+    asyncio.run(serve_async(host, port, reuse_port, unix_listener))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulletin board server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--engine', choices=ENGINES, default='threaded',
+                        help="threaded: one thread per connection; asyncio: single event loop")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="run this many worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument('--unix', metavar='PATH',
+                        help="also accept connections on this Unix socket, for clients on the same host")
+    parser.add_argument('--bus-path',
+                        help="Unix socket used by sharded workers to coordinate (default: in the temp dir)")
+    parser.add_argument('--session-ttl', type=float, default=SESSION_TTL,
+                        help="seconds a dropped client has to %%resume its session (default: %(default)s)")
+    parser.add_argument('--page-size', type=int, default=HISTORY_PAGE_SIZE,
+                        help="most messages returned by one range command (default: %(default)s)")
+    parser.add_argument('--join-history', type=int, default=JOIN_HISTORY,
+                        help="recent public board messages sent to users when they join (default: %(default)s)")
+    parser.add_argument('--admin', action='append', default=[],
+                        help="username allowed to run %%stats (repeatable; default: everyone)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics over HTTP on this port (workers use port + index)")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--queue-size', type=int, default=outbound.OUTBOUND_QUEUE_SIZE,
+                        help="max frames buffered per client before the slow-consumer policy applies")
+    parser.add_argument('--slow-consumer', choices=outbound.SLOW_CONSUMER_POLICIES,
+                        default=outbound.SLOW_CONSUMER_POLICY)
+    parser.add_argument('--data-dir',
+                        help="persist board and group history in append-only logs under this directory")
+    parser.add_argument('--fsync', choices=message_log.FSYNC_POLICIES, default=message_log.FSYNC_POLICY,
+                        help="when logged messages are fsynced: every write, every batch, or on an interval")
+    parser.add_argument('--hot-messages', type=int,
+                        help="keep only this many recent messages per board/group in memory")
+    parser.add_argument('--hot-mb', type=float,
+                        help="cap the in-memory history of each board/group at this many MiB")
+    parser.add_argument('--spill-dir', default=os.path.join(tempfile.gettempdir(), 'bulletin-board-spill'),
+                        help="where messages evicted from the in-memory window are kept")
+    parser.add_argument('--max-connections', type=int, default=rate_limit.MAX_CONNECTIONS,
+                        help="refuse connections beyond this many per process (default: no limit)")
+    parser.add_argument('--backlog', type=int, default=rate_limit.LISTEN_BACKLOG,
+                        help="pending connections the kernel queues before refusing more")
+    parser.add_argument('--rate-limit', action='append', default=[], type=rate_limit.parse_limit, metavar='CLASS=RATE[/BURST]',
+                        help="commands per second allowed per connection and per username for "
+                             f"{', '.join(rate_limit.RATE_LIMITS)} commands, e.g. post=5/20 "
+                             "(repeatable; a rate of 0 disables the limit)")
+    parser.add_argument('--heartbeat', type=float, default=heartbeat.HEARTBEAT_INTERVAL,
+                        help="ping connections quiet for this many seconds (0 disables; default: %(default)s)")
+    parser.add_argument('--idle-timeout', type=float, default=heartbeat.IDLE_TIMEOUT,
+                        help="drop connections quiet for this many seconds (0 disables; default: %(default)s)")
+    parser.add_argument('--keepalive', type=int, default=heartbeat.KEEPALIVE_IDLE,
+                        help="seconds before TCP keepalive probes start (0 disables; default: %(default)s)")
+    parser.add_argument('--retention', action='append', default=[], type=retention.parse_policy,
+                        metavar='[BOARD:]age=AGE,count=N,bytes=SIZE',
+                        help="expire messages older than AGE (e.g. 30s, 12h, 7d), beyond the newest N, "
+                             "or beyond SIZE bytes (e.g. 50M), for every board or for one group "
+                             "('public' is the public board); repeatable, later values win")
+    parser.add_argument('--replication', type=replication.parse_address, metavar='ADDRESS',
+                        help="stream history to read replicas on this Unix socket path or [host:]port")
+    parser.add_argument('--follow', type=replication.parse_address, metavar='ADDRESS',
+                        help="run as a read-only replica of the primary whose --replication is ADDRESS")
+    parser.add_argument('--handoff', metavar='PATH',
+                        help="take over the listeners and connections of the server accepting handoffs on this "
+                             "Unix socket, if there is one, then accept handoffs there for the next upgrade")
+    parser.add_argument('--framing', choices=framing.FRAMING_MODES, default=framing.DEFAULT_FRAMING,
+                        help="framing used by connections until they send %%frame")
+    args = parser.parse_args(argv)
+    if args.follow and (args.workers > 1 or args.data_dir or args.replication or args.retention):
+        parser.error("--follow runs a single in-memory process that takes its history and expiry from "
+                     "the primary; it can't be combined with --workers, --data-dir, --replication or --retention")
+    if args.handoff and (args.workers > 1 or args.follow):
+        parser.error("--handoff needs a single process that owns its history; drop --workers and --follow")
+    return args
+
+def main(argv=None):
+    global HISTORY_PAGE_SIZE, SESSION_TTL, JOIN_HISTORY, UNIX_PATH, HANDOFF_PATH, METRICS_ADDRESS
+    global read_gate, takeover
+    args = parse_args(argv)
+    UNIX_PATH = args.unix
+    HISTORY_PAGE_SIZE = args.page_size
+    JOIN_HISTORY = args.join_history
+    SESSION_TTL = args.session_ttl
+    outbound.OUTBOUND_QUEUE_SIZE = args.queue_size
+    outbound.SLOW_CONSUMER_POLICY = args.slow_consumer
+    framing.DEFAULT_FRAMING = args.framing
+    rate_limit.MAX_CONNECTIONS = args.max_connections
+    rate_limit.LISTEN_BACKLOG = args.backlog
+    rate_limit.RATE_LIMITS.update(args.rate_limit)
+    heartbeat.HEARTBEAT_INTERVAL = args.heartbeat
+    heartbeat.IDLE_TIMEOUT = args.idle_timeout
+    heartbeat.KEEPALIVE_IDLE = args.keepalive
+    # Check often enough that short timeouts given on the command line are still honoured
+    heartbeat.SWEEP_INTERVAL = min([heartbeat.SWEEP_INTERVAL] +
+                                   [value / 3 for value in (args.heartbeat, args.idle_timeout) if value])
+    message_log.FSYNC_POLICY = args.fsync
+    ADMIN_USERS.update(args.admin)
+    RETENTION.update(args.retention)
+    if args.workers > 1:
+        start_sharded(args)
+        return
+    if args.handoff:
+        HANDOFF_PATH = args.handoff
+        if args.engine == 'threaded':
+            read_gate = handoff.ReadGate()
+        # Everything below runs while the old server, if there is one, holds its clients frozen
+        takeover = handoff.request(args.handoff)
+        if takeover is not None:
+            print(f"Taking over from the server at {args.handoff}")
+            for name in ('handoff', 'tcp'):
+                listener = inherited_listener(name)
+                if listener is not None:
+                    listeners[name] = listener
+    if args.data_dir:
+        open_message_logs(args.data_dir)
+    if takeover is not None:
+        load_handoff_state(takeover.state)
+    if args.data_dir or takeover is not None:
+        build_search_indexes()
+    if args.metrics_port:
+        METRICS_ADDRESS = (args.metrics_host, args.metrics_port)
+        if takeover is None:
+            start_metrics()
+    if args.hot_messages or args.hot_mb:
+        hot_bytes = int(args.hot_mb * 1024 * 1024) if args.hot_mb else 0
+        spill_dir = os.path.join(args.spill_dir, str(os.getpid()))
+        open_hot_stores(args.hot_messages, hot_bytes, spill_dir)
+    if args.follow:
+        start_following(args.follow)
+    else:
+        start_retention(board_history, expire_history, [''] + list(groups))
+    if args.replication:
+        start_replication(args.replication, replication_snapshot)
+    unix_listener = None
+    if UNIX_PATH:
+        unix_listener = inherited_listener('unix') or open_unix_listener(UNIX_PATH)
+    try:
+        if args.engine == 'asyncio':
+            start_async_server(args.host, args.port, unix_listener=unix_listener)
+        else:
+            start_server(args.host, args.port, unix_listener=unix_listener)
+    finally:
+        if unix_listener is not None:
+            close_unix_listener(unix_listener)
+        if replicator is not None:
+            replicator.close()
+        if 'handoff' in listeners and os.path.exists(HANDOFF_PATH):
+            os.unlink(HANDOFF_PATH)
+        close_histories()
 
 if __name__ == '__main__':
-    start_server()
+    main()
@@ -1,8 +1,11 @@
 import tkinter as tk
 from tkinter import messagebox
+import queue
 import socket
 import threading
 
+import heartbeat
+
 #this will give it a green-black terminal look
 retro_font = ("Courier", 12, "bold")
 bg_color = "#000000"  #black bbg
@@ -11,13 +14,23 @@ button_color = "#444444"  #dark grey buttons
 button_fg = "#000000"  #black button text
 
 client_socket = None
+unix_socket_path = None  #set to the server's --unix path to skip tcp when running on the same machine
+
+#incoming text is queued here by any thread and only drawn by the tk thread
+incoming = queue.SimpleQueue()
+max_scrollback_lines = 5000  #older lines get trimmed off the top
+drain_interval_ms = 50
 
 #connect to the server and then check the username
 def connect_to_server(username):
     try:
         global client_socket
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect(('127.0.0.1', 12345))  #update with your server IP/Port
+        if unix_socket_path:
+            client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client_socket.connect(unix_socket_path)
+        else:
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.connect(('127.0.0.1', 12345))  #update with your server IP/Port
         client_socket.sendall(username.encode('utf-8'))
         
         #waiting for server response
@@ -53,7 +66,11 @@ def listen_for_messages():
         while True:
             message = client_socket.recv(1024).decode('utf-8')
             if message:
-                append_text(message)
+                message, pings = heartbeat.strip_pings(message)
+                if pings:  #answer server pings so we aren't dropped as idle
+                    client_socket.sendall(heartbeat.PONG_COMMAND.encode('utf-8'))
+                if message:
+                    append_text(message)
             else:
                 break
     except Exception as e:
@@ -62,10 +79,25 @@ def listen_for_messages():
         client_socket.close()
 
 def append_text(message):
-    chat_log.config(state=tk.NORMAL)
-    chat_log.insert(tk.END, message + "\n")
-    chat_log.config(state=tk.DISABLED)
-    chat_log.see(tk.END)
+    incoming.put(message)
+
+#draws everything queued since last time in one insert, then trims the scrollback
+def drain_incoming():
+    messages = []
+    while True:
+        try:
+            messages.append(incoming.get_nowait())
+        except queue.Empty:
+            break
+    if messages:
+        chat_log.config(state=tk.NORMAL)
+        chat_log.insert(tk.END, "\n".join(messages) + "\n")
+        lines = int(chat_log.index("end-1c").split(".")[0]) - 1
+        if lines > max_scrollback_lines:
+            chat_log.delete("1.0", f"{lines - max_scrollback_lines + 1}.0")
+        chat_log.config(state=tk.DISABLED)
+        chat_log.see(tk.END)
+    root.after(drain_interval_ms, drain_incoming)
 
 #disconnecting from the server
 def disconnect():
@@ -122,4 +154,5 @@ exit_button = tk.Button(chat_frame, text="Exit", font=retro_font, bg=button_colo
 exit_button.pack(pady=5)
 
 root.protocol("WM_DELETE_WINDOW", disconnect)
+root.after(drain_interval_ms, drain_incoming)
 root.mainloop()